@@ -34,6 +34,7 @@ import connect
 import UserInterface
 import DicomExport
 import TomoExport
+import OptimizationOperations
 
 
 def main():
@@ -120,6 +121,17 @@ def main():
             else:
                 logging.warning('The user chose to export the structure set without approval')
                 ignore = True
+
+        # Add the solutions of the approved plan to the warm-start solution library of their protocol
+        try:
+            if plan.Review is not None and plan.Review.ApprovalStatus == 'Approved':
+                stored = OptimizationOperations.store_solutions(patient, case, plan)
+                if stored:
+                    logging.info('Solutions of {} stored in the solution library'.format(', '.join(stored)))
+
+        except Exception as e:
+            logging.warning('Solutions of plan {} could not be stored: {}'.format(plan.Name, e))
+
     for b in DicomExport.machines(beamset):
         logging.debug('list of machines is {}'.format(b))
 
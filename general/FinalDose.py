@@ -79,13 +79,12 @@ def main():
     grid_test = True
     # Let the statements below change as needed
     tomo_couch_test = False
-    check_lateral_pa = False
+    clearance_test = False
     cps_test = False
     # Set up the workflow steps.
     steps = []
     if 'Tomo' not in beamset.DeliveryTechnique and beamset.Modality != 'Electrons':
-        if check_lateral_pa:
-            steps.append('Check Laterality')
+        steps.append('Check gantry clearance')
         steps.append('Rename Beams')
         steps.append('Check for external structure integrity')
         steps.append('Check SimFiducials have coordinates')
@@ -97,6 +96,7 @@ def main():
         steps.append('Round Jaws')
         steps.append('Recompute Dose')
         cps_test = True
+        clearance_test = True
 
     if 'Tomo' in beamset.DeliveryTechnique:
         steps.append('Rename Beams')
@@ -121,13 +121,18 @@ def main():
                                         help=__help__)
     status.next_step('Checking beam names')
 
-    if check_lateral_pa:
-        # Check the lateral PA for clearance
-        for b in beamset.Beams:
-            change_gantry = BeamOperations.check_pa(plan=plan, beam=b)
-            logging.debug('Recommended change for {} is {}'.format(b.Name, change_gantry))
-        # BeamOperations.check_clearance(beamset=beamset)
-        status.next_step('Checked field orientations')
+    if clearance_test:
+        # Check the gantry clearance of the patient and couch for every beam and arc. The head and couch models
+        # are approximate, so potential collisions are reported without stopping the script
+        clearance = BeamOperations.check_clearance(case=case, exam=exam, beamset=beamset)
+        collisions = []
+        if clearance is not None:
+            collisions = ['{}: {}'.format(k, v['Collisions']) for k, v in clearance.items() if v['Collisions']]
+        if collisions:
+            logging.warning('Potential gantry collisions at gantry angles {}'.format('; '.join(collisions)))
+            status.next_step('Potential gantry collisions, verify clearance: {}'.format('; '.join(collisions)))
+        else:
+            status.next_step('Checked gantry clearance')
 
     if rename_beams:
         # Rename the beams
@@ -299,7 +304,10 @@ def main():
         status.next_step('DSP set, checking statistics')
         mc_histories = 500000
         # Make sure electron monte carlo statistical uncertainty is clinical
-        emc_result = BeamOperations.check_emc(beamset, stat_limit=0.005, histories=mc_histories)
+        # The planner records each calculation and predicts the histories needed from past calculations
+        emc_planner = BeamOperations.EmcPlanner()
+        emc_result = BeamOperations.check_emc(beamset, stat_limit=0.005, histories=mc_histories,
+                                              planner=emc_planner)
         # If the test returns an insufficient uncertainty, change the number of histories
         if emc_result.bool is False:
             beamset.AccurateDoseAlgorithm.MonteCarloHistoriesPerAreaFluence = emc_result.hist
@@ -311,6 +319,8 @@ def main():
         status.next_step('Rounded MU, recomputing doses')
         # Compute Dose with new DSP, and recommended history settings (mainly to force a DSP update)
         beamset.ComputeDose(ComputeBeamDoses=True, DoseAlgorithm=dose_algorithm, ForceRecompute=True)
+        # Record the final calculation to improve future history predictions
+        emc_planner.record(beamset)
         status.next_step('Script Complete')
 
     logcrit('Final Dose Script Run Successfully')
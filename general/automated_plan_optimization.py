@@ -30,11 +30,30 @@
                   beamset=beamset,
                   **optimization_inputs)
 
+    Batch Usage:
+    A job file (.json list or .jsonl, one job per line) lists the plans to optimize
+    overnight without any dialogs, e.g.
+    {"PatientID": "123456", "Case": "Case 1", "Plan": "VMAT_Test", "BeamSet": "VMAT_Test",
+     "OptimizationInputs": {"n_iterations": 6, "vary_grid": true}}
+
+    import automated_plan_optimization
+    jobs = automated_plan_optimization.read_jobs('jobs.jsonl')
+    results = automated_plan_optimization.run_queue(jobs, export=export_function)
+
+    Each patient is opened in turn, optimized with optimize_plan(headless=True, telemetry=True),
+    saved and the outcome of the job appended to the results file. A failed job is logged and
+    the queue moves on to the next. Completed jobs are passed to export, a function
+    export(job, patient, case, plan, beamset). Run without a loaded patient, this script
+    prompts for a job file and runs the queue (queue_main).
+
     Script Created by RAB 12Dec2019
     Prerequisites:
 
     Version history:
     1.0.0 Moved Most functions to the OptimizeOperations library
+    1.0.1 Added read_jobs and run_queue for headless batch optimization of many plans
+    1.0.2 Queued runs write telemetry and save the patient once. The queue runs when no patient is loaded
+    1.0.3 Adaptive Dose Grid selects the variable dose grid without Variable Dose Grid also checked
 
 
     This program is free software: you can redistribute it and/or modify it under
@@ -67,12 +86,126 @@ __copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
 __credits__ = ['']
 #
 
+import os
+import re
+import sys
+import json
+import time
 import logging
 import connect
 import UserInterface
 import OptimizationOperations
 
 
+def read_jobs(path):
+    """
+    Read an optimization job file. The file is either a json list of jobs or a json-lines file
+    with one job per line. Each job is a dictionary of the form
+    {'PatientID': '123456', 'Case': 'Case 1', 'Plan': 'Plan', 'BeamSet': 'BeamSet',
+     'OptimizationInputs': {...}}
+    :param path: path to the job file
+    :return: list of job dictionaries
+    """
+    with open(path, 'r') as f:
+        text = f.read()
+    if os.path.splitext(path)[1].lower() == '.json':
+        jobs = json.loads(text)
+    else:
+        jobs = [json.loads(l) for l in text.splitlines() if l.strip()]
+    for i, j in enumerate(jobs):
+        missing = [k for k in ['PatientID', 'Case', 'Plan', 'BeamSet'] if k not in j]
+        if missing:
+            raise ValueError('Job {} in {} is missing {}'.format(i + 1, path, ', '.join(missing)))
+        j.setdefault('OptimizationInputs', {})
+    return jobs
+
+
+def open_job(job, connect_module=None):
+    """
+    Load the patient of a job and set the case, plan and beamset current
+    :param job: job dictionary, see read_jobs
+    :param connect_module: the RayStation connect module, or a stand-in for it
+    :return: patient, case, plan, beamset
+    """
+    rs = connect_module if connect_module is not None else connect
+    db = rs.get_current("PatientDB")
+    patient_info = db.QueryPatientInfo(Filter={'PatientID': '^{0}$'.format(re.escape(job['PatientID']))})
+    if len(patient_info) != 1:
+        raise IOError('{} patients found matching PatientID {}'.format(len(patient_info), job['PatientID']))
+    patient = db.LoadPatient(PatientInfo=patient_info[0])
+    case = patient.Cases[job['Case']]
+    case.SetCurrent()
+    plan = case.TreatmentPlans[job['Plan']]
+    plan.SetCurrent()
+    beamset = plan.BeamSets[job['BeamSet']]
+    beamset.SetCurrent()
+    return patient, case, plan, beamset
+
+
+def run_queue(jobs, connect_module=None, export=None, results_path=None):
+    """
+    Optimize each job in turn without a user interface. Every patient is saved after
+    optimization and telemetry is written by optimize_plan. Failures are logged and
+    recorded and the queue continues with the next job.
+    :param jobs: list of job dictionaries, see read_jobs
+    :param connect_module: the RayStation connect module, or a stand-in for it
+    :param export: function export(job, patient, case, plan, beamset) called for each completed job
+    :param results_path: json-lines file the result of each job is appended to
+    :return: list of result dictionaries with Job, Status, Seconds and Error
+    """
+    results = []
+    for i, job in enumerate(jobs):
+        name = '{} {}/{}/{}'.format(job['PatientID'], job['Case'], job['Plan'], job['BeamSet'])
+        logging.info('Optimization queue: starting job {} of {}: {}'.format(i + 1, len(jobs), name))
+        result = {'Job': job, 'Status': 'Failed', 'Error': None, 'Seconds': 0.}
+        time_start = time.time()
+        try:
+            patient, case, plan, beamset = open_job(job, connect_module=connect_module)
+            optimization_inputs = dict(job.get('OptimizationInputs', {}))
+            optimization_inputs['headless'] = True
+            optimization_inputs.setdefault('telemetry', True)
+            # The patient is saved below, once the optimization is complete
+            optimization_inputs['save'] = False
+            OptimizationOperations.optimize_plan(patient=patient,
+                                                 case=case,
+                                                 plan=plan,
+                                                 beamset=beamset,
+                                                 **optimization_inputs)
+            patient.Save()
+            result['Status'] = 'Optimized'
+            if export is not None:
+                export(job, patient, case, plan, beamset)
+                result['Status'] = 'Exported'
+        except (Exception, SystemExit) as e:
+            result['Error'] = '{}: {}'.format(type(e).__name__, e)
+            logging.exception('Optimization queue: job {} failed: {}'.format(name, result['Error']))
+        result['Seconds'] = time.time() - time_start
+        results.append(result)
+        if results_path is not None:
+            try:
+                with open(results_path, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+            except IOError as e:
+                logging.warning('Optimization queue: unable to write {}: {}'.format(results_path, e))
+    logging.info('Optimization queue: {} of {} jobs completed'.format(
+        len([r for r in results if r['Status'] != 'Failed']), len(results)))
+    return results
+
+
+def queue_main():
+    """Prompt for a job file and optimize every job in it, writing the results next to the job file"""
+    browser = UserInterface.CommonDialog()
+    path = browser.open_file(title='Select an optimization job file',
+                             filters='Job Files (*.jsonl;*.json)|*.jsonl;*.json')
+    if not path:
+        sys.exit('No job file selected')
+    results = run_queue(read_jobs(path), results_path=os.path.splitext(path)[0] + '_results.jsonl')
+    failed = [r for r in results if r['Status'] == 'Failed']
+    if failed:
+        UserInterface.WarningBox('{} of {} optimization jobs failed, see the results file'.format(
+            len(failed), len(results)))
+
+
 def main():
     try:
         Patient = connect.get_current("Patient")
@@ -136,7 +269,7 @@ def main():
         options={
             'input01_fluence_only': ['Fluence calc'],
             'input02_cold_start': ['Reset Beams'],
-            'input07_vary_dose_grid': ['Variable Dose Grid'],
+            'input07_vary_dose_grid': ['Variable Dose Grid', 'Adaptive Dose Grid'],
             'input09_segment_weight': ['Perform Segment Weighted optimization'],
             'input10_reduce_oar': ['Perform reduce OAR dose before completion'],
             # Small Target
@@ -146,15 +279,25 @@ def main():
     optimization_dialog.show()
 
     # DATA PARSING FOR THE OPTIMIZATION MENU
-    # Determine if variable dose grid is selected
+    # Determine if variable dose grid is selected, the adaptive dose grid is a variable dose grid
     try:
-        if 'Variable Dose Grid' in optimization_dialog.values['input07_vary_dose_grid']:
+        if 'Variable Dose Grid' in optimization_dialog.values['input07_vary_dose_grid'] or \
+                'Adaptive Dose Grid' in optimization_dialog.values['input07_vary_dose_grid']:
             vary_dose_grid = True
         else:
             vary_dose_grid = False
     except KeyError:
         vary_dose_grid = False
 
+    # Refine the variable dose grid when the objective stops improving rather than at fixed iterations
+    try:
+        if 'Adaptive Dose Grid' in optimization_dialog.values['input07_vary_dose_grid']:
+            grid_refine_tolerance = 0.05
+        else:
+            grid_refine_tolerance = None
+    except KeyError:
+        grid_refine_tolerance = None
+
     # SVD to DAO calc for cold start (first optimization)
     try:
         if 'Fluence calc' in optimization_dialog.values['input01_fluence_only']:
@@ -205,6 +348,7 @@ def main():
         'second_max_it': int(optimization_dialog.values['input05_ws_max_iteration']),
         'second_int_it': int(optimization_dialog.values['input06_ws_interm_iteration']),
         'vary_grid': vary_dose_grid,
+        'grid_refine_tolerance': grid_refine_tolerance,
         'dose_dim1': 0.5,
         'dose_dim2': 0.4,
         'dose_dim3': 0.3,
@@ -226,4 +370,13 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    # Without a loaded patient the script runs a batch optimization queue
+    try:
+        connect.get_current('Patient')
+        run_batch = False
+    except SystemError:
+        run_batch = True
+    if run_batch:
+        queue_main()
+    else:
+        main()
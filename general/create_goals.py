@@ -23,11 +23,13 @@
     1.0.0 initial release supporting HN, Prostate, and lung (non-SBRT)
     1.0.1 supporting SBRT, brain, and knowledge-based goals for RTOG-SBRT Lung
     2.0.0 Adding the clinical objectives for IMRT
+    2.0.1 RTOG SBRT limits as numpy tables interpolated for all targets at once, knowledge-based goals
+          computed in one batch (knowledge_based_goals) with a single pass over the structure volumes
 
 """
 __author__ = 'Adam Bayliss'
 __contact__ = 'rabayliss@wisc.edu'
-__version__ = '2.0.0'
+__version__ = '2.0.1'
 __license__ = 'GPLv3'
 __help__ = 'https://github.com/wrssc/ray_scripts/wiki/CreateGoals'
 __copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
@@ -35,16 +37,54 @@ __copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
 import sys
 import os
 import logging
+import numpy as np
 import Objectives
 import connect
 import UserInterface
 import Goals
 import StructureOperations
+import ProtocolIndex
 from GeneralOperations import logcrit as logcrit
 from GeneralOperations import find_scope as find_scope
 
 
-def rtog_sbrt_dgi(case, examination, target, flag, isodose=None):
+# RTOG SBRT lung limits by target volume [cc]: the minor and major deviation limits on the gradient index (DGI) and
+# on the maximum dose 2 cm from the target (Normal_2cm), the latter as a fraction of the goal dose
+_rtog_sbrt_volumes = np.array([1.8, 3.8, 7.4, 13.2, 22, 34, 50, 70, 95, 126, 163])
+_rtog_sbrt_limits = {
+    'rtog_sbr_dgi_minor': np.array([0.17, 0.18, 0.20, 0.21, 0.22, 0.23, 0.25, 0.29, 0.30, 0.32, 0.34]),
+    'rtog_sbr_dgi_major': np.array([0.13, 0.15, 0.17, 0.17, 0.18, 0.19, 0.20, 0.21, 0.23, 0.25, 0.27]),
+    'rtog_sbr_norm2_major': np.array([0.57, 0.57, 0.58, 0.58, 0.63, 0.68, 0.77, 0.86, 0.89, 0.91, 0.94]),
+    'rtog_sbr_norm2_minor': np.array([0.50, 0.50, 0.50, 0.50, 0.54, 0.58, 0.62, 0.66, 0.70, 0.73, 0.77])}
+_rtog_sbrt_dose_scaled = ('rtog_sbr_norm2_major', 'rtog_sbr_norm2_minor')
+
+
+def rtog_sbrt_limits(volumes, flag, isodose=None):
+    """
+    RTOG SBRT limits interpolated on the target volume for an array of targets. Volumes outside of the RTOG
+    table are given the limit of the smallest or largest table volume.
+
+    :param volumes: target volumes in cc
+    :param flag: type of goal to be used
+    :param isodose: goal doses of the Normal_2cm limits, one per target or a single dose
+    :return: numpy array of the limits, zeros for an unknown flag
+    """
+    volumes = np.asarray(volumes, dtype=float)
+    if flag not in _rtog_sbrt_limits:
+        logging.warning("rtog_sbrt_limits: Unknown flag {} used in call. Returning zero".format(flag))
+        return np.zeros(volumes.shape)
+
+    outside = np.sum((volumes < _rtog_sbrt_volumes[0]) | (volumes > _rtog_sbrt_volumes[-1]))
+    if outside:
+        logging.warning('rtog_sbrt_limits: {} target volume(s) outside of the RTOG volume limits '.format(outside) +
+                        'use the lowest or highest available index')
+    limits = np.interp(volumes, _rtog_sbrt_volumes, _rtog_sbrt_limits[flag])
+    if flag in _rtog_sbrt_dose_scaled:
+        limits *= np.asarray(isodose, dtype=float)
+    return limits
+
+
+def rtog_sbrt_dgi(case, examination, target, flag, isodose=None, roi_cache=None):
     """
     implementation of the RTOG limits for DGI and PITV modified to allow the
     use of the conformity index
@@ -54,77 +94,21 @@ def rtog_sbrt_dgi(case, examination, target, flag, isodose=None):
     :param target: roi to be used for evaluation of knowledge-based goal
     :param flag: type of goal to be used
     :param isodose: optional for inputing a relative dose value
+    :param roi_cache: Objectives.RoiCache of the examination, to reuse volumes already fetched
     :return: a float that is the desired index or dose
     """
-    prot_vol = [1.8, 3.8, 7.4, 13.2, 22, 34, 50, 70, 95, 126, 163]
-    if flag == 'rtog_sbr_dgi_minor':
-        index = [0.17, 0.18, 0.20, 0.21, 0.22, 0.23, 0.25, 0.29, 0.30, 0.32, 0.34]
-        logging.debug('rtog_sbrt_dgi: Minor DGI selected.')
-    elif flag == 'rtog_sbr_dgi_major':
-        index = [0.13, 0.15, 0.17, 0.17, 0.18, 0.19, 0.20, 0.21, 0.23, 0.25, 0.27]
-        logging.debug('rtog_sbrt_dgi: Major DGI selected.')
-    elif flag == 'rtog_sbr_norm2_major':
-        unscaled_index = [0.57, 0.57, 0.58, 0.58, 0.63, 0.68, 0.77, 0.86, 0.89, 0.91, 0.94]
-        index = [i * float(isodose) for i in unscaled_index]
-        logging.debug('rtog_sbrt_dgi: Major Normal_2cm selected. Index scaled by dose {}'.format(isodose))
-    elif flag == 'rtog_sbr_norm2_minor':
-        unscaled_index = [0.50, 0.50, 0.50, 0.50, 0.54, 0.58, 0.62, 0.66, 0.70, 0.73, 0.77]
-        index = [i * float(isodose) for i in unscaled_index]
-        logging.debug('rtog_sbrt_dgi: Minor Normal_2cm selected. Index scaled by dose {}'.format(isodose))
-    else:
-        logging.warning("rtog_sbrt_dgi: Unknown flag used in call. Returning zero")
-        return 0.0
-
-    vol = 0.0
-    try:
-        t = case.PatientModel.StructureSets[examination.Name]. \
-            RoiGeometries[target]
-        if t.HasContours():
-            vol = t.GetRoiVolume()
-        else:
-            logging.warning('rtog_sbrt_dgi: {} has no contours, index undefined'.format(target))
-    except:
-        logging.warning('rtog_sbrt_dgi: Error getting volume for {}, volume => 0.0'.format(target))
-
-    # Compute density from the actual dose grid representation
-    # fd = beamset.FractionDose
-    # roi = fd.GetDoseGridRoi(RoiName=target)
-    # vol = roi.RoiVolumeDistribution.TotalVolume
-    # logging.debug('Type of roi {}'.format(type(roi)))
-    if abs(vol) <= 1e-9:
+    if roi_cache is None:
+        roi_cache = Objectives.RoiCache(case=case, exam=examination)
+    vol = roi_cache.volume(target)
+    if vol is None or abs(vol) <= 1e-9:
         logging.warning('rtog_sbrt_dgi: Volume is 0.0 for {}'.format(target))
-    else:
-        logging.debug('rtog_sbrt_dgi: Volume for {} is {}'.format(
-            target, vol))
-    v = prot_vol[0]
-    i = 0
-    # Find first volume exceeding target volume or find the end of the list
-    while v <= vol and i <= len(prot_vol) - 1:
-        i += 1
-        v = prot_vol[i]
-    # Exceptions for target volumes exceeding or smaller than the minimum volume
-    if i == 0:
-        logging.warning('rtog_sbrt_dgi.py: Target volume < RTOG volume limits' +
-                        '  returning lowest available index{}'.format(index[i]))
-        return index[i]
-    elif i == len(prot_vol):
-        logging.warning('rtog_sbrt_dgi.py: Target volume > RTOG volume limits' +
-                        ' returning highest available index{}'.format(index[i]))
-        return index[i]
-    # Interpolate on i and i - 1
-    else:
-        interp = index[i - 1] + (vol - prot_vol[i - 1]) * (
-                (index[i] - index[i - 1]) / (prot_vol[i] - prot_vol[i - 1]))
-        logging.info('rtog_sbrt_dgi: {} volume is {}, index = {}. '.format(
-            target, vol, interp))
-        logging.debug('Table searched lower bound on volume ' +
-                      'interpolating volumes: ({}, {}) and index: ({}, {})'.format(
-                          prot_vol[i - 1], prot_vol[i], index[i - 1], index[i]
-                      ))
-        return interp
-
-
-def residual_volume(structure_name, goal_volume, case, exam):
+        vol = 0.0
+    index = float(rtog_sbrt_limits([vol], flag, isodose=isodose)[0])
+    logging.info('rtog_sbrt_dgi: {} volume is {}, index = {}. '.format(target, vol, index))
+    return index
+
+
+def residual_volume(structure_name, goal_volume, case, exam, roi_cache=None):
     """
     Used for finding the remaining volume in terms of the total.  Use for limits
     that must preserve a certain number of cc exposed below a limit
@@ -132,20 +116,13 @@ def residual_volume(structure_name, goal_volume, case, exam):
     :param goal_volume: desired residual volume
     :param case: current case
     :param exam: current exam
+    :param roi_cache: Objectives.RoiCache of the examination, to reuse volumes already fetched
     :return: the residual volume as a percentage of the total or zero if volume is undefined
     """
-    vol = 0.0
-    try:
-        t = case.PatientModel.StructureSets[exam.Name]. \
-            RoiGeometries[structure_name]
-        if t.HasContours():
-            vol = t.GetRoiVolume()
-        else:
-            logging.warning('residual_volume: {} has no contours, index undefined'.format(structure_name))
-    except:
-        logging.warning('residual_volume: Error getting volume for {}, volume => 0.0'.format(structure_name))
-
-    if abs(vol) <= 1e-9:
+    if roi_cache is None:
+        roi_cache = Objectives.RoiCache(case=case, exam=exam)
+    vol = roi_cache.volume(structure_name)
+    if vol is None or abs(vol) <= 1e-9:
         logging.warning('residual_volume: Volume is 0.0 for {}'.format(structure_name))
         return 0
     else:
@@ -185,36 +162,74 @@ def knowledge_based_goal(structure_name, goal_type, case, exam,
     :param comp_structure: a comparison structure for conditional evaluation
     :return: know_analysis - dictionary containing the elements that need to be changed
     """
-    know_analysis = {}
-    if goal_type in ['rtog_sbr_dgi_minor', 'rtog_sbr_dgi_major']:
-        know_analysis['index'] = rtog_sbrt_dgi(case=case,
-                                               examination=exam,
-                                               target=structure_name,
-                                               flag=goal_type)
-    elif goal_type in ['rtog_sbr_norm2_major', 'rtog_sbr_norm2_minor']:
-        know_analysis['dose'] = rtog_sbrt_dgi(case=case,
-                                              examination=exam,
-                                              target=structure_name,
-                                              flag=goal_type,
-                                              isodose=isodose)
-    elif goal_type in ['resid_vol']:
-        know_analysis['volume'] = residual_volume(structure_name=structure_name,
-                                                  goal_volume=res_vol,
-                                                  case=case,
-                                                  exam=exam)
-        know_analysis['units'] = '%'
-    elif goal_type in ['overlap']:
-        know_analysis = conditional_overlap(structure_name=structure_name,
-                                            goal_volume=res_volume,
-                                            case=case,
-                                            exam=exam,
-                                            comp_structure=comp_structure,
-                                            isodose=isodose)
-    else:
-        know_analysis['error'] = True
-        logging.warning('knowledge_based_goal: Unsupported knowledge-based goal')
+    return knowledge_based_goals([{'structure_name': structure_name,
+                                   'goal_type': goal_type,
+                                   'isodose': isodose,
+                                   'res_vol': res_vol,
+                                   'comp_structure': comp_structure}],
+                                 case=case,
+                                 exam=exam)[0]
 
-    return know_analysis
+
+def knowledge_based_goals(goals, case, exam, roi_cache=None):
+    """
+    Batch of knowledge_based_goal: the volumes of all structures are fetched in one pass and the RTOG SBRT
+    limits and residual volumes of all goals of a type are computed at once.
+    :param goals: list of dicts with the knowledge_based_goal arguments structure_name, goal_type and
+                  optionally isodose, res_vol and comp_structure
+    :param case: RS case object
+    :param exam: RS examination object
+    :param roi_cache: Objectives.RoiCache of the examination, to reuse volumes already fetched
+    :return: list of know_analysis dictionaries in the order of goals
+    """
+    if roi_cache is None:
+        roi_cache = Objectives.RoiCache(case=case, exam=exam)
+    roi_cache.prefetch([g['structure_name'] for g in goals])
+    volumes = np.array([roi_cache.volume(g['structure_name']) or 0.0 for g in goals])
+    for g, v in zip(goals, volumes):
+        if abs(v) <= 1e-9:
+            logging.warning('knowledge_based_goals: Volume is 0.0 for {}'.format(g['structure_name']))
+
+    know_analyses = [{} for _ in goals]
+    types = {}
+    for i, g in enumerate(goals):
+        types.setdefault(g['goal_type'], []).append(i)
+
+    for goal_type, indices in types.items():
+        if goal_type in ['rtog_sbr_dgi_minor', 'rtog_sbr_dgi_major']:
+            limits = rtog_sbrt_limits(volumes[indices], goal_type)
+            for i, l in zip(indices, limits):
+                know_analyses[i]['index'] = float(l)
+        elif goal_type in ['rtog_sbr_norm2_major', 'rtog_sbr_norm2_minor']:
+            limits = rtog_sbrt_limits(volumes[indices], goal_type,
+                                      isodose=[goals[i]['isodose'] for i in indices])
+            for i, l in zip(indices, limits):
+                know_analyses[i]['dose'] = float(l)
+        elif goal_type in ['resid_vol']:
+            goal_volumes = np.array([goals[i]['res_vol'] for i in indices], dtype=float)
+            total = volumes[indices]
+            defined = np.abs(total) > 1e-9
+            residual = np.zeros(total.shape)
+            residual[defined] = 100 * (total[defined] - goal_volumes[defined]) / total[defined]
+            for i, r in zip(indices, residual):
+                know_analyses[i]['volume'] = float(r)
+                know_analyses[i]['units'] = '%'
+        elif goal_type in ['overlap']:
+            for i in indices:
+                know_analyses[i] = conditional_overlap(structure_name=goals[i]['structure_name'],
+                                                       goal_volume=goals[i].get('res_vol'),
+                                                       case=case,
+                                                       exam=exam,
+                                                       comp_structure=goals[i].get('comp_structure'),
+                                                       isodose=goals[i].get('isodose'))
+        else:
+            for i in indices:
+                know_analyses[i]['error'] = True
+            logging.warning('knowledge_based_goals: Unsupported knowledge-based goal {}'.format(goal_type))
+
+    logging.debug('knowledge_based_goals: {} goals on {} structures'.format(
+        len(goals), len(set(g['structure_name'] for g in goals))))
+    return know_analyses
 
 
 def main():
@@ -276,9 +291,11 @@ def main():
         protocol_name = input_dialog.values['i']
         order_name = None
         order_list = []
+        orders = {}
         protocol = tpo.protocols[input_dialog.values['i']]
-        for o in protocol.findall('order/name'):
-            order_list.append(o.text)
+        for o in protocol.findall('order'):
+            order_list.append(o.find('name').text)
+            orders[o.find('name').text] = o
 
         if len(order_list) >= 1:
             use_orders = True
@@ -296,15 +313,7 @@ def main():
             logging.critical("Order selected: {}".format(
                 input_dialog.values['i']))
             # Update the order name
-
-            # I believe this loop can be eliminated with we can use a different function
-            # to match protocol.find('order') with input_dialog.values['i']
-            for o in protocol.findall('order'):
-                if o.find('name').text == input_dialog.values['i']:
-                    order = o
-                    logging.debug('Matching protocol ElementTag found for {}'.format(
-                        input_dialog.values['i']))
-                    break
+            order = orders[input_dialog.values['i']]
             order_name = input_dialog.values['i']
 
         else:
@@ -333,30 +342,34 @@ def main():
         if use_orders:
             goal_locations = (protocol.findall('./goals/roi'), order.findall('./goals/roi'))
         else:
-            goal_locations = (protocol.findall('./goals/roi'))
+            goal_locations = (protocol.findall('./goals/roi'),)
+        # Goals of the protocol followed by those of the order, from the protocol index
+        # Only the protocol files of the folder the protocol was selected from, not e.g. retired copies
+        goal_references = [r for r in ProtocolIndex.get_index().order_references(
+            order_name, protocol=protocol_name, kinds=['goal'], goalsets=False, folder=path_protocols)
+            if r.record.priority is not None]
+        plan_target_set = set(plan_targets)
         # Use the following loop to find the targets in protocol matching the names above
-        for s in goal_locations:
-            for g in s:
-                g_name = g.find('name').text
-                # Priorities should be even for targets and append unique elements only
-                # into the protocol_targets list
-                if int(g.find('priority').text) % 2 == 0 and g_name not in protocol_targets:
-                    protocol_targets.append(g_name)
-                    k = str(i)
-                    # Python doesn't sort lists....
-                    k_name = k.zfill(2) + 'Aname_' + g_name
-                    k_dose = k.zfill(2) + 'Bdose_' + g_name
-                    target_inputs[k_name] = 'Match a plan target to ' + g_name
-                    target_options[k_name] = plan_targets
-                    target_datatype[k_name] = 'combo'
-                    target_required.append(k_name)
-                    target_inputs[k_dose] = 'Provide dose for protocol target: ' + g_name + ' Dose in cGy'
-                    target_required.append(k_dose)
-                    i += 1
-                    # Exact matches get an initial guess in the dropdown
-                    for t in plan_targets:
-                        if g_name == t:
-                            target_initial[k_name] = t
+        for g in goal_references:
+            g_name = g.record.name
+            # Priorities should be even for targets and append unique elements only
+            # into the protocol_targets list
+            if int(g.record.priority) % 2 == 0 and g_name not in protocol_targets:
+                protocol_targets.append(g_name)
+                k = str(i)
+                # Python doesn't sort lists....
+                k_name = k.zfill(2) + 'Aname_' + g_name
+                k_dose = k.zfill(2) + 'Bdose_' + g_name
+                target_inputs[k_name] = 'Match a plan target to ' + g_name
+                target_options[k_name] = plan_targets
+                target_datatype[k_name] = 'combo'
+                target_required.append(k_name)
+                target_inputs[k_dose] = 'Provide dose for protocol target: ' + g_name + ' Dose in cGy'
+                target_required.append(k_dose)
+                i += 1
+                # Exact matches get an initial guess in the dropdown
+                if g_name in plan_target_set:
+                    target_initial[k_name] = g_name
 
         # Warn the user they are missing organs at risk specified in the order
         rois = []  # List of contours in plan
@@ -365,16 +378,14 @@ def main():
         for r in case.PatientModel.RegionsOfInterest:
             # Maybe extend, can't remember
             rois.append(r.Name)
-        for s in goal_locations:
-            for g in s:
-                g_name = g.find('name').text
-                if g_name not in protocol_rois: protocol_rois.append(g_name)
-                # Add a quick check if the contour exists in RS
-                # This step is slow, we may want to gather all rois into a list and look for it
-                if int(g.find('priority').text) % 2:
-                    if not any(r == g_name for r in rois) and g_name not in missing_contours:
-                        #       case.PatientModel.RegionsOfInterest) and g_name not in missing_contours:
-                        missing_contours.append(g_name)
+        roi_set = set(rois)
+        for g in goal_references:
+            g_name = g.record.name
+            if g_name not in protocol_rois: protocol_rois.append(g_name)
+            # Add a quick check if the contour exists in RS
+            if int(g.record.priority) % 2:
+                if g_name not in roi_set and g_name not in missing_contours:
+                    missing_contours.append(g_name)
 
         # Launch the matching script here. Then check for any missing that remain. Supply function with rois and
         # protocol_rois
@@ -389,19 +400,10 @@ def main():
             for r in case.PatientModel.RegionsOfInterest:
                 # Maybe extend, can't remember
                 rois.append(r.Name)
+            roi_set = set(rois)
 
-            m_c = []
-            found = False
-            for m in missing_contours:
-                # We don't want in, we need an exact match - for length too
-                for r in rois:
-                    found = False
-                    if r == m:
-                        found = True
-                        break
-                if not found:
-                    if m not in m_c:
-                        m_c.append(m)
+            # We don't want in, we need an exact match - for length too
+            m_c = [m for m in missing_contours if m not in roi_set]
             if not m_c:
                 logging.debug('All structures in protocol accounted for')
             else:
@@ -447,6 +449,9 @@ def main():
 
         status.next_step(text="Adding goals.", num=3)
         # Iterate over goals in orders and protocols
+        plan_goals = []
+        know_elements = []
+        know_requests = []
         for seq in goal_locations:
             for g in seq:
                 # try:
@@ -493,8 +498,8 @@ def main():
                         pass
 
                 #  Knowledge-based goals:
-                #  Call the knowledge_based_goal for the correct structure
-                #  Use the returned dictionary to modify the ElementTree
+                #  Collect the knowledge_based_goal request for the correct structure,
+                #  all requests are computed in one batch below
                 if 'know' in g.find('type').attrib:
                     # TODO: Consider a new type for know-goals in the xml
                     try:
@@ -507,41 +512,46 @@ def main():
                         vol = g.find('volume').text
                     else:
                         vol = None
-                    know_goal = knowledge_based_goal(
-                        structure_name=p_r,
-                        goal_type=g.find('type').attrib['know'],
-                        case=case,
-                        exam=exam,
-                        isodose=g.find('dose').text,
-                        res_vol=vol)
-                    # use a dictionary for storing the return values
-                    try:
-                        g.find('index').text = str(know_goal['index'])
-                        logging.debug('Index changed for ROI {} to {}'.format(
-                            g.find('name').text, g.find('index').text))
-                    except KeyError:
-                        logging.debug('knowledge goals for {} had no index information'.format(
-                            g.find('name').text))
-                    try:
-                        g.find('dose').text = str(know_goal['dose'])
-                        logging.debug('Dose changed for ROI {} to {}'.format(
-                            g.find('name').text, g.find('dose').text))
-                    except KeyError:
-                        logging.debug('knowledge goals for {} had no dose information'.format(
-                            g.find('name').text))
-                    try:
-                        g.find('volume').text = str(know_goal['volume'])
-                        g.find('volume').attrib['units'] = str(know_goal['units'])
-                        logging.debug('Index changed for ROI {} to {}'.format(
-                            g.find('name').text, g.find('volume').text))
-                    except KeyError:
-                        logging.debug('knowledge goals for {} had no volume information'.format(
-                            g.find('name').text))
+                    know_elements.append(g)
+                    know_requests.append({'structure_name': p_r,
+                                          'goal_type': g.find('type').attrib['know'],
+                                          'isodose': g.find('dose').text,
+                                          'res_vol': vol})
 
                 # except AttributeError:
                 #    logging.debug('Goal loaded which does not have dose attribute.')
-                # Regardless, add the goal now
-                Goals.add_goal(g, connect.get_current('Plan'))
+                # Regardless, add the goal
+                plan_goals.append(g)
+
+        # Compute the knowledge-based goals of all targets at once and
+        # use the returned dictionaries to modify the ElementTree
+        know_goals = knowledge_based_goals(know_requests, case=case, exam=exam)
+        for g, know_goal in zip(know_elements, know_goals):
+            try:
+                g.find('index').text = str(know_goal['index'])
+                logging.debug('Index changed for ROI {} to {}'.format(
+                    g.find('name').text, g.find('index').text))
+            except KeyError:
+                logging.debug('knowledge goals for {} had no index information'.format(
+                    g.find('name').text))
+            try:
+                g.find('dose').text = str(know_goal['dose'])
+                logging.debug('Dose changed for ROI {} to {}'.format(
+                    g.find('name').text, g.find('dose').text))
+            except KeyError:
+                logging.debug('knowledge goals for {} had no dose information'.format(
+                    g.find('name').text))
+            try:
+                g.find('volume').text = str(know_goal['volume'])
+                g.find('volume').attrib['units'] = str(know_goal['units'])
+                logging.debug('Index changed for ROI {} to {}'.format(
+                    g.find('name').text, g.find('volume').text))
+            except KeyError:
+                logging.debug('knowledge goals for {} had no volume information'.format(
+                    g.find('name').text))
+
+        # Add all goals in one batch
+        Goals.add_goals(plan_goals, plan)
 
     status.next_step(text="Adding Objectives.", num=4)
     objective_elements = Objectives.select_objective_protocol(order_name=order_name,
@@ -573,53 +583,18 @@ def main():
     #  we'd map an xml-input to objectives using the mapping, save the mapping and
     #  output the xml-result using the inverse mapping
 
+    # Add the objectives of all sets in one batch, resolving plan rois and doses with the translation map
+    objectives = []
     for objsets in objective_elements:
-        objectives = objsets.findall('./objectives/roi')
-        for o in objectives:
-            o_n = o.find('name').text
-            o_t = o.find('type').text
-            o_d = o.find('dose').text
-            if o_n in translation_map:
-                s_roi = translation_map[o_n][0]
-            else:
-                s_roi = None
-
-            if "%" in o.find('dose').attrib['units']:
-                # Define the unmatched and unmodified protocol name and dose
-                o_r = o.find('dose').attrib['roi']
-                # See if the goal is on a matched target and change the % dose of the attributed ROI
-                # to match the user input target and dose level for that named structure
-                # Correct the relative dose to the user-specified dose levels for this structure
-                if o_r in translation_map:
-
-                    s_dose = float(translation_map[o_r][1])  # * float(o_d) / 100
-                    Objectives.add_objective(o,
-                                             exam=exam,
-                                             case=case,
-                                             plan=plan,
-                                             beamset=beamset,
-                                             s_roi=s_roi,
-                                             s_dose=s_dose,
-                                             s_weight=None,
-                                             restrict_beamset=None,
-                                             checking=True)
-                else:
-                    logging.debug('No match found protocol roi: {}, with a relative dose requiring protocol roi: {}'
-                                  .format(o_n, o_r))
-                    s_dose = 0
-                    pass
-            else:
-                s_dose = None
-                Objectives.add_objective(o,
-                                         exam=exam,
-                                         case=case,
-                                         plan=plan,
-                                         beamset=beamset,
-                                         s_roi=s_roi,
-                                         s_dose=s_dose,
-                                         s_weight=None,
-                                         restrict_beamset=None,
-                                         checking=True)
+        objectives += objsets.findall('./objectives/roi')
+    Objectives.add_objectives(objectives,
+                              exam=exam,
+                              case=case,
+                              plan=plan,
+                              beamset=beamset,
+                              translation_map=translation_map,
+                              restrict_beamset=None,
+                              checking=True)
 
 
 if __name__ == '__main__':
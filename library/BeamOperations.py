@@ -71,18 +71,28 @@ import UserInterface
 import StructureOperations
 import PlanOperations
 import GeneralOperations
-import Beams
 import datetime
+import os
+import io
+import csv
+import xml.etree.ElementTree
 
 clr.AddReference('System')
 
+# Local store of electron Monte Carlo calculation results used by EmcPlanner
+emc_store = os.path.join(os.path.expanduser('~'), 'RayScripts', 'emc_history.csv')
+
 
 class Beam(object):
+    __slots__ = ('number', 'technique', 'name', 'description', 'energy', 'gantry_start_angle',
+                 'gantry_stop_angle', 'rotation_dir', 'collimator_angle', 'iso', 'couch_angle', 'field_width',
+                 'pitch', 'jaw_mode', 'back_jaw_position', 'front_jaw_position', 'dsp')
 
     def __init__(self):
         self.number = None
         self.technique = None
         self.name = None
+        self.description = None
         self.energy = None
         self.gantry_start_angle = None
         self.gantry_stop_angle = None
@@ -126,6 +136,9 @@ class Beam(object):
 
 
 class BeamSet(object):
+    __slots__ = ('name', 'DicomName', 'iso', 'number_of_fractions', 'total_dose', 'machine', 'modality',
+                 'technique', 'rx_target', 'iso_target', 'protocol_name', 'origin_file', 'origin_folder',
+                 'description', 'plan_name', 'template_name', 'patient_position', 'beams')
 
     def __init__(self):
         self.name = None
@@ -141,6 +154,12 @@ class BeamSet(object):
         self.protocol_name = None
         self.origin_file = None
         self.origin_folder = None
+        # Template information, see BeamTemplateLibrary
+        self.description = None
+        self.plan_name = None
+        self.template_name = None
+        self.patient_position = None
+        self.beams = []
 
     def __eq__(self, other):
         return other and self.iso == other.iso and self.number_of_fractions \
@@ -172,6 +191,216 @@ class DSP(object):
         return hash(frozenset(self.coords.items()))
 
 
+class BeamTemplateLibrary(object):
+    """
+    Beamset templates loaded once from the protocol beamset xml files and the beam template csv files
+    into BeamSet records, each holding its list of Beam records. Templates are indexed by file, beamset
+    name, technique and patient position. A file is re-read only when its modification time changes.
+
+    Usage:
+        library = beam_template_library()
+        names = library.beamset_names(technique='VMAT')
+        beams = library.find('2 Arc VMAT - HN Shoulder').beams
+    """
+    protocol_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'protocols')
+    beamset_folder = os.path.join(protocol_folder, 'UW', 'beamsets')
+    # Column order of the beam template csv files, the first row of each file is a header
+    csv_fields = ['PlanName', 'BeamSetName', 'TemplateName', 'TreatmentTechnique', 'PatientPosition',
+                  'BeamName', 'BeamDescription', 'GantryStart', 'GantryStop', 'ArcDirection',
+                  'CollimatorAngle', 'CouchAngle']
+
+    def __init__(self):
+        # {file path: modification time when loaded}
+        self.mtimes = {}
+        # {file path: [BeamSet]}
+        self.files = {}
+        # {beamset name: BeamSet}, {technique: [BeamSet]}, {patient position: [BeamSet]}
+        self.beamsets = {}
+        self.techniques = {}
+        self.positions = {}
+
+    def default_files(self):
+        files = []
+        for folder, extension in [(self.beamset_folder, '.xml'), (self.protocol_folder, '_BeamTemplates.csv')]:
+            if os.path.isdir(folder):
+                files.extend(os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith(extension))
+        return files
+
+    def load(self, files=None):
+        """
+        Load (or refresh) template files
+        :param files: list of xml or csv file paths, the default protocol templates if not supplied
+        :return: self
+        """
+        if files is None:
+            files = self.default_files()
+        changed = False
+        for f in files:
+            f = os.path.normpath(os.path.abspath(f))
+            mtime = os.path.getmtime(f)
+            if self.mtimes.get(f) == mtime:
+                continue
+            if f.endswith('.csv'):
+                self.files[f] = self.read_csv(f)
+            else:
+                self.files[f] = self.read_xml(f)
+            self.mtimes[f] = mtime
+            changed = True
+            logging.debug('Beam templates loaded from {}'.format(f))
+        if changed:
+            self.index()
+        return self
+
+    def index(self):
+        self.beamsets = {}
+        self.techniques = {}
+        self.positions = {}
+        for f in sorted(self.files):
+            for bs in self.files[f]:
+                if bs.name in self.beamsets:
+                    logging.debug('Beamset template {} in {} duplicates an existing template name'.format(bs.name, f))
+                else:
+                    self.beamsets[bs.name] = bs
+                self.techniques.setdefault(bs.technique, []).append(bs)
+                self.positions.setdefault(bs.patient_position, []).append(bs)
+
+    @staticmethod
+    def text(element, tag, cast=str):
+        # Value of the child tag of element, None if the tag is missing or not convertible
+        child = element.find(tag)
+        if child is None or child.text is None:
+            return None
+        try:
+            return cast(child.text.strip())
+        except ValueError:
+            return None
+
+    def read_xml(self, path):
+        beamsets = []
+        tree = xml.etree.ElementTree.parse(path)
+        for template in tree.findall('./beam_template'):
+            template_name = self.text(template, 'name')
+            for bs_element in template.findall('./beamset'):
+                bs = BeamSet()
+                bs.name = self.text(bs_element, 'name')
+                bs.DicomName = self.text(bs_element, 'DicomName')
+                bs.technique = self.text(bs_element, 'technique')
+                bs.description = self.text(bs_element, 'description')
+                bs.template_name = template_name
+                bs.origin_file = os.path.basename(path)
+                bs.origin_folder = os.path.dirname(path)
+                for b in bs_element.findall('./beam'):
+                    beam = Beam()
+                    beam.number = self.text(b, 'BeamNumber', int)
+                    beam.name = self.text(b, 'Name')
+                    beam.technique = self.text(b, 'DeliveryTechnique')
+                    beam.energy = self.text(b, 'Energy', int)
+                    beam.gantry_start_angle = self.text(b, 'GantryAngle', float)
+                    beam.gantry_stop_angle = self.text(b, 'GantryStopAngle', float)
+                    beam.rotation_dir = self.text(b, 'ArcRotationDirection')
+                    beam.collimator_angle = self.text(b, 'CollimatorAngle', float)
+                    beam.couch_angle = self.text(b, 'CouchAngle', float)
+                    beam.field_width = self.text(b, 'FieldWidth', float)
+                    beam.pitch = self.text(b, 'Pitch', float)
+                    beam.jaw_mode = self.text(b, 'JawMode', float)
+                    beam.back_jaw_position = self.text(b, 'BackJawPosition', float)
+                    bs.beams.append(beam)
+                beamsets.append(bs)
+        return beamsets
+
+    def read_csv(self, path):
+        def number(value):
+            try:
+                return float(value)
+            except ValueError:
+                return None
+
+        beamsets = []
+        current = None
+        with io.open(path, 'r', encoding='utf-8-sig') as f:
+            rows = csv.reader(f, delimiter=',')
+            # Skip header
+            next(rows)
+            for line in rows:
+                if len(line) < len(self.csv_fields):
+                    continue
+                row = dict(zip(self.csv_fields, [str(l).strip() for l in line]))
+                if current is None or current.name != row['BeamSetName']:
+                    current = BeamSet()
+                    current.name = row['BeamSetName']
+                    current.DicomName = row['BeamSetName']
+                    current.plan_name = row['PlanName']
+                    current.template_name = row['TemplateName']
+                    current.technique = row['TreatmentTechnique']
+                    current.patient_position = row['PatientPosition']
+                    current.origin_file = os.path.basename(path)
+                    current.origin_folder = os.path.dirname(path)
+                    beamsets.append(current)
+                beam = Beam()
+                beam.number = len(current.beams) + 1
+                beam.name = row['BeamName']
+                beam.description = row['BeamDescription']
+                beam.technique = row['TreatmentTechnique']
+                beam.gantry_start_angle = number(row['GantryStart'])
+                beam.gantry_stop_angle = number(row['GantryStop'])
+                beam.rotation_dir = None if row['ArcDirection'] == 'NA' else row['ArcDirection']
+                beam.collimator_angle = number(row['CollimatorAngle'])
+                beam.couch_angle = number(row['CouchAngle'])
+                current.beams.append(beam)
+        return beamsets
+
+    def find(self, beamset_name, filename=None, path=None):
+        """
+        :param beamset_name: name of the beamset template
+        :param filename: optional file to search, loaded if it is not already part of the library
+        :param path: folder of filename
+        :return: BeamSet or None if not found
+        """
+        if filename is not None:
+            for bs in self.file_beamsets(filename, path):
+                if bs.name == beamset_name:
+                    return bs
+            return None
+        self.load()
+        return self.beamsets.get(beamset_name)
+
+    def file_beamsets(self, filename, path=None):
+        """
+        :param filename: template file name, or full path if path is None
+        :param path: folder of filename
+        :return: list of BeamSet loaded from the file
+        """
+        f = filename if path is None else os.path.join(path, filename)
+        f = os.path.normpath(os.path.abspath(f))
+        self.load(files=[f])
+        return self.files[f]
+
+    def beamset_names(self, filename=None, path=None, technique=None, patient_position=None):
+        """
+        Names of the beamset templates, optionally limited to a file, technique and patient position
+        """
+        if filename is not None:
+            beamsets = self.file_beamsets(filename, path)
+        else:
+            self.load()
+            beamsets = [bs for f in sorted(self.files) for bs in self.files[f]]
+        return [bs.name for bs in beamsets
+                if (technique is None or bs.technique == technique) and
+                (patient_position is None or bs.patient_position == patient_position)]
+
+
+_beam_template_library = BeamTemplateLibrary()
+
+
+def beam_template_library(files=None):
+    """
+    Return the shared beam template library, refreshing any template files that changed on disk
+    :param files: optional list of template files to load, the default protocol templates if not supplied
+    :return: BeamTemplateLibrary
+    """
+    return _beam_template_library.load(files=files)
+
+
 # Return a patient position in the expected format for beamset definition
 def patient_position_map(exam_position):
     if exam_position == 'HFP':
@@ -222,19 +451,11 @@ def beamset_dialog(case, filename=None, path=None, order_name=None):
     # machine_list = ['TrueBeam', 'TrueBeamSTx']
 
     # Open the user supplied filename located at folder and return a list of available beamsets
-    # Should be able to eliminate this if after the modifications to select_element are complete
     if filename is not None:
         dialog_beamset.origin_file = filename
         dialog_beamset.origin_folder = path
         logging.debug('looking in {} at {} for a {}'.format(filename, path, 'beamset'))
-        available_beamsets = Beams.select_element(
-            set_level='beamset',
-            set_type=None,
-            set_elements='beam',
-            filename=filename,
-            dialog=False,
-            folder=path,
-            verbose_logging=False)
+        available_beamsets = beam_template_library().beamset_names(filename=filename, path=path)
 
     targets = StructureOperations.find_targets(case=case)
 
@@ -387,14 +608,21 @@ def create_beamset(patient, case, exam, plan,
     return beamset
 
 
-def place_beams_in_beamset(iso, beamset, beams):
+def place_beams_in_beamset(iso, beamset, beams=None, template_name=None):
     """
     Put beams in place based on a list of Beam objects
     :param iso: isocenter data dictionary
     :param beamset: beamset to which to add beams
     :param beams: list of Beam objects
+    :param template_name: name of a beamset template in the beam template library, used if beams is None
     :return:
     """
+    if beams is None:
+        template = beam_template_library().find(template_name)
+        if template is None:
+            logging.warning('Beamset template {} was not found, no beams placed'.format(template_name))
+            return
+        beams = template.beams
     for b in beams:
         logging.info(('Loading Beam {}. Type {}, Name {}, Energy {}, StartAngle {}, StopAngle {}, ' +
                       'RotationDirection {}, CollimatorAngle {}, CouchAngle {} ').format(
@@ -533,18 +761,202 @@ def check_pa(plan, beam):
 
 
 
-# def check_clearance(beamset):
-#     """Currently looking only at PA fields for whether the pa function should be flipped
-#     return: dict: {Beam.Name: 'PA_Check': {'No_Collision':True, 'Change_Gantry': 180.1}}"""
-#     beam_status = {}
-#     for b in beamset.Beams:
-#         rec_gantry_angle = check_pa(beam=b)
-#         if rec_gantry_angle is not None:
-#             logging.debug('Beam {} potential gantry clearance issue. Recommend changing gantry angle from {} to {}'
-#                           .format(b.Name, b.GantryAngle, rec_gantry_angle))
-#             if b.Name not in beam_status:
-#                 beam_status[b.Name] = {'PA_Check':}
-#             beam_status[b.Name] = ['PA_Clear']
+def roi_vertices(case, exam, roi_name):
+    """
+    Vertex cloud of an roi geometry
+    :param case: RS case
+    :param exam: RS exam
+    :param roi_name: name of the roi
+    :return: numpy array [n_vertices x 3] of DICOM patient coordinates, empty if the geometry has no shape
+    """
+    try:
+        shape = case.PatientModel.StructureSets[exam.Name].RoiGeometries[roi_name].PrimaryShape
+    except Exception:
+        logging.debug('Roi {} has no geometry on {}'.format(roi_name, exam.Name))
+        return np.empty((0, 3))
+    try:
+        # Triangle mesh geometries
+        vertices = [[v.x, v.y, v.z] for v in shape.Vertices]
+    except AttributeError:
+        # Contour geometries
+        vertices = [[p.x, p.y, p.z] for c in shape.Contours for p in c]
+    return np.array(vertices, dtype=float).reshape(-1, 3)
+
+
+def gantry_angle_samples(beam, spacing=2.):
+    """
+    Gantry angles of a beam: the static gantry angle or the arc sampled every spacing degrees
+    :param beam: RS beam
+    :param spacing: arc gantry sample spacing in degrees
+    :return: numpy array of gantry angles
+    """
+    start = float(beam.GantryAngle)
+    try:
+        stop = beam.ArcStopGantryAngle
+        direction = beam.ArcRotationDirection
+    except AttributeError:
+        stop = None
+        direction = None
+    if stop is None or direction not in ['Clockwise', 'CounterClockwise']:
+        return np.array([start])
+    if direction == 'Clockwise':
+        span = (float(stop) - start) % 360.
+        sign = 1.
+    else:
+        span = (start - float(stop)) % 360.
+        sign = -1.
+    offsets = np.append(np.arange(0., span, spacing), span)
+    return (start + sign * offsets) % 360.
+
+
+def gantry_clearance(points, gantry_angles, head_distance, head_radius, max_distance=20.):
+    """
+    Minimum distance from a cloud of points to the treatment head at each gantry angle.
+    The head is modeled as a cylinder of radius head_radius coaxial with the beam, with its face
+    head_distance from isocenter. Points and head are in IEC fixed coordinates relative to isocenter
+    (x: lateral, y: toward the gantry, z: up).
+    :param points: numpy array [n x 3] of IEC fixed coordinates in cm
+    :param gantry_angles: numpy array of gantry angles in degrees
+    :param head_distance: distance from isocenter to the head face in cm
+    :param head_radius: radius of the head in cm
+    :param max_distance: distances larger than this are not resolved (reported as max_distance)
+    :return: numpy array of the minimum head to point distance at each gantry angle, 0 is a collision
+    """
+    theta = np.radians(np.asarray(gantry_angles, dtype=float))
+    clearance = np.full(theta.shape, float(max_distance))
+    # Only points at least head_distance - max_distance from isocenter can approach the head face
+    points = points[np.linalg.norm(points, axis=1) >= head_distance - max_distance]
+    if points.shape[0] == 0:
+        return clearance
+    sin_t = np.sin(theta)[np.newaxis, :]
+    cos_t = np.cos(theta)[np.newaxis, :]
+    # Limit the size of the [points x angles] arrays
+    chunk = max(1, 2000000 // max(1, theta.size))
+    for i in range(0, points.shape[0], chunk):
+        x = points[i:i + chunk, 0:1]
+        y = points[i:i + chunk, 1:2]
+        z = points[i:i + chunk, 2:3]
+        # Distance along the beam axis toward the source, and radial distance from the axis
+        axial = x * sin_t + z * cos_t
+        radial = np.sqrt(y ** 2 + (x * cos_t - z * sin_t) ** 2)
+        distance = np.sqrt(np.maximum(radial - head_radius, 0.) ** 2 +
+                           np.maximum(head_distance - axial, 0.) ** 2)
+        clearance = np.minimum(clearance, np.amin(distance, axis=0))
+    return clearance
+
+
+# Transformation from DICOM patient coordinates to IEC table coordinates (x: lateral, y: toward the
+# gantry, z: up) for each patient position
+patient_to_table = {
+    'HeadFirstSupine': np.array([[1., 0., 0.], [0., 0., 1.], [0., -1., 0.]]),
+    'HeadFirstProne': np.array([[-1., 0., 0.], [0., 0., 1.], [0., 1., 0.]]),
+    'FeetFirstSupine': np.array([[-1., 0., 0.], [0., 0., -1.], [0., -1., 0.]]),
+    'FeetFirstProne': np.array([[1., 0., 0.], [0., 0., -1.], [0., 1., 0.]])}
+
+# Clearance models in cm: the head face distance from isocenter and head radius (with accessories),
+# and the couch top used when no support structures are contoured
+clearance_models = {
+    'default': {'HeadDistance': 41.5, 'HeadRadius': 38., 'CouchWidth': 53., 'CouchThickness': 5.,
+                'CouchSampling': 2.}}
+
+
+def couch_model_points(table_points, model):
+    """
+    Sample the couch top as a slab directly below the patient points in IEC table coordinates. The couch is
+    centered on the lateral midline of the patient, not on the isocenter, which may be lateral.
+    :param table_points: numpy array [n x 3] of patient points in IEC table coordinates
+    :param model: clearance model
+    :return: numpy array [m x 3] of couch points in IEC table coordinates
+    """
+    step = model['CouchSampling']
+    midline = (np.amin(table_points[:, 0]) + np.amax(table_points[:, 0])) / 2.
+    x = midline + np.arange(-model['CouchWidth'] / 2., model['CouchWidth'] / 2. + step, step)
+    y = np.arange(np.amin(table_points[:, 1]), np.amax(table_points[:, 1]) + step, step)
+    top = np.amin(table_points[:, 2])
+    z = np.array([top, top - model['CouchThickness']])
+    grid = np.meshgrid(x, y, z, indexing='ij')
+    return np.column_stack([g.ravel() for g in grid])
+
+
+def colliding_ranges(gantry_angles, collision):
+    """
+    Group consecutive colliding gantry samples into ranges
+    :param gantry_angles: numpy array of gantry angles in delivery order
+    :param collision: boolean numpy array
+    :return: list of [start, stop] gantry angles
+    """
+    ranges = []
+    edges = np.diff(np.concatenate([[0], collision.astype(int), [0]]))
+    for start, stop in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1):
+        ranges.append([float(gantry_angles[start]), float(gantry_angles[stop])])
+    return ranges
+
+
+def check_clearance(case, exam, beamset, external=None, supports=None, model=None, margin=2.,
+                    gantry_spacing=2.):
+    """
+    Check the treatment head clearance of the patient and couch for every beam (and arc gantry samples)
+    in the beamset. The External vertex cloud, and the support structures or a couch model, are
+    transformed once to IEC table coordinates, then rotated by each couch angle and compared to a
+    cylindrical head model at every gantry angle.
+    :param case: RS case
+    :param exam: RS exam
+    :param beamset: RS beamset
+    :param external: name of the external roi, the External type roi if not supplied
+    :param supports: list of support roi names, the Support type rois if not supplied, a couch model
+        centered on the patient midline is used if there are none
+    :param model: clearance model dictionary, clearance_models['default'] if not supplied
+    :param margin: clearance in cm below which a gantry angle is reported as colliding
+    :param gantry_spacing: arc gantry sample spacing in degrees
+    :return: {beam name: {'GantryAngles': array, 'Clearance': array, 'Collisions': [[start, stop],..]}},
+        None if the check is not possible
+    """
+    if model is None:
+        model = clearance_models['default']
+    if beamset.PatientPosition not in patient_to_table:
+        logging.warning('Clearance check is not supported for patient position {}'.format(
+            beamset.PatientPosition))
+        return None
+    if external is None:
+        externals = StructureOperations.find_types(case, 'External')
+        if not externals:
+            logging.warning('No External type structure, clearance check not possible')
+            return None
+        external = externals[0]
+    if supports is None:
+        supports = StructureOperations.find_types(case, 'Support')
+
+    patient_points = roi_vertices(case, exam, external)
+    if patient_points.shape[0] == 0:
+        logging.warning('External {} has no geometry, clearance check not possible'.format(external))
+        return None
+    support_points = [roi_vertices(case, exam, s) for s in supports]
+    support_points = np.concatenate(support_points) if support_points else np.empty((0, 3))
+    rotation = patient_to_table[beamset.PatientPosition]
+
+    results = {}
+    for b in beamset.Beams:
+        iso = b.Isocenter.Position
+        iso = np.array([iso.x, iso.y, iso.z])
+        table_points = np.dot(patient_points - iso, rotation.T)
+        if support_points.shape[0] > 0:
+            table_points = np.concatenate([table_points, np.dot(support_points - iso, rotation.T)])
+        else:
+            table_points = np.concatenate([table_points, couch_model_points(table_points, model)])
+        # The couch rotates the table points about the vertical axis
+        phi = np.radians(float(b.CouchAngle))
+        couch_rotation = np.array([[np.cos(phi), -np.sin(phi), 0.], [np.sin(phi), np.cos(phi), 0.], [0., 0., 1.]])
+        fixed_points = np.dot(table_points, couch_rotation.T)
+        gantry_angles = gantry_angle_samples(b, spacing=gantry_spacing)
+        clearance = gantry_clearance(fixed_points, gantry_angles, model['HeadDistance'], model['HeadRadius'])
+        collisions = colliding_ranges(gantry_angles, clearance < margin)
+        results[b.Name] = {'GantryAngles': gantry_angles, 'Clearance': clearance, 'Collisions': collisions}
+        if collisions:
+            logging.warning('Beam {}: clearance less than {} cm at gantry angles {}'.format(
+                b.Name, margin, collisions))
+        else:
+            logging.debug('Beam {}: minimum clearance {:.1f} cm'.format(b.Name, np.amin(clearance)))
+    return results
 
 
 def validate_setup_fields(beamset):
@@ -1240,6 +1652,123 @@ def rename_beams():
         raise IOError("Patient Orientation Unsupported.. Manual Beam Naming Required")
 
 
+class BeamSnapshot(object):
+    """
+    Per-segment data of a beam read from RayStation in a single pass over beam.Segments.
+    Use beam_snapshot(beam) to get a cached snapshot rather than constructing one directly.
+
+    name: beam name
+    key: the beam state the snapshot was taken in, see snapshot_key
+    has_segments: False for beams (e.g. electrons) without segments
+    number_segments: number of segments
+    jaws: numpy array [segments x 4] of jaw positions [X1, X2, Y1, Y2]
+    banks: numpy array [leaves x 2 x segments] of leaf positions (X1 bank, X2 bank)
+    delta_gantry: numpy array of the DeltaGantryAngle of each segment (zeros for static beams)
+    weights: numpy array of the RelativeWeight of each segment
+    """
+    __slots__ = ('name', 'key', 'has_segments', 'number_segments', 'jaws', 'banks', 'delta_gantry', 'weights')
+
+    def __init__(self, beam, key=None):
+        self.name = beam.Name
+        self.key = snapshot_key(beam) if key is None else key
+        jaws = []
+        banks = []
+        delta_gantry = []
+        weights = []
+        try:
+            segments = beam.Segments
+            for s in segments:
+                jp = s.JawPositions
+                jaws.append([jp[0], jp[1], jp[2], jp[3]])
+                lp = s.LeafPositions
+                banks.append(np.column_stack((lp[0], lp[1])))
+                # Static beam segments have no gantry increment
+                delta_gantry.append(getattr(s, 'DeltaGantryAngle', 0.))
+                weights.append(getattr(s, 'RelativeWeight', np.nan))
+        except Exception:
+            logging.debug('Beam {} does not have segments'.format(beam.Name))
+        self.number_segments = len(jaws)
+        self.has_segments = self.number_segments > 0
+        self.jaws = np.array(jaws, dtype=float).reshape(-1, 4)
+        self.banks = np.dstack(banks) if banks else np.empty((0, 2, 0))
+        self.delta_gantry = np.array(delta_gantry, dtype=float)
+        self.weights = np.array(weights, dtype=float)
+
+
+# Cache of BeamSnapshot by snapshot_scope
+_beam_snapshots = {}
+
+
+def snapshot_scope(beam):
+    """
+    Cache slot of a beam: the patient ID, beam name and beam number. Beams of different plans or beamsets of
+    a patient may share a slot, they are told apart by the beam geometry in snapshot_key.
+    :param beam: RS beam
+    :return: tuple
+    """
+    try:
+        patient_id = connect.get_current('Patient').PatientID
+    except Exception:
+        patient_id = None
+    return patient_id, beam.Name, getattr(beam, 'Number', None)
+
+
+def snapshot_key(beam):
+    """
+    State of the beam used to decide if a cached snapshot is current: the beam name, machine, isocenter and
+    angles, MU, number of segments, the segment weights and the modification time, where RayStation reports one.
+    Only scalars are read, so checking a cached snapshot costs far less than taking one. Jaw and leaf positions
+    are not part of the key: scripts that edit segments call invalidate_beam_snapshot.
+    :param beam: RS beam
+    :return: tuple
+    """
+    try:
+        iso = beam.Isocenter.Position
+        iso = (iso.x, iso.y, iso.z)
+    except AttributeError:
+        iso = None
+    geometry = (beam.MachineReference.MachineName, iso) + tuple(
+        getattr(beam, a, None) for a in ['GantryAngle', 'ArcStopGantryAngle', 'InitialCollimatorAngle', 'CouchAngle'])
+    try:
+        weights = tuple(getattr(s, 'RelativeWeight', None) for s in beam.Segments)
+    except Exception:
+        weights = ()
+    try:
+        modified = str(beam.ModificationInfo.ModificationTime)
+    except AttributeError:
+        modified = None
+    return beam.Name, geometry, beam.BeamMU, len(weights), weights, modified
+
+
+def beam_snapshot(beam):
+    """
+    Return the snapshot of a beam, reading the segments again only if the beam has changed
+    :param beam: RS beam
+    :return: BeamSnapshot
+    """
+    key = snapshot_key(beam)
+    scope = snapshot_scope(beam)
+    snapshot = _beam_snapshots.get(scope)
+    if snapshot is None or snapshot.key != key:
+        snapshot = BeamSnapshot(beam, key=key)
+        _beam_snapshots[scope] = snapshot
+    return snapshot
+
+
+def invalidate_beam_snapshot(beam):
+    """
+    Drop the cached snapshot of a beam after its segments are edited
+    :param beam: RS beam
+    """
+    _beam_snapshots.pop(snapshot_scope(beam), None)
+
+
+# Checks reported by mlc_properties.violation_table, one row per leaf (or jaw) and control point
+violation_checks = ['Carriage', 'MinGap', 'LeafJawOverlap', 'YBoundary']
+violation_dtype = np.dtype([('segment', int), ('leaf', int), ('bank', int), ('check', 'U16'),
+                            ('position', float), ('limit', float)])
+
+
 class mlc_properties:
     """
     Class of mlc_properties:
@@ -1251,28 +1780,30 @@ class mlc_properties:
     num_leaves_per_bank: the number of MLC leaves in a bank
 
     banks: a numpy array of MLC segment positions
+    y_jaw_limits: [Y1 overtravel, Y1 MLC boundary, Y2 overtravel, Y2 MLC boundary] (see check_y_jaw_positions)
 
     """
 
-    # Initialize with a RS beam object
-    def __init__(self, beam):
+    # Initialize with a RS beam object, optionally supplying an already loaded machine to avoid
+    # a second trip to the machine database
+    def __init__(self, beam, machine=None):
         self.beam = beam  # A Raystation beam object that has segments
-        try:
-            s0 = self.beam.Segments[0]
-            self.has_segments = True
-        except:
-            self.has_segments = False
+        snapshot = beam_snapshot(beam)
+        self.has_segments = snapshot.has_segments
 
         if self.has_segments:
-            current_machine_name = self.beam.MachineReference.MachineName
-            current_machine = GeneralOperations.get_machine(current_machine_name)
+            if machine is None:
+                current_machine_name = self.beam.MachineReference.MachineName
+                current_machine = GeneralOperations.get_machine(current_machine_name)
+            else:
+                current_machine = machine
             # Maximum motion of a leaf on its own side of the origin
             self.max_tip = current_machine.Physics.MlcPhysics.MaxTipPosition
             # Maximum leaf out of carriage distance [cm]
             self.max_leaf_carriage = current_machine.Physics.MlcPhysics.MaxLeafOutOfCarriageDistance
 
             # Compute the number of leaves in the bank based on the first segment
-            self.num_leaves_per_bank = int(s0.LeafPositions[0].shape[0])
+            self.num_leaves_per_bank = int(snapshot.banks.shape[0])
 
             # Grab the leaf centers and widths
             self.leaf_centers = current_machine.Physics.MlcPhysics.UpperLayer.LeafCenterPositions
@@ -1281,38 +1812,25 @@ class mlc_properties:
             self.leaf_jaw_overlap = current_machine.Physics.MlcPhysics.LeafJawOverlap
             # Grab the minimum gap allowed for a dynamic leaf
             self.min_gap_moving = current_machine.Physics.MlcPhysics.MinGapMoving
+            # Jaw overtravel and the MLC-delineated boundary: Leaf Center + 0.2 Leaf_Width
+            min_y2_jaw_limit = current_machine.Physics.JawPhysics.MinBottomJawPos
+            self.y_jaw_limits = [- min_y2_jaw_limit,
+                                 self.leaf_centers[0] - 0.2 * self.leaf_widths[0],
+                                 min_y2_jaw_limit,
+                                 self.leaf_centers[self.num_leaves_per_bank - 1] +
+                                 0.2 * self.leaf_widths[self.num_leaves_per_bank - 1]]
             #
-            # Set up a numpy array that will be a combine segments
-            # into a single ndarray of size:
+            # Combine segments from the beam snapshot into a single ndarray of size:
             # MLC leaf number x number of banks x number of segments
-            self.banks = np.column_stack((s0.LeafPositions[0], s0.LeafPositions[1]))
-            self.number_segments = len(beam.Segments)
+            # (a copy, since filter_leaves edits the banks in place)
+            self.number_segments = snapshot.number_segments
             if self.number_segments > 1:
-                for cp in range(1, self.number_segments):
-                    # for s in beam.Segments:
-                    s = beam.Segments[cp]
-                    # Take the bank positions on X1-bank, and X2 Bank and put them in column 0, 1 respectively
-                    bank = np.column_stack((s.LeafPositions[0], s.LeafPositions[1]))
-                    self.banks = np.dstack((self.banks, bank))
-                # Determine if leaves are in retracted position
-                if np.all(self.banks[:, 0, :] <= - self.max_tip):
-                    x1_bank_retracted = True
-                else:
-                    x1_bank_retracted = False
-                if np.all(self.banks[:, 1, :] >= self.max_tip):
-                    x2_bank_retracted = True
-                else:
-                    x2_bank_retracted = False
+                self.banks = np.copy(snapshot.banks)
             else:
-                # Determine if leaves are in retracted position
-                if np.all(self.banks[:, 0] <= - self.max_tip):
-                    x1_bank_retracted = True
-                else:
-                    x1_bank_retracted = False
-                if np.all(self.banks[:, 1] >= self.max_tip):
-                    x2_bank_retracted = True
-                else:
-                    x2_bank_retracted = False
+                self.banks = np.copy(snapshot.banks[:, :, 0])
+            # Determine if leaves are in retracted position
+            x1_bank_retracted = np.all(self.banks[:, 0, ...] <= - self.max_tip)
+            x2_bank_retracted = np.all(self.banks[:, 1, ...] >= self.max_tip)
 
             if x1_bank_retracted and x2_bank_retracted:
                 self.mlc_retracted = True
@@ -1450,6 +1968,337 @@ class mlc_properties:
         else:
             return None
 
+    def violation_table(self, jaws=None):
+        """
+        Check every leaf at every control point against the machine constraints in one array operation:
+            Carriage: a leaf extends into the field the maximum leaf out of carriage distance or further from its
+                jaw, or the most extended leaf of a bank is that far behind its jaw (the distance is absolute)
+            MinGap: a dynamic leaf pair is closer than the minimum moving leaf gap
+            LeafJawOverlap: a closed leaf pair between the y jaws is not hidden the leaf jaw overlap behind
+                an x jaw
+            YBoundary: a y jaw is past the jaw overtravel or the MLC-delineated boundary (leaf = -1)
+        :param jaws: proposed [X1, X2, Y1, Y2] applied to every segment, or an array [segments x 4].
+            The current segment jaws are used if not supplied.
+        :return: numpy structured array (violation_dtype) with one row per violation, sorted by segment.
+            bank is 0 (X1/Y1), 1 (X2/Y2) or -1 for a leaf pair.
+        """
+        threshold = 1e-6
+        if not self.has_segments:
+            return np.zeros(0, dtype=violation_dtype)
+        banks = self.banks if self.banks.ndim == 3 else self.banks[:, :, np.newaxis]
+        if jaws is None:
+            jaws = beam_snapshot(self.beam).jaws
+        jaws = np.broadcast_to(np.asarray(jaws, dtype=float), (banks.shape[2], 4))
+        x1 = banks[:, 0, :]
+        x2 = banks[:, 1, :]
+        centers = np.asarray(self.leaf_centers, dtype=float)[:, np.newaxis]
+        gap = x2 - x1
+        # Leaf pairs at (0, 0) are not dynamic
+        dynamic = ~((x1 == 0) & (x2 == 0))
+        closed = dynamic & (gap < (1 + threshold) * self.min_gap_moving)
+        in_field = (centers > jaws[:, 2]) & (centers < jaws[:, 3])
+        x1_hidden = jaws[:, 0] - self.leaf_jaw_overlap
+        x2_hidden = jaws[:, 1] + self.leaf_jaw_overlap
+        # Each check: name, bank, violation mask [leaves x segments], position and limit
+        checks = [('MinGap', -1, dynamic & (gap < (1 - threshold) * self.min_gap_moving),
+                   gap, np.broadcast_to(self.min_gap_moving, gap.shape)),
+                  ('LeafJawOverlap', -1, closed & in_field & (x2 > x1_hidden) & (x1 < x2_hidden),
+                   (x1 + x2) / 2., np.where(np.abs(x1 - x1_hidden) <= np.abs(x2 - x2_hidden), x1_hidden, x2_hidden))]
+        # A retracted MLC can not violate the carriage
+        if not self.mlc_retracted:
+            x1_limit = np.broadcast_to(jaws[:, 0] + self.max_leaf_carriage, x1.shape)
+            x2_limit = np.broadcast_to(jaws[:, 1] - self.max_leaf_carriage, x2.shape)
+            # The most extended leaf of each bank must also be within the carriage distance behind the jaw
+            x1_most = (np.arange(x1.shape[0])[:, np.newaxis] == np.argmax(x1, axis=0)) & \
+                      (x1 <= jaws[:, 0] - self.max_leaf_carriage)
+            x2_most = (np.arange(x2.shape[0])[:, np.newaxis] == np.argmin(x2, axis=0)) & \
+                      (x2 > jaws[:, 1] + self.max_leaf_carriage)
+            checks = [('Carriage', 0, x1 >= x1_limit, x1, x1_limit),
+                      ('Carriage', 0, x1_most, x1, np.broadcast_to(jaws[:, 0] - self.max_leaf_carriage, x1.shape)),
+                      ('Carriage', 1, x2 < x2_limit, x2, x2_limit),
+                      ('Carriage', 1, x2_most, x2, np.broadcast_to(jaws[:, 1] + self.max_leaf_carriage, x2.shape))] \
+                + checks
+        rows = []
+        for name, bank, mask, position, limit in checks:
+            leaf, segment = np.nonzero(mask)
+            rows.append((segment, leaf, np.full(len(leaf), bank), [name] * len(leaf),
+                         position[leaf, segment], limit[leaf, segment]))
+        # Y jaws checked per segment
+        y_checks = [(0, (jaws[:, 2] > self.y_jaw_limits[0]), self.y_jaw_limits[0]),
+                    (0, (jaws[:, 2] < self.y_jaw_limits[1]), self.y_jaw_limits[1]),
+                    (1, (jaws[:, 3] < self.y_jaw_limits[2]), self.y_jaw_limits[2]),
+                    (1, (jaws[:, 3] > self.y_jaw_limits[3]), self.y_jaw_limits[3])]
+        for bank, mask, limit in y_checks:
+            segment = np.flatnonzero(mask)
+            rows.append((segment, np.full(len(segment), -1), np.full(len(segment), bank),
+                         ['YBoundary'] * len(segment), jaws[segment, 2 + bank], np.full(len(segment), limit)))
+        table = np.zeros(sum(len(r[0]) for r in rows), dtype=violation_dtype)
+        for field, k in zip(violation_dtype.names, range(6)):
+            table[field] = np.concatenate([np.asarray(r[k], dtype=violation_dtype[field]) for r in rows])
+        return table[np.argsort(table['segment'], kind='mergesort')]
+
+    def constrain_jaws(self, jaws, min_aperture=None):
+        """
+        Move proposed jaw positions the least distance (to the nearest mm) needed to clear the carriage and
+        y-jaw violations found in violation_table. When a minimum aperture is given, an aperture the constraint
+        closed below it is opened again about its center, within the y-jaw limits; the minimum aperture takes
+        precedence over the carriage.
+        :param jaws: proposed [X1, X2, Y1, Y2], applied to every segment
+        :param min_aperture: minimum x and y aperture [cm] of the returned jaws
+        :return: [X1, X2, Y1, Y2]
+        """
+        jaws = [float(j) for j in jaws]
+        table = self.violation_table(jaws)
+        carriage = table[table['check'] == 'Carriage']
+        x1 = carriage['position'][carriage['bank'] == 0]
+        x2 = carriage['position'][carriage['bank'] == 1]
+        # Leaves in front of the jaw close the jaw, a leaf too far behind the jaw opens it
+        if np.any(x1 > jaws[0]):
+            jaws[0] = math.floor(10 * (np.amax(x1) - self.max_leaf_carriage)) / 10 + 0.1
+        elif len(x1) > 0:
+            jaws[0] = math.ceil(10 * (np.amin(x1) + self.max_leaf_carriage)) / 10 - 0.1
+        if np.any(x2 < jaws[1]):
+            jaws[1] = math.floor(10 * (np.amin(x2) + self.max_leaf_carriage)) / 10
+        elif len(x2) > 0:
+            jaws[1] = math.ceil(10 * (np.amax(x2) - self.max_leaf_carriage)) / 10
+        jaws[2] = float(min(max(jaws[2], self.y_jaw_limits[1]), self.y_jaw_limits[0]))
+        jaws[3] = float(max(min(jaws[3], self.y_jaw_limits[3]), self.y_jaw_limits[2]))
+        if min_aperture is not None:
+            for lo, hi in [(0, 1), (2, 3)]:
+                gap = min_aperture - (jaws[hi] - jaws[lo])
+                if gap > 0:
+                    jaws[lo] = math.floor(10 * (jaws[lo] - gap / 2.)) / 10
+                    jaws[hi] = math.ceil(10 * (jaws[hi] + gap / 2.)) / 10
+            # Keep the opened y aperture within the y-jaw limits
+            if jaws[2] < self.y_jaw_limits[1]:
+                jaws[3] = float(min(jaws[3] + self.y_jaw_limits[1] - jaws[2], self.y_jaw_limits[3]))
+                jaws[2] = float(self.y_jaw_limits[1])
+            if jaws[3] > self.y_jaw_limits[3]:
+                jaws[2] = float(max(jaws[2] - jaws[3] + self.y_jaw_limits[3], self.y_jaw_limits[1]))
+                jaws[3] = float(self.y_jaw_limits[3])
+        return jaws
+
+
+def violation_counts(table, number_segments):
+    """
+    Count the violations of each check at each control point
+    :param table: violation table from mlc_properties.violation_table
+    :param number_segments: number of segments in the beam
+    :return: {check: numpy array of the number of violations at each segment}
+    """
+    return {c: np.bincount(table['segment'][table['check'] == c], minlength=number_segments)
+            for c in violation_checks}
+
+
+# Delivery parameters used when the machine physics do not supply them:
+# MaxLeafSpeed [cm/s], GantrySpeed [deg/s], DoseRate [MU/min]
+delivery_models = {
+    'default': {'MaxLeafSpeed': 2.5, 'GantrySpeed': 6., 'DoseRate': 600.}}
+
+
+def delivery_parameters(machine, model=None):
+    """
+    Maximum leaf speed, gantry speed and dose rate of a machine, taken from the machine physics where
+    available, and otherwise from the delivery model
+    :param machine: RS machine
+    :param model: delivery model dictionary, delivery_models['default'] if not supplied
+    :return: {'MaxLeafSpeed': cm/s, 'GantrySpeed': deg/s, 'DoseRate': MU/min}
+    """
+    parameters = dict(delivery_models['default'] if model is None else model)
+    physics = machine.Physics
+    for key, source, attribute in [('MaxLeafSpeed', 'MlcPhysics', 'MaxLeafSpeed'),
+                                   ('GantrySpeed', 'GantryPhysics', 'MaxGantryAngleSpeed')]:
+        try:
+            parameters[key] = float(getattr(getattr(physics, source), attribute))
+        except (AttributeError, TypeError, ValueError):
+            logging.debug('Machine {} has no {}.{}, using {} = {}'.format(
+                machine.Name, source, attribute, key, parameters[key]))
+    return parameters
+
+
+def segment_complexity(banks, jaws, leaf_centers, leaf_widths, min_gap):
+    """
+    Aperture metrics of each segment, vectorized across all segments (of one or many beams)
+    :param banks: numpy array [leaves x 2 x segments] of leaf positions
+    :param jaws: numpy array [segments x 4] of jaw positions [X1, X2, Y1, Y2]
+    :param leaf_centers: leaf center positions
+    :param leaf_widths: leaf widths
+    :param min_gap: leaf gaps at or below this are treated as closed
+    :return: dictionary of numpy arrays over segments: Area [cm^2], Perimeter [cm], LSV (leaf sequence
+        variability), and the open leaf pairs 'Open' [leaves x segments]
+    """
+    threshold = 1e-6
+    x1 = banks[:, 0, :]
+    x2 = banks[:, 1, :]
+    centers = np.asarray(leaf_centers, dtype=float)[:, np.newaxis]
+    widths = np.asarray(leaf_widths, dtype=float)[:, np.newaxis]
+    # Leaf opening within the x jaws and leaf width within the y jaws
+    low = np.minimum(np.maximum(x1, jaws[:, 0]), jaws[:, 1])
+    high = np.minimum(np.maximum(x2, jaws[:, 0]), jaws[:, 1])
+    width = np.clip(np.minimum(centers + widths / 2., jaws[:, 3]) -
+                    np.maximum(centers - widths / 2., jaws[:, 2]), 0., None)
+    opening = np.where(x2 - x1 > (1 + threshold) * min_gap, np.clip(high - low, 0., None), 0.)
+    is_open = (opening > 0.) & (width > 0.)
+    opening = np.where(is_open, opening, 0.)
+    area = np.sum(opening * width, axis=0)
+
+    # Perimeter: leaf ends of each open leaf pair, and the unshared leaf side lengths between neighbours
+    pad = np.zeros((1, opening.shape[1]))
+    p_open = np.concatenate([pad, opening, pad])
+    p_low = np.concatenate([pad, np.where(is_open, low, 0.), pad])
+    p_high = np.concatenate([pad, np.where(is_open, high, 0.), pad])
+    shared = np.clip(np.minimum(p_high[:-1], p_high[1:]) - np.maximum(p_low[:-1], p_low[1:]), 0., None)
+    shared = np.where((p_open[:-1] > 0.) & (p_open[1:] > 0.), shared, 0.)
+    perimeter = np.sum(p_open[:-1] + p_open[1:] - 2. * shared, axis=0) + 2. * np.sum(np.where(is_open, width, 0.),
+                                                                                     axis=0)
+
+    # Leaf sequence variability (McNiven et al. 2010) of each bank, for adjacent open leaf pairs
+    pairs = is_open[:-1] & is_open[1:]
+    n_pairs = np.sum(pairs, axis=0)
+    lsv = np.ones(opening.shape[1])
+    for bank in [x1, x2]:
+        masked = np.where(is_open, bank, np.nan)
+        with np.errstate(invalid='ignore'):
+            pos_max = np.nanmax(masked, axis=0) - np.nanmin(masked, axis=0)
+        step = np.where(pairs, pos_max - np.abs(np.diff(bank, axis=0)), 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bank_lsv = np.sum(step, axis=0) / (n_pairs * pos_max)
+        lsv *= np.where((n_pairs > 0) & (pos_max > 0), bank_lsv, 1.)
+    return {'Area': area, 'Perimeter': perimeter, 'LSV': lsv, 'Open': is_open, 'Opening': opening}
+
+
+def beam_complexity(beams, machine=None, model=None, dose_per_fraction=None):
+    """
+    Delivery complexity and estimated beam-on time of a list of beams on the same machine. The segments
+    of all beams are concatenated so every metric is computed in one vectorized pass.
+    :param beams: list of RS beams
+    :param machine: RS machine of the beams, loaded from the first beam if not supplied
+    :param model: delivery model dictionary, see delivery_parameters
+    :param dose_per_fraction: prescription dose per fraction in cGy, used for MU per Gy
+    :return: {beam name: {'MU', 'Segments', 'LeafTravel' [cm], 'MeanLeafTravel' [cm], 'MeanArea' [cm^2],
+        'MeanPerimeter' [cm], 'MCS', 'MUperGy', 'BeamOnTime' [s]}}
+    """
+    results = {}
+    if not beams:
+        return results
+    if machine is None:
+        machine = GeneralOperations.get_machine(machine_name=beams[0].MachineReference.MachineName)
+    parameters = delivery_parameters(machine, model=model)
+    dose_rate = parameters['DoseRate'] / 60.
+
+    snapshots = [beam_snapshot(b) for b in beams]
+    mu = np.array([b.BeamMU for b in beams], dtype=float)
+    segmented = [i for i, s in enumerate(snapshots) if s.has_segments]
+    for i in range(len(beams)):
+        beam_mu = float(mu[i])
+        results[beams[i].Name] = {'MU': beam_mu, 'Segments': snapshots[i].number_segments,
+                                  'LeafTravel': 0., 'MeanLeafTravel': 0., 'MeanArea': None, 'MeanPerimeter': None,
+                                  'MCS': None, 'BeamOnTime': beam_mu / dose_rate,
+                                  'MUperGy': None if not dose_per_fraction else 100. * beam_mu / dose_per_fraction}
+    if not segmented:
+        return results
+
+    mlc_physics = machine.Physics.MlcPhysics
+    banks = np.concatenate([snapshots[i].banks for i in segmented], axis=2)
+    jaws = np.concatenate([snapshots[i].jaws for i in segmented])
+    counts = np.array([snapshots[i].number_segments for i in segmented])
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    metrics = segment_complexity(banks, jaws, mlc_physics.UpperLayer.LeafCenterPositions,
+                                 mlc_physics.UpperLayer.LeafWidths, mlc_physics.MinGapMoving)
+
+    # Segment MU from the relative weights of each beam
+    weights = np.concatenate([snapshots[i].weights for i in segmented])
+    weights = np.where(np.isnan(weights), 1., weights)
+    beam_index = np.repeat(np.arange(len(segmented)), counts)
+    weight_sums = np.add.reduceat(weights, starts)
+    segment_mu = weights / weight_sums[beam_index] * mu[segmented][beam_index]
+
+    # Aperture area variability (McNiven et al. 2010) relative to the widest opening of each leaf in its beam
+    opening = metrics['Opening']
+    x1_min = np.minimum.reduceat(np.where(metrics['Open'], banks[:, 0, :], np.inf), starts, axis=1)
+    x2_max = np.maximum.reduceat(np.where(metrics['Open'], banks[:, 1, :], -np.inf), starts, axis=1)
+    max_opening = np.sum(np.where(np.isfinite(x2_max - x1_min), x2_max - x1_min, 0.), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        aav = np.where(max_opening[beam_index] > 0, np.sum(opening, axis=0) / max_opening[beam_index], 0.)
+    mcs = np.add.reduceat(aav * metrics['LSV'] * segment_mu, starts) / np.add.reduceat(segment_mu, starts)
+
+    # Leaf motion into each segment from the previous segment of the same beam, and gantry motion over it
+    first = np.zeros(banks.shape[2], dtype=bool)
+    first[starts] = True
+    leaf_motion = np.zeros(banks.shape[2])
+    leaf_motion[1:] = np.sum(np.abs(np.diff(banks, axis=2)), axis=(0, 1))
+    leaf_motion[first] = 0.
+    max_leaf_motion = np.zeros(banks.shape[2])
+    max_leaf_motion[1:] = np.amax(np.abs(np.diff(banks, axis=2)), axis=(0, 1))
+    max_leaf_motion[first] = 0.
+    gantry_motion = np.abs(np.concatenate([snapshots[i].delta_gantry for i in segmented]))
+
+    # Arcs deliver dose during motion, limited by the slowest of dose rate, gantry and leaves.
+    # Static segments deliver dose after the leaves reach position.
+    mu_time = segment_mu / dose_rate
+    motion_time = np.maximum(gantry_motion / parameters['GantrySpeed'], max_leaf_motion / parameters['MaxLeafSpeed'])
+    is_arc = np.add.reduceat(gantry_motion, starts)[beam_index] > 0.
+    segment_time = np.where(is_arc, np.maximum(mu_time, motion_time), mu_time + motion_time)
+    beam_time = np.add.reduceat(segment_time, starts)
+    leaf_travel = np.add.reduceat(leaf_motion, starts)
+    mean_area = np.add.reduceat(metrics['Area'], starts) / counts
+    mean_perimeter = np.add.reduceat(metrics['Perimeter'], starts) / counts
+
+    for k, i in enumerate(segmented):
+        results[beams[i].Name].update({
+            'LeafTravel': float(leaf_travel[k]),
+            'MeanLeafTravel': float(leaf_travel[k]) / (2. * banks.shape[0]),
+            'MeanArea': float(mean_area[k]),
+            'MeanPerimeter': float(mean_perimeter[k]),
+            'MCS': float(mcs[k]),
+            'BeamOnTime': float(beam_time[k])})
+    return results
+
+
+def beamset_complexity(beamsets, model=None):
+    """
+    Delivery complexity and estimated beam-on time of each beam and beamset in a list of beamsets.
+    Beams on the same machine are scored together, and each machine is loaded once.
+    :param beamsets: list of RS beamsets, which may belong to different plans
+    :param model: delivery model dictionary, see delivery_parameters
+    :return: list with one result per beamset in the order of beamsets: {'BeamSet': DicomPlanLabel,
+        'Beams': {beam name: beam_complexity results}, 'MU', 'MUperGy', 'MCS' (MU weighted), 'BeamOnTime' [s]}
+    """
+    results = []
+    groups = {}
+    dose_per_fraction = []
+    for i, bs in enumerate(beamsets):
+        try:
+            dose_per_fraction.append(bs.Prescription.PrimaryDosePrescription.DoseValue /
+                                     bs.FractionationPattern.NumberOfFractions)
+        except (AttributeError, TypeError, ZeroDivisionError):
+            logging.debug('Beamset {} has no prescription, MU per Gy not computed'.format(bs.DicomPlanLabel))
+            dose_per_fraction.append(None)
+        results.append({'BeamSet': bs.DicomPlanLabel, 'Beams': {}})
+        # Beamsets of different plans may share a label, so beams are grouped by the position of their beamset
+        for b in bs.Beams:
+            groups.setdefault((b.MachineReference.MachineName, i), []).append(b)
+
+    machines = {}
+    for (machine_name, i), beams in groups.items():
+        if machine_name not in machines:
+            machines[machine_name] = GeneralOperations.get_machine(machine_name=machine_name)
+        results[i]['Beams'].update(beam_complexity(beams, machine=machines[machine_name], model=model,
+                                                   dose_per_fraction=dose_per_fraction[i]))
+
+    for r, dose in zip(results, dose_per_fraction):
+        beam_results = list(r['Beams'].values())
+        total_mu = sum(b['MU'] for b in beam_results)
+        scored = [b for b in beam_results if b['MCS'] is not None]
+        r['MU'] = total_mu
+        r['MUperGy'] = None if not dose else 100. * total_mu / dose
+        r['BeamOnTime'] = sum(b['BeamOnTime'] for b in beam_results)
+        scored_mu = sum(b['MU'] for b in scored)
+        r['MCS'] = sum(b['MCS'] * b['MU'] for b in scored) / scored_mu if scored_mu > 0 else None
+        logging.debug('Beamset {}: MU {:.1f}, estimated beam-on time {:.0f} s, MCS {}'.format(
+            r['BeamSet'], r['MU'], r['BeamOnTime'], r['MCS']))
+    return results
+
 
 def maximum_beam_leaf_extent(beam):
     """
@@ -1513,16 +2362,17 @@ def maximum_leaf_carriage_extent(beam):
     return max_travel
 
 
-def filter_leaves(beam):
+def filter_leaves(beam, beam_mlc=None):
     """ Examine all leaves that are currently set to be at a minimum leaf gap. If those leaves
         are not moving from control point to control point, then place them such that they will
         be behind the jaw once the set-back is in place. Note that the actual calculation here is
         to place the leaf-pair at: Original Gap position + 0.8 mm + RS Minimum Leaf Jaw Overlap
         :param beam: A beam class object
+        :param beam_mlc: optional mlc_properties object for beam, the banks are updated in place
         :return error: A string documenting success or failure"""
-    s0 = beam.Segments[0]
-    a = s0.JawPositions[1] - s0.JawPositions[0]
-    b = s0.JawPositions[3] - s0.JawPositions[2]
+    s0_jaws = beam_snapshot(beam).jaws[0]
+    a = s0_jaws[1] - s0_jaws[0]
+    b = s0_jaws[3] - s0_jaws[2]
     equivalent_square_field_size = 2 * a * b / (a + b)
     if equivalent_square_field_size < 3.:
         mlc_filter = True
@@ -1534,7 +2384,8 @@ def filter_leaves(beam):
         return error
     # For some bizzare reason, the __init__ method of beam does not pull the data from
     # the MLC MachineReference physics. So we are searching for the machine directly here.
-    beam_mlc = mlc_properties(beam)
+    if beam_mlc is None:
+        beam_mlc = mlc_properties(beam)
 
     if beam_mlc.mlc_retracted:
         error = "MLC filtering failed. MLC retracted"
@@ -1591,6 +2442,7 @@ def filter_leaves(beam):
                 lp[0][l] = beam_mlc.banks[l, 0, cp]
                 lp[1][l] = beam_mlc.banks[l, 1, cp]
             beam.Segments[cp].LeafPositions = lp
+        invalidate_beam_snapshot(beam)
         error = None
         return error
 
@@ -1615,50 +2467,39 @@ def check_mlc_jaw_positions(jaw_positions, mlc_positions):
 
     """
 
-    # Maximum a single leaf can extend from the carriage (jaw)
-    maximum_leaf_out_of_carriage = mlc_positions.max_leaf_carriage
     error = ''
-    # if ciao is not None:
-    #     ciao = maximum_leaf_carriage_extent(beam=beam)
-    max_travel = mlc_positions.max_travel()
-    # Find the maximally extended MLC in each bank
-    max_x1_bank = np.amax(max_travel[:, 0], axis=0)
-    min_x2_bank = np.amin(max_travel[:, 1], axis=0)
-
-    # delta's are the maximum extent of the MLC leaves away from the jaw for this segment
-    if max_travel is not None and not mlc_positions.mlc_retracted:
-        delta_x1 = jaw_positions['X1'] - max_x1_bank
-        delta_x2 = jaw_positions['X2'] - min_x2_bank
-    else:
-        # The beam has no segments, jaws only. Set these variables to something that does not influence calc
-        # i.e. return no violation
-        delta_x1 = delta_x2 = 0
-
-    if abs(delta_x1) >= maximum_leaf_out_of_carriage:
-        error = 'Maximum leaf limit violated for X1. '
-    if abs(delta_x2) > maximum_leaf_out_of_carriage:
-        error += 'Maximum leaf limit violated for X2'
-    if error:
-        logging.debug('MLC Out of Carriage limit reached with proposed jaw positions: ' +
-                      'Maximum A MLC = {}, X1 = {}: '.format(abs(delta_x1), jaw_positions['X1']) +
-                      'Maximum B MLC = {}, X2 = {}'.format(abs(delta_x2), jaw_positions['X2']))
-    return error
-
-
-def check_y_jaw_positions(jaw_positions, beam):
+    # The beam has no segments, jaws only, or the MLC is retracted: no violation
+    if not mlc_positions.has_segments:
+        return error
+    # Check every leaf at every control point against the carriage
+    table = mlc_positions.violation_table([jaw_positions['X1'], jaw_positions['X2'],
+                                           jaw_positions['Y1'], jaw_positions['Y2']])
+    carriage = table[table['check'] == 'Carriage']
+    for bank, jaw in enumerate(['X1', 'X2']):
+        rows = carriage[carriage['bank'] == bank]
+        if len(rows) > 0:
+            error += 'Maximum leaf limit violated for {}. '.format(jaw)
+            logging.debug('MLC Out of Carriage limit reached with proposed jaw position {} = {}: '.format(
+                jaw, jaw_positions[jaw]) + '{} leaves past {}, first at leaf {} segment {}'.format(
+                len(rows), rows['limit'][0], rows['leaf'][0], rows['segment'][0]))
+    return error.strip()
+
+
+def check_y_jaw_positions(jaw_positions, beam, machine=None):
     """
     Make sure setting the jaw positions to the proposed limits does not open past available MLC or
     past jaw overtravel limits
     :param jaw_positions:
     :param beam: RS beam object
+    :param machine: optional RS machine object of the beam, loaded from the machine db if not supplied
     :return: error, if error is None, then no error is detected
     """
 
     error = ''
-    current_machine_name = beam.MachineReference.MachineName
-    machine_db = connect.get_current('MachineDB')
-    current_machine = machine_db.GetTreatmentMachine(machineName=current_machine_name,
-                                                     lockMode=None)
+    if machine is None:
+        current_machine = GeneralOperations.get_machine(machine_name=beam.MachineReference.MachineName)
+    else:
+        current_machine = machine
     # Maximum jaw overtravel (minimum) position
     min_y2_jaw_limit = current_machine.Physics.JawPhysics.MinBottomJawPos
     min_y1_jaw_limit = - min_y2_jaw_limit
@@ -1717,17 +2558,17 @@ def rounded_jaw_positions(beam):
     """
     jaw_positions = {}
 
-    s0 = beam.Segments[0]
+    s0_jaws = beam_snapshot(beam).jaws[0]
     # Find the result of setting the jaws open
-    round_open_l_jaw = math.floor(10 * s0.JawPositions[0]) / 10
-    round_open_r_jaw = math.ceil(10 * s0.JawPositions[1]) / 10
-    round_open_t_jaw = math.floor(10 * s0.JawPositions[2]) / 10
-    round_open_b_jaw = math.ceil(10 * s0.JawPositions[3]) / 10
+    round_open_l_jaw = math.floor(10 * s0_jaws[0]) / 10
+    round_open_r_jaw = math.ceil(10 * s0_jaws[1]) / 10
+    round_open_t_jaw = math.floor(10 * s0_jaws[2]) / 10
+    round_open_b_jaw = math.ceil(10 * s0_jaws[3]) / 10
     # Compute closed jaw positions
-    round_closed_l_jaw = math.ceil(10 * s0.JawPositions[0]) / 10
-    round_closed_r_jaw = math.floor(10 * s0.JawPositions[1]) / 10
-    round_closed_t_jaw = math.ceil(10 * s0.JawPositions[2]) / 10
-    round_closed_b_jaw = math.floor(10 * s0.JawPositions[3]) / 10
+    round_closed_l_jaw = math.ceil(10 * s0_jaws[0]) / 10
+    round_closed_r_jaw = math.floor(10 * s0_jaws[1]) / 10
+    round_closed_t_jaw = math.ceil(10 * s0_jaws[2]) / 10
+    round_closed_b_jaw = math.floor(10 * s0_jaws[3]) / 10
 
     # Potential options
     use_jaw_offset = False
@@ -1735,8 +2576,8 @@ def rounded_jaw_positions(beam):
     use_round_closed = False
     # Check for the equivalent square area, and do not use jaw offsets if the limit is larger than 3 cm^2
     # get the ciao for this beam
-    a = s0.JawPositions[1] - s0.JawPositions[0]
-    b = s0.JawPositions[3] - s0.JawPositions[2]
+    a = s0_jaws[1] - s0_jaws[0]
+    b = s0_jaws[3] - s0_jaws[2]
     equivalent_square_field_size = 2 * a * b / (a + b)
     if equivalent_square_field_size < 3.:
         use_jaw_offset = True
@@ -1745,11 +2586,9 @@ def rounded_jaw_positions(beam):
     # For some bizzare reason, the __init__ method of beam does not pull the data from
     # the MLC MachineReference physics. So we are searching for the machine directly here.
     current_machine = GeneralOperations.get_machine(machine_name=beam.MachineReference.MachineName)
-    # Maximum jaw overtravel (minimum) position
-    current_mlc_physics = current_machine.Physics.MlcPhysics
 
     # If the target is small, try to use jaw offsets.
-    beam_mlc = mlc_properties(beam)
+    beam_mlc = mlc_properties(beam, machine=current_machine)
     if use_jaw_offset:
         x_jaw_offset = 0.8
         y_jaw_offset = 0.2
@@ -1774,7 +2613,7 @@ def rounded_jaw_positions(beam):
             y2_jaw_standoff = math.ceil(10 * (max_open_y2 + y_jaw_offset)) / 10
     else:
         logging.debug('Beam {}: X1:{}, X2:{}, Y1:{}, Y2:{}; Calculated Eq Square Field {}'.format(
-            beam.Name, s0.JawPositions[0], s0.JawPositions[1], s0.JawPositions[2], s0.JawPositions[3],
+            beam.Name, s0_jaws[0], s0_jaws[1], s0_jaws[2], s0_jaws[3],
             equivalent_square_field_size
         ))
     # Check jaws
@@ -1786,7 +2625,7 @@ def rounded_jaw_positions(beam):
         jaw_positions['Y2'] = y2_jaw_standoff
         jaw_positions['X1'] = x1_jaw_standoff
         jaw_positions['X2'] = x2_jaw_standoff
-        error_y_msg = check_y_jaw_positions(jaw_positions, beam)
+        error_y_msg = check_y_jaw_positions(jaw_positions, beam, machine=current_machine)
         error_x_msg = check_mlc_jaw_positions(jaw_positions, beam_mlc)
         if error_x_msg or error_y_msg:
             # Default then to round open
@@ -1799,7 +2638,7 @@ def rounded_jaw_positions(beam):
         jaw_positions['Y2'] = round_open_b_jaw
         jaw_positions['X1'] = round_open_l_jaw
         jaw_positions['X2'] = round_open_r_jaw
-        error_y_msg = check_y_jaw_positions(jaw_positions, beam)
+        error_y_msg = check_y_jaw_positions(jaw_positions, beam, machine=current_machine)
         error_x_msg = check_mlc_jaw_positions(jaw_positions, beam_mlc)
         if error_y_msg or error_x_msg:
             # Default then to rounding both jaws closed
@@ -1813,7 +2652,7 @@ def rounded_jaw_positions(beam):
         jaw_positions['Y2'] = round_closed_b_jaw
         jaw_positions['X1'] = round_closed_l_jaw
         jaw_positions['X2'] = round_closed_r_jaw
-        error_y_msg = check_y_jaw_positions(jaw_positions, beam)
+        error_y_msg = check_y_jaw_positions(jaw_positions, beam, machine=current_machine)
         error_x_msg = check_mlc_jaw_positions(jaw_positions, beam_mlc)
         if error_y_msg:
             logging.debug('Beam {} Y-Jaws: could not be rounded, error {}'.format(beam.Name, error_y_msg))
@@ -1831,12 +2670,12 @@ def jaws_rounded(beam):
     """
     rounded = True
 
-    s0 = beam.Segments[0]
+    s0_jaws = beam_snapshot(beam).jaws[0]
     j0 = rounded_jaw_positions(beam)
-    if (s0.JawPositions[0] != j0['X1'] or
-            s0.JawPositions[1] != j0['X2'] or
-            s0.JawPositions[2] != j0['Y1'] or
-            s0.JawPositions[3] != j0['Y2']):
+    if (s0_jaws[0] != j0['X1'] or
+            s0_jaws[1] != j0['X2'] or
+            s0_jaws[2] != j0['Y1'] or
+            s0_jaws[3] != j0['Y2']):
         rounded = False
 
     return rounded
@@ -1851,31 +2690,11 @@ def round_jaws(beamset):
     Open: X1/Y1 will be rounded down to nearest mm, X2/Y2 rounded up
     Closed: X2/Y1 will be rounded down to nearest mm, X1/Y2 rounded up
         note X1=l_jaw (left), X2=r_jaw (right), Y1=t_jaw (top), Y2=b_jaw (bottom)
+    The beams are processed together, see round_beamset.
     :param beamset: RS beamset
     :return: success: boolean indicating adjustments were successful
     """
-    for b in beamset.Beams:
-        error = filter_leaves(b)
-        if error is not None:
-            logging.debug(error)
-        else:
-            logging.debug('Beam {} filtered'.format(b.Name))
-
-        if not jaws_rounded(beam=b):
-            s0 = b.Segments[0]
-            init_positions = [s0.JawPositions[0], s0.JawPositions[1], s0.JawPositions[2], s0.JawPositions[3]]
-            j0 = rounded_jaw_positions(b)
-            for s in b.Segments:
-                s.JawPositions = [j0['X1'], j0['X2'], j0['Y1'], j0['Y2']]
-            GeneralOperations.logcrit('Beam {}: jaw positions changed '.format(b.Name) +
-                                      '<X1: {0:.2f}->{1:.2f}>, '.format(init_positions[0], s.JawPositions[0]) +
-                                      '<X2: {0:.2f}->{1:.2f}>, '.format(init_positions[1], s.JawPositions[1]) +
-                                      '<Y1: {0:.2f}->{1:.2f}>, '.format(init_positions[2], s.JawPositions[2]) +
-                                      '<Y2: {0:.2f}->{1:.2f}>'.format(init_positions[3], s.JawPositions[3]))
-        else:
-            GeneralOperations.logcrit('Beam {}: jaw positions do not need rounding.'.format(b.Name))
-    success = True
-    return success
+    return round_beamset(beamset, round_jaws=True, round_mu=False)
 
 
 def mu_rounded(beam):
@@ -1913,19 +2732,224 @@ def round_mu(beamset):
     :param beamset:
     :return: success: logical
     """
+    return round_beamset(beamset, round_jaws=False, round_mu=True)
+
+
+class beamset_mlc_properties:
+    """
+    Class of beamset_mlc_properties:
+    the segment and machine data needed to round the jaws and MU of every beam in a beamset, gathered
+    in a single pass over the beams. Each machine is loaded once, rather than once per beam and check.
+    All arrays are indexed by beam, in the order of beamset.Beams
+
+    beams: list of RS beam objects
+    names: list of beam names
+    mu: numpy array of beam MU
+    jaws: numpy array [n_beams x 4] of the first segment jaw positions [X1, X2, Y1, Y2] (nan if no segments)
+    has_segments: boolean numpy array, False for beams (e.g. electrons) without segments
+    mlc_retracted: boolean numpy array, True when both banks are retracted
+    max_open: numpy array [n_beams x 4] of the most open leaf positions [X1, X2, Y1, Y2], only computed
+        for beams that may use jaw standoffs (nan otherwise)
+    y_limits: numpy array [n_beams x 4] of [Y1 overtravel, Y1 MLC boundary, Y2 overtravel, Y2 MLC boundary]
+    beam_mlc: list of mlc_properties objects (None for beams without segments)
+    """
+
+    # Equivalent square field size below which jaw standoffs are used
+    small_field = 3.
+    # Jaw standoffs in x and y for small fields
+    x_jaw_offset = 0.8
+    y_jaw_offset = 0.2
+
+    def __init__(self, beamset, load_segments=True, filter_mlc=False):
+        """
+        :param beamset: RS beamset
+        :param load_segments: read the MLC and jaw data of each beam, not needed for MU-only operations
+        :param filter_mlc: apply filter_leaves to each beam before the leaf data is recorded
+        """
+        self.beams = [b for b in beamset.Beams]
+        self.names = [b.Name for b in self.beams]
+        n = len(self.beams)
+        self.mu = np.array([b.BeamMU for b in self.beams], dtype=float)
+        self.jaws = np.full((n, 4), np.nan)
+        self.has_segments = np.zeros(n, dtype=bool)
+        self.mlc_retracted = np.zeros(n, dtype=bool)
+        self.max_open = np.full((n, 4), np.nan)
+        self.y_limits = np.full((n, 4), np.nan)
+        self.beam_mlc = [None] * n
+        if not load_segments:
+            return
+
+        machines = {}
+        for i, b in enumerate(self.beams):
+            snapshot = beam_snapshot(b)
+            if not snapshot.has_segments:
+                logging.debug('Beam {} does not have segments, jaws will not be evaluated'.format(b.Name))
+                continue
+            self.has_segments[i] = True
+            self.jaws[i, :] = snapshot.jaws[0]
+
+            # Load each machine only once
+            machine_name = b.MachineReference.MachineName
+            if machine_name not in machines:
+                machine = GeneralOperations.get_machine(machine_name=machine_name)
+                mlc_physics = machine.Physics.MlcPhysics
+                n_leaves = len(mlc_physics.UpperLayer.LeafCenterPositions)
+                min_y2_jaw_limit = machine.Physics.JawPhysics.MinBottomJawPos
+                # Maximum MLC defined positions: Leaf Center + 0.2 Leaf_Width (see check_y_jaw_positions)
+                machines[machine_name] = {
+                    'machine': machine,
+                    'y_limits': [- min_y2_jaw_limit,
+                                 mlc_physics.UpperLayer.LeafCenterPositions[0] -
+                                 0.2 * mlc_physics.UpperLayer.LeafWidths[0],
+                                 min_y2_jaw_limit,
+                                 mlc_physics.UpperLayer.LeafCenterPositions[n_leaves - 1] +
+                                 0.2 * mlc_physics.UpperLayer.LeafWidths[n_leaves - 1]]}
+            self.y_limits[i, :] = machines[machine_name]['y_limits']
+
+            beam_mlc = mlc_properties(b, machine=machines[machine_name]['machine'])
+            if filter_mlc:
+                error = filter_leaves(b, beam_mlc=beam_mlc)
+                if error is not None:
+                    logging.debug(error)
+                else:
+                    logging.debug('Beam {} filtered'.format(b.Name))
+            self.beam_mlc[i] = beam_mlc
+            self.mlc_retracted[i] = beam_mlc.mlc_retracted
+
+        # The most open leaves are only needed for small fields that may use jaw standoffs
+        for i in np.flatnonzero(self.standoff_candidates()):
+            max_open = self.beam_mlc[i].max_opening()
+            self.max_open[i, :] = [max_open['max_open_x1'], max_open['max_open_x2'],
+                                   max_open['max_open_y1'], max_open['max_open_y2']]
+
+    def equivalent_square(self):
+        # Equivalent square field size of the first segment of each beam
+        a = self.jaws[:, 1] - self.jaws[:, 0]
+        b = self.jaws[:, 3] - self.jaws[:, 2]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return 2 * a * b / (a + b)
+
+    def standoff_candidates(self):
+        # Beams small enough for jaw standoffs, with an MLC that is not retracted
+        with np.errstate(invalid='ignore'):
+            small = self.equivalent_square() < self.small_field
+        return small & self.has_segments & ~self.mlc_retracted
+
+    def violation_tables(self, jaws):
+        """
+        Full-bank violation table of each beam for proposed jaw positions (see mlc_properties.violation_table)
+        :param jaws: numpy array [n_beams x 4] of proposed [X1, X2, Y1, Y2]
+        :return: list of violation tables (None for beams without segments)
+        """
+        return [None if m is None or np.any(np.isnan(j)) else m.violation_table(j)
+                for m, j in zip(self.beam_mlc, jaws)]
+
+    def jaw_violations(self, jaws, tables=None):
+        """
+        Check proposed jaw positions for all beams against the MLC carriage and jaw overtravel limits
+        :param jaws: numpy array [n_beams x 4] of proposed [X1, X2, Y1, Y2]
+        :param tables: violation tables of the proposed jaws, computed if not supplied
+        :return: boolean numpy array [n_beams x 4], True where the proposed jaw violates a limit
+        """
+        violations = np.zeros(jaws.shape, dtype=bool)
+        if tables is None:
+            tables = self.violation_tables(jaws)
+        # Leaves retracted or no segments: the carriage can not be violated
+        for i, t in enumerate(tables):
+            if t is not None:
+                carriage = t['bank'][t['check'] == 'Carriage']
+                violations[i, 0] = np.any(carriage == 0)
+                violations[i, 1] = np.any(carriage == 1)
+        with np.errstate(invalid='ignore'):
+            violations[:, 2] = (jaws[:, 2] > self.y_limits[:, 0]) | (jaws[:, 2] < self.y_limits[:, 1])
+            violations[:, 3] = (jaws[:, 3] < self.y_limits[:, 2]) | (jaws[:, 3] > self.y_limits[:, 3])
+        return violations
+
+    def rounded_jaw_positions(self):
+        """
+        Vectorized form of rounded_jaw_positions for all beams: use jaw standoffs for small fields,
+        otherwise round open, and round closed where the proposed positions violate a machine limit
+        :return: numpy array [n_beams x 4] of the proposed [X1, X2, Y1, Y2] (nan for beams without segments)
+        """
+        open_direction = np.array([-1., 1., -1., 1.])
+        round_open = np.where(open_direction < 0, np.floor(10 * self.jaws), np.ceil(10 * self.jaws)) / 10
+        round_closed = np.where(open_direction < 0, np.ceil(10 * self.jaws), np.floor(10 * self.jaws)) / 10
+        offsets = np.array([self.x_jaw_offset, self.x_jaw_offset, self.y_jaw_offset, self.y_jaw_offset])
+        standoff = self.max_open + open_direction * offsets
+        standoff = np.where(open_direction < 0, np.floor(10 * standoff), np.ceil(10 * standoff)) / 10
+
+        use_standoff = self.standoff_candidates() & ~np.any(self.jaw_violations(standoff), axis=1)
+        use_open = ~use_standoff & ~np.any(self.jaw_violations(round_open), axis=1)
+        proposed = np.where(use_standoff[:, np.newaxis], standoff,
+                            np.where(use_open[:, np.newaxis], round_open, round_closed))
+        tables = self.violation_tables(proposed)
+        violations = self.jaw_violations(proposed, tables=tables)
+        for i in np.flatnonzero(self.has_segments & np.any(violations, axis=1)):
+            counts = violation_counts(tables[i], self.beam_mlc[i].number_segments)
+            logging.debug('Beam {}: jaws could not be rounded without violating limits on {}, '.format(
+                self.names[i], [j for j, v in zip(['X1', 'X2', 'Y1', 'Y2'], violations[i]) if v]) +
+                'violations at segments {}'.format(
+                    {c: np.flatnonzero(n).tolist() for c, n in counts.items() if c in ['Carriage', 'YBoundary']}))
+        return proposed
+
+    def rounded_mu(self):
+        # Round each beam to the nearest 0.1 MU using the same Round_Half_Up strategy as mu_rounded
+        from decimal import Decimal, ROUND_HALF_UP
+        return np.array([float(Decimal(m).quantize(Decimal('0.1'), rounding=ROUND_HALF_UP))
+                         for m in self.mu.tolist()])
+
+
+def round_beamset(beamset, round_jaws=True, round_mu=True, filter_mlc=True):
+    """
+    Round the jaws and MU of all beams in a beamset in one pass. Segment and machine data are loaded
+    once (beamset_mlc_properties), the proposed jaws and MU are computed for all beams together,
+    and only beams whose values actually change are modified.
+    :param beamset: RS beamset
+    :param round_jaws: round the jaw positions (see round_jaws)
+    :param round_mu: round the beam MU (see round_mu)
+    :param filter_mlc: move stationary closed leaf pairs behind the jaws before rounding (see filter_leaves)
+    :return: success: boolean indicating adjustments were successful
+    """
+    tolerance = 1e-6
     if 'Tomo' in beamset.DeliveryTechnique:
-        logging.debug('Round MU is not a good idea on a Tomo plan.')
+        logging.debug('Rounding jaws and MU is not a good idea on a Tomo plan.')
         success = False
         return success
 
-    for b in beamset.Beams:
-        if mu_is_rounded(b):
-            GeneralOperations.logcrit('Beam {} already has rounded MU {}'.format(b.Name, b.BeamMU))
-        else:
-            mu_i = b.BeamMU
-            b.BeamMU = mu_rounded(b)
-            GeneralOperations.logcrit('Beam {0} MU changed from {1:.2f} to {2}'.format(b.Name, mu_i, b.BeamMU))
-    return True
+    data = beamset_mlc_properties(beamset, load_segments=round_jaws, filter_mlc=round_jaws and filter_mlc)
+
+    if round_mu:
+        mu = data.rounded_mu()
+        changed = np.abs(data.mu - mu) > tolerance
+        for i, b in enumerate(data.beams):
+            if changed[i]:
+                b.BeamMU = float(mu[i])
+                GeneralOperations.logcrit('Beam {0} MU changed from {1:.2f} to {2}'.format(
+                    b.Name, data.mu[i], b.BeamMU))
+            else:
+                GeneralOperations.logcrit('Beam {} already has rounded MU {}'.format(b.Name, b.BeamMU))
+
+    if round_jaws:
+        proposed = data.rounded_jaw_positions()
+        with np.errstate(invalid='ignore'):
+            changed = data.has_segments & np.any(proposed != data.jaws, axis=1)
+        for i, b in enumerate(data.beams):
+            if not data.has_segments[i]:
+                continue
+            if changed[i]:
+                j0 = proposed[i, :].tolist()
+                for s in b.Segments:
+                    s.JawPositions = j0
+                invalidate_beam_snapshot(b)
+                GeneralOperations.logcrit('Beam {}: jaw positions changed '.format(b.Name) +
+                                          '<X1: {0:.2f}->{1:.2f}>, '.format(data.jaws[i, 0], j0[0]) +
+                                          '<X2: {0:.2f}->{1:.2f}>, '.format(data.jaws[i, 1], j0[1]) +
+                                          '<Y1: {0:.2f}->{1:.2f}>, '.format(data.jaws[i, 2], j0[2]) +
+                                          '<Y2: {0:.2f}->{1:.2f}>'.format(data.jaws[i, 3], j0[3]))
+            else:
+                GeneralOperations.logcrit('Beam {}: jaw positions do not need rounding.'.format(b.Name))
+    success = True
+    return success
 
 
 def exists_dsp(beamset, dsps):
@@ -2200,78 +3224,96 @@ def load_beams_xml(filename, beamset_name, path):
     :param path: path to the xml file
     :return beams: a list of objects of type Beam"""
 
-    beam_elements = Beams.select_element(set_level='beamset',
-                                         set_type=None,
-                                         set_elements='beam',
-                                         set_level_name=beamset_name,
-                                         filename=filename,
-                                         folder=path, verbose_logging=True)
-
-    beams = []
-    for et_beamsets in beam_elements:
-        beam_nodes = et_beamsets.findall('./beam')
-        for b in beam_nodes:
-            beam = Beam()
-            beam.number = int(b.find('BeamNumber').text)
-            beam.name = str(b.find('Name').text)
-            beam.technique = str(b.find('DeliveryTechnique').text)
-            beam.energy = int(b.find('Energy').text)
-
-            if b.find('GantryAngle') is None:
-                beam.gantry_start_angle = None
-            else:
-                beam.gantry_start_angle = float(b.find('GantryAngle').text)
-
-            if b.find('GantryStopAngle') is None:
-                beam.gantry_stop_angle = None
-            else:
-                beam.gantry_stop_angle = float(b.find('GantryStopAngle').text)
-
-            if b.find('ArcRotationDirection') is None:
-                beam.rotation_dir = None
-            else:
-                beam.rotation_dir = str(b.find('ArcRotationDirection').text)
-
-            if b.find('CollimatorAngle') is None:
-                beam.collimator_angle = None
-            else:
-                beam.collimator_angle = float(b.find('CollimatorAngle').text)
-
-            if b.find('CouchAngle') is None:
-                beam.couch_angle = None
-            else:
-                beam.couch_angle = float(b.find('CouchAngle').text)
-
-            if b.find('CouchAngle') is None:
-                beam.couch_angle = None
-            else:
-                beam.couch_angle = float(b.find('CouchAngle').text)
-
-            if b.find('FieldWidth') is None:
-                beam.field_width = None
-            else:
-                beam.field_width = float(b.find('FieldWidth').text)
+    template = beam_template_library().find(beamset_name, filename=filename, path=path)
+    if template is None:
+        logging.warning('Beamset {} was not found in {}'.format(beamset_name, filename))
+        return []
+    logging.info('Beam list to be loaded {}'.format(template.name))
+    return list(template.beams)
 
-            if b.find('Pitch') is None:
-                beam.pitch = None
-            else:
-                beam.pitch = float(b.find('Pitch').text)
-
-            if b.find('JawMode') is None:
-                beam.jaw_mode = None
-            else:
-                beam.jaw_mode = float(b.find('JawMode').text)
 
-            if b.find('BackJawPosition') is None:
-                beam.back_jaw_position = None
-            else:
-                beam.back_jaw_position = float(b.find('BackJawPosition').text)
+class OptimizationSettingsIndex(object):
+    """
+    Index of the optimization settings of a plan, built in a single pass over the PlanOptimizations.
+    Use one index for a series of beam limit checks rather than searching the plan optimizations,
+    treatment setup settings and beam settings again for every beam.
 
-            beams.append(beam)
-    return beams
+    optimization_index: {beamset DicomPlanLabel: index in plan.PlanOptimizations}
+    treatment_setup_settings: {beamset DicomPlanLabel: TreatmentSetupSettings}
+    beam_settings: {beamset DicomPlanLabel: {beam name: BeamSettings}}
+    """
 
+    def __init__(self, plan):
+        self.plan = plan
+        self.optimization_index = {}
+        self.treatment_setup_settings = {}
+        self.beam_settings = {}
+        # InitialJawPositions of each beam by jaw_key, read from RS once and dropped when the beam limits are edited
+        self._jaw_positions = {}
+        for opt_index, plan_optimization in enumerate(plan.PlanOptimizations):
+            for tss in plan_optimization.OptimizationParameters.TreatmentSetupSettings:
+                label = tss.ForTreatmentSetup.DicomPlanLabel
+                self.optimization_index[label] = opt_index
+                self.treatment_setup_settings[label] = tss
+                self.beam_settings[label] = {}
+                for bs in tss.BeamSettings:
+                    self.beam_settings[label][bs.ForBeam.Name] = bs
+
+    def find_beam_settings(self, beamset, beam_name):
+        """
+        :param beamset: RS beamset
+        :param beam_name: name of the beam
+        :return: the BeamSettings of the beam or None if it is not found
+        """
+        try:
+            return self.beam_settings[beamset.DicomPlanLabel][beam_name]
+        except KeyError:
+            return None
 
-def check_beam_limits(beam_name, plan, beamset, limit, change=False, verbose_logging=True):
+    def jaw_key(self, beamset, beam_settings):
+        """
+        Cache key of the jaw positions of a beam: the plan, beamset, beam and machine, so beams of the same name
+        in other beamsets or plans, or on another machine, do not share jaw positions
+        :param beamset: RS beamset
+        :param beam_settings: BeamSettings of the beam
+        :return: tuple
+        """
+        beam = beam_settings.ForBeam
+        return (self.plan.Name, beamset.DicomPlanLabel, beam.Name, getattr(beam, 'Number', None),
+                beam.MachineReference.MachineName)
+
+    def initial_jaw_positions(self, beamset, beam_settings):
+        """
+        :param beamset: RS beamset of the beam
+        :param beam_settings: BeamSettings of the beam
+        :return: list of InitialJawPositions [x1, x2, y1, y2]
+        """
+        key = self.jaw_key(beamset, beam_settings)
+        if key not in self._jaw_positions:
+            jaws = beam_settings.ForBeam.InitialJawPositions
+            self._jaw_positions[key] = [jaws[0], jaws[1], jaws[2], jaws[3]]
+        return self._jaw_positions[key]
+
+    def edit_jaw_limits(self, beamset, beam_settings, limit):
+        """
+        Set the jaw limits of a beam to be used as the maximum aperture in optimization
+        :param beamset: RS beamset of the beam
+        :param beam_settings: BeamSettings of the beam
+        :param limit: list of four limit [x1, x2, y1, y2]
+        """
+        beam_settings.EditBeamOptimizationSettings(
+            JawMotion='Use limits as max',
+            LeftJaw=limit[0],
+            RightJaw=limit[1],
+            TopJaw=limit[2],
+            BottomJaw=limit[3],
+            SelectCollimatorAngle='False',
+            AllowBeamSplit='False',
+            OptimizationTypes=['SegmentOpt', 'SegmentMU'])
+        self._jaw_positions.pop(self.jaw_key(beamset, beam_settings), None)
+
+
+def check_beam_limits(beam_name, plan, beamset, limit, change=False, verbose_logging=True, settings_index=None):
     """
     Check the current locked limit on the beams and modify the optimization limit
     :param beam_name: name of beam to be modified
@@ -2280,36 +3322,21 @@ def check_beam_limits(beam_name, plan, beamset, limit, change=False, verbose_log
     :param limit: list of four limit [x1, x2, y1, y2]
     :param change: change the beam limit True/False
     :param verbose_logging: turn on (True) or off (False) extensive debugging messages
+    :param settings_index: OptimizationSettingsIndex of the plan, built here if not supplied
     :return: success: True if limits changed or limit is satisfied by current beam limits
     """
-    # Find the optimization index corresponding to this beamset
-    opt_index = PlanOperations.find_optimization_index(plan=plan,
-                                                       beamset=beamset,
-                                                       verbose_logging=verbose_logging)
-    plan_optimization_parameters = plan.PlanOptimizations[opt_index].OptimizationParameters
-    ts_settings = None
-    beam_found = False
-    for tss in plan_optimization_parameters.TreatmentSetupSettings:
-        if tss.ForTreatmentSetup.DicomPlanLabel == beamset.DicomPlanLabel:
-            ts_settings = tss
-            if verbose_logging:
-                logging.debug('TreatmentSetupSettings:{} matches Beamset:{} looking for beam {}'.format(
-                    tss.ForTreatmentSetup.DicomPlanLabel, beamset.DicomPlanLabel, beam_name))
-            for bs in ts_settings.BeamSettings:
-                if bs.ForBeam.Name == beam_name:
-                    beam_found = True
-                    current_beam = bs
-                    break
-                else:
-                    continue
-        else:
-            continue
+    if settings_index is None:
+        settings_index = OptimizationSettingsIndex(plan)
 
-    if ts_settings is None:
+    if beamset.DicomPlanLabel not in settings_index.treatment_setup_settings:
         logging.exception('No treatment set up settings could be found for beamset {}'.format(
             beamset.DicomPlanLabel) + 'Contact script administrator')
+    elif verbose_logging:
+        logging.debug('TreatmentSetupSettings found for Beamset:{} looking for beam {}'.format(
+            beamset.DicomPlanLabel, beam_name))
 
-    if not beam_found:
+    current_beam = settings_index.find_beam_settings(beamset, beam_name)
+    if current_beam is None:
         logging.warning('Beam {} not found in beam list from {}'.format(
             beam_name, beamset.DicomPlanLabel))
         sys.exit('Could not find a beam match for setting aperture limits')
@@ -2318,10 +3345,7 @@ def check_beam_limits(beam_name, plan, beamset, limit, change=False, verbose_log
     try:
         current_limits = current_beam.BeamApertureLimit
         if current_limits != 'NoLimit':
-            existing_limits = [current_beam.ForBeam.InitialJawPositions[0],
-                               current_beam.ForBeam.InitialJawPositions[1],
-                               current_beam.ForBeam.InitialJawPositions[2],
-                               current_beam.ForBeam.InitialJawPositions[3]]
+            existing_limits = list(settings_index.initial_jaw_positions(beamset, current_beam))
             if verbose_logging:
                 logging.debug(('aperture limits found on beam {} of initial jaw positions: x1 = {}, ' +
                                'x2 = {}, y1 = {}, y2 = {}')
@@ -2377,21 +3401,14 @@ def check_beam_limits(beam_name, plan, beamset, limit, change=False, verbose_log
                 logging.debug('Beam has MU. Changing jaw limit with an optimized beam is not possible without reset')
             return False
         if change:
-            current_beam.EditBeamOptimizationSettings(
-                JawMotion='Use limits as max',
-                LeftJaw=modified_limit[0],
-                RightJaw=modified_limit[1],
-                TopJaw=modified_limit[2],
-                BottomJaw=modified_limit[3],
-                SelectCollimatorAngle='False',
-                AllowBeamSplit='False',
-                OptimizationTypes=['SegmentOpt', 'SegmentMU'])
+            settings_index.edit_jaw_limits(beamset, current_beam, modified_limit)
+            new_limits = settings_index.initial_jaw_positions(beamset, current_beam)
             logging.info('Beam {}: Changed jaw limits x1: {} => {}, x2: {} = {}, y1: {} => {}, y2: {} => {}'
                          .format(beam_name,
-                                 existing_limits[0], current_beam.ForBeam.InitialJawPositions[0],
-                                 existing_limits[1], current_beam.ForBeam.InitialJawPositions[1],
-                                 existing_limits[2], current_beam.ForBeam.InitialJawPositions[2],
-                                 existing_limits[3], current_beam.ForBeam.InitialJawPositions[3]))
+                                 existing_limits[0], new_limits[0],
+                                 existing_limits[1], new_limits[1],
+                                 existing_limits[2], new_limits[2],
+                                 existing_limits[3], new_limits[3]))
             return True
         else:
             logging.info(('Aperture check shows that limit on {} are not current. Limits should be '
@@ -2406,21 +3423,75 @@ def check_beam_limits(beam_name, plan, beamset, limit, change=False, verbose_log
         return True
 
 
+def check_beamset_limits(plan, beamset, limits, change=False, verbose_logging=True, settings_index=None):
+    """
+    Check (and optionally change) the optimization jaw limits of several beams of a beamset in one pass
+    over the plan optimization settings. See check_beam_limits.
+    :param plan: current plan
+    :param beamset: current beamset
+    :param limits: dictionary of {beam name: list of four limit [x1, x2, y1, y2]}
+    :param change: change the beam limits True/False
+    :param verbose_logging: turn on (True) or off (False) extensive debugging messages
+    :param settings_index: OptimizationSettingsIndex of the plan, built here if not supplied
+    :return: success: {beam name: True if limits changed or limit is satisfied by current beam limits}
+    """
+    if settings_index is None:
+        settings_index = OptimizationSettingsIndex(plan)
+    success = {}
+    for beam_name, limit in limits.items():
+        success[beam_name] = check_beam_limits(beam_name, plan=plan, beamset=beamset, limit=limit,
+                                               change=change, verbose_logging=verbose_logging,
+                                               settings_index=settings_index)
+    return success
+
+
+def electron_field_size(beam):
+    """
+    Area of the electron field defined by the beam's block (cutout), if one exists
+    :param beam: RS electron beam
+    :return: field area in cm^2 or None if no block contour is found
+    """
+    try:
+        contour = beam.Blocks[0].Contour
+        x = np.array([c.x for c in contour])
+        y = np.array([c.y for c in contour])
+    except (AttributeError, IndexError, TypeError):
+        return None
+    if x.size < 3:
+        return None
+    # Shoelace formula for the area of the block polygon
+    return 0.5 * abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+
+
 def emc_calc_params(beamset):
     """
     For each beam, go through the beam doses, and return the statistical uncertainty and the
     MC histories used in beam beam dose. Return the maximum uncertainty and minimum MC histories.
     :param beamset: RS beamset
-    :return: NormUnc (the maximum normalized uncertainty) and number of histories used in calc
+    :return: NormUnc (the maximum normalized uncertainty) and number of histories used in calc,
+        Beams is a list of the machine, energy, field size, histories and uncertainty of each beam dose
     """
     max_uncertainty = 0
     min_histories = 1e10
+    beams = []
     # Return electron monte carlo computational parameters
     for bd in beamset.FractionDose.BeamDoses:
-        max_uncertainty = max(max_uncertainty, bd.DoseValues.RelativeStatisticalUncertainty)
-        min_histories = min(min_histories, bd.DoseValues.AlgorithmProperties.MonteCarloHistoriesPerAreaFluence)
+        uncertainty = bd.DoseValues.RelativeStatisticalUncertainty
+        histories = bd.DoseValues.AlgorithmProperties.MonteCarloHistoriesPerAreaFluence
+        max_uncertainty = max(max_uncertainty, uncertainty)
+        min_histories = min(min_histories, histories)
+        try:
+            beam = bd.ForBeam
+            beams.append({'Name': beam.Name,
+                          'Machine': beam.MachineReference.MachineName,
+                          'Energy': beam.MachineReference.Energy,
+                          'FieldSize': electron_field_size(beam),
+                          'Histories': histories,
+                          'Uncertainty': uncertainty})
+        except AttributeError:
+            logging.debug('Beam dose is not associated with a beam, not recorded for history planning')
 
-    return {'NormUnc': max_uncertainty, 'MinHist': min_histories}
+    return {'NormUnc': max_uncertainty, 'MinHist': min_histories, 'Beams': beams}
 
 
 class EmcTest:
@@ -2431,24 +3502,177 @@ class EmcTest:
         self.hist = None
 
 
-def check_emc(beamset, stat_limit=0.01, histories=5e5):
+class EmcPlanner(object):
+    """
+    Predicts the electron Monte Carlo histories needed to meet a statistical uncertainty limit in a single
+    recompute. Every calculation examined is recorded in a local csv store, and for each machine and energy
+    the uncertainty is fit as:
+        log(uncertainty) = a + b * log(histories) [+ c * log(field size)]
+    The fitted exponent b replaces the ideal Monte Carlo scaling (b = -0.5) when scaling the current
+    calculation to the limit. The ideal scaling is used until a machine and energy has enough records.
+    """
+    fields = ['Date', 'Machine', 'Energy', 'FieldSize', 'Histories', 'Uncertainty']
+    default_exponent = -0.5
+    # Minimum number of records for a machine and energy before a fit is used
+    min_records = 4
+    # Increase the predicted histories slightly to avoid landing just above the limit
+    safety_factor = 1.1
+
+    def __init__(self, store=None):
+        """
+        :param store: path to the csv store of calculation results, emc_store if not supplied
+        """
+        self.store = emc_store if store is None else store
+        self.records = self.read_store()
+
+    def read_store(self):
+        records = []
+        if not os.path.isfile(self.store):
+            return records
+        with open(self.store, 'r') as f:
+            header = f.readline().strip().split(',')
+            for line in f:
+                values = dict(zip(header, line.strip().split(',')))
+                try:
+                    records.append({
+                        'Machine': values['Machine'],
+                        'Energy': float(values['Energy']),
+                        'FieldSize': float(values['FieldSize']) if values['FieldSize'] else None,
+                        'Histories': float(values['Histories']),
+                        'Uncertainty': float(values['Uncertainty'])})
+                except (KeyError, ValueError):
+                    logging.debug('Skipping malformed EMC record {}'.format(line.strip()))
+        return records
+
+    def record(self, beamset):
+        """
+        Record the histories and uncertainty of each beam dose of the beamset
+        :param beamset: RS beamset with computed electron dose
+        :return: emc_calc_params of the beamset
+        """
+        params = emc_calc_params(beamset)
+        date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        lines = []
+        for b in params['Beams']:
+            if not b['Uncertainty'] or not b['Histories']:
+                continue
+            self.records.append({k: b[k] for k in ['Machine', 'Energy', 'FieldSize', 'Histories', 'Uncertainty']})
+            lines.append(','.join(['{}'.format(v) for v in [
+                date, b['Machine'], b['Energy'], '' if b['FieldSize'] is None else b['FieldSize'],
+                b['Histories'], b['Uncertainty']]]))
+        try:
+            store_dir = os.path.dirname(self.store)
+            if store_dir and not os.path.isdir(store_dir):
+                os.makedirs(store_dir)
+            new_store = not os.path.isfile(self.store)
+            with open(self.store, 'a') as f:
+                if new_store:
+                    f.write(','.join(self.fields) + '\n')
+                for line in lines:
+                    f.write(line + '\n')
+        except (IOError, OSError) as e:
+            logging.warning('EMC history store {} could not be written: {}'.format(self.store, e))
+        return params
+
+    def fit(self, machine, energy):
+        """
+        Fit the uncertainty scaling for a machine and energy
+        :param machine: machine name
+        :param energy: nominal electron energy
+        :return: dictionary of the fit 'Exponent', 'Coefficients' and number of 'Records',
+            None if there are too few records or the fit is not physical
+        """
+        records = [r for r in self.records if r['Machine'] == machine and r['Energy'] == float(energy)]
+        if len(records) < self.min_records:
+            return None
+        histories = np.log(np.array([r['Histories'] for r in records]))
+        uncertainty = np.log(np.array([r['Uncertainty'] for r in records]))
+        if np.unique(histories).size < 2:
+            return None
+        columns = [np.ones(len(records)), histories]
+        field_sizes = [r['FieldSize'] for r in records]
+        if None not in field_sizes and len(set(field_sizes)) > 1 and len(records) > self.min_records:
+            columns.append(np.log(np.array(field_sizes)))
+        coefficients = np.linalg.lstsq(np.column_stack(columns), uncertainty, rcond=None)[0]
+        if coefficients[1] >= 0:
+            logging.debug('EMC fit for {} {} MeV is not physical, using ideal scaling'.format(machine, energy))
+            return None
+        return {'Exponent': coefficients[1], 'Coefficients': coefficients, 'Records': len(records)}
+
+    def exponent(self, machine, energy):
+        fit = self.fit(machine, energy)
+        if fit is None:
+            return self.default_exponent
+        return fit['Exponent']
+
+    def predict(self, params, stat_limit, histories):
+        """
+        Predict the histories that will bring every beam dose below the statistical limit
+        :param params: emc_calc_params of the current calculation
+        :param stat_limit: limit on the maximum uncertainty normalized to the maximum dose
+        :param histories: minimum number of histories
+        :return: predicted number of histories per area fluence
+        """
+        predicted = histories
+        for b in params['Beams']:
+            if not b['Uncertainty'] or not b['Histories'] or b['Uncertainty'] <= stat_limit:
+                continue
+            exponent = self.exponent(b['Machine'], b['Energy'])
+            needed = b['Histories'] * (stat_limit / b['Uncertainty']) ** (1. / exponent)
+            logging.debug('Beam {}: {} {} MeV uncertainty scales as histories^{:.3f}, {} histories needed'.format(
+                b['Name'], b['Machine'], b['Energy'], exponent, int(needed)))
+            predicted = max(predicted, int(self.safety_factor * needed))
+        return predicted
+
+    def compute_dose(self, beamset, dose_algorithm, stat_limit=0.01, histories=5e5, max_recomputes=2):
+        """
+        Check the current electron dose and recompute with the predicted histories until the
+        statistical limit is met
+        :param beamset: RS beamset with computed electron dose
+        :param dose_algorithm: RS dose algorithm for ComputeDose
+        :param stat_limit: limit on the maximum uncertainty normalized to the maximum dose
+        :param histories: minimum number of histories
+        :param max_recomputes: maximum number of dose recomputes
+        :return: EmcTest of the last calculation
+        """
+        emc_result = check_emc(beamset, stat_limit=stat_limit, histories=histories, planner=self)
+        recomputes = 0
+        while not emc_result.bool and recomputes < max_recomputes:
+            beamset.AccurateDoseAlgorithm.MonteCarloHistoriesPerAreaFluence = emc_result.hist
+            beamset.ComputeDose(ComputeBeamDoses=True, DoseAlgorithm=dose_algorithm, ForceRecompute=True)
+            recomputes += 1
+            emc_result = check_emc(beamset, stat_limit=stat_limit, histories=histories, planner=self)
+        logging.info('Electron MC dose {} after {} recomputes'.format(
+            'met the statistical limit' if emc_result.bool else 'did not meet the statistical limit', recomputes))
+        return emc_result
+
+
+def check_emc(beamset, stat_limit=0.01, histories=5e5, planner=None):
     """
     Checks the electron monte carlo accuracy to ensure statistical limit is met
     :param beamset: RS beamset
     :param stat_limit: limit on the maximum uncertainty normalized to the maximum dose
     :param histories: number of e mc histories
+    :param planner: EmcPlanner used to record this calculation and predict the recommended histories
     :return: EmcTest: True if meeting both standard clinical goals, otherwise a new recommended number of histories
     """
-    eval_current_emc = emc_calc_params(beamset)
+    emc_test = EmcTest()
+    if planner is None:
+        eval_current_emc = emc_calc_params(beamset)
+    else:
+        eval_current_emc = planner.record(beamset)
     if eval_current_emc['MinHist'] < histories or eval_current_emc['NormUnc'] > stat_limit:
-        EmcTest.bool = False
-        stat_limit_hist = int(eval_current_emc['MinHist'] * (eval_current_emc['NormUnc'] / stat_limit) ** 2.)
-        EmcTest.hist = max(histories, stat_limit_hist)
+        emc_test.bool = False
+        if planner is None:
+            stat_limit_hist = int(eval_current_emc['MinHist'] * (eval_current_emc['NormUnc'] / stat_limit) ** 2.)
+        else:
+            stat_limit_hist = planner.predict(eval_current_emc, stat_limit=stat_limit, histories=histories)
+        emc_test.hist = max(histories, stat_limit_hist)
         logging.info('Electron MC check showed an uncertainty of {} recommend increasing histories from {} to {}'
-                     .format(eval_current_emc['NormUnc'], eval_current_emc['MinHist'], EmcTest.hist))
+                     .format(eval_current_emc['NormUnc'], eval_current_emc['MinHist'], emc_test.hist))
     else:
-        EmcTest.bool = True
+        emc_test.bool = True
         logging.info('Electron MC check showed clinically-acceptable uncertainty {} and histories {}'
                      .format(eval_current_emc['NormUnc'], eval_current_emc['MinHist']))
 
-    return EmcTest
+    return emc_test
@@ -8,6 +8,7 @@ import os
 import logging
 import xml.etree.ElementTree
 import UserInterface
+import ProtocolIndex
 
 
 def select_element(set_level, set_type, set_elements,
@@ -157,7 +158,7 @@ def select_element(set_level, set_type, set_elements,
         for f in file_list:
             if f.endswith('.xml'):
                 # Parse the xml file
-                tree = xml.etree.ElementTree.parse(os.path.join(path_to_sets, f))
+                tree = ProtocolIndex.parse(os.path.join(path_to_sets, f))
                 if verbose_logging:
                     logging.debug('tree root level is {}'.format(tree.getroot().tag))
                 # Search first for a top level set. This would be a file of beamsets, goalsets, or objectivesets
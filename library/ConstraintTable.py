@@ -0,0 +1,245 @@
+""" Constraint Table
+
+    Compiles the per-organ dose constraints of the stand-alone goal sets (QUANTEC, QUANTEC-SRS, QUANTEC-SBRT and
+    TG-101) into a lookup table. Each <roi> of a set is a row, indexed by (organ, fractions, endpoint), by
+    (organ, fractions) and by (set, fractions), so the constraints of a plan ROI are found without scanning the
+    sets. The columns, including the serial or parallel architecture of the organ, are also kept as numpy arrays
+    for queries over the whole table, e.g. all serial organ constraints for 5 fractions. Constraints without a
+    <fractions> element apply to any fractionation and are stored under fractions None.
+
+    Example Usage:
+    import ConstraintTable
+    table = ConstraintTable.get_table()
+    rows = table.lookup('SpinalCord', fractions=5, endpoint='Max')
+    serial = table.query(fractions=5, architecture='serial')
+    print serial['organ'], serial['dose']
+    constraints = table.plan_constraints(['SpinalCord', 'Esophagus'], fractions=5)
+    elements = table.elements(constraints['SpinalCord'])
+
+    Version history:
+    1.0.0 Lookup tables of the goal set constraints
+    1.0.1 Tables are rebuilt when a goal set file of their folder is added, edited or removed
+
+    This program is free software: you can redistribute it and/or modify it under
+    the terms of the GNU General Public License as published by the Free Software
+    Foundation, either version 3 of the License, or (at your option) any later
+    version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT
+    ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+    FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+    """
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.1'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+import os
+import logging
+import numpy as np
+import Goals
+import ProtocolIndex
+
+# Organs with a parallel architecture (TG-101 critical volume constraints and the QUANTEC mean dose organs),
+# all other organs are serial
+parallel_organs = {'Lungs', 'Lung_L', 'Lung_R', 'Lung_Total', 'Liver', 'Liver-GTV', 'Kidneys', 'Kidney_L',
+                   'Kidney_R', 'Kidney_Total', 'Parotid_L', 'Parotid_R', 'Parotid_Total'}
+
+
+def architecture(organ):
+    """
+    :param organ: TG-263 organ name
+    :return: 'parallel' or 'serial'
+    """
+    return 'parallel' if organ in parallel_organs else 'serial'
+
+
+def _number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class ConstraintTable(object):
+    """
+    Goal set constraints indexed by organ, fractionation and endpoint
+    """
+
+    def __init__(self, sets):
+        """
+        :param sets: {set name: goal set element or list of <roi> elements}
+        """
+        self.goals = []
+        self._elements = []
+        set_names = []
+        descriptions = []
+        for name in sorted(sets):
+            s = sets[name]
+            for r in s.findall('roi') if hasattr(s, 'findall') else s:
+                self._elements.append(r)
+                self.goals.append(Goals.compile_goal(r))
+                set_names.append(name)
+                description = r.find('description')
+                descriptions.append(description.text if description is not None else None)
+
+        g = self.goals
+        self.columns = {
+            'organ': np.array([x.roi for x in g], dtype=object),
+            'set': np.array(set_names, dtype=object),
+            'fractions': np.array([x.fractions if x.fractions is not None else np.nan for x in g], dtype=float),
+            'endpoint': np.array([Goals.goal_endpoint(x) for x in g], dtype=object),
+            'direction': np.array([x.direction for x in g], dtype=object),
+            'dose': np.array([_number(x.dose) for x in g], dtype=float),
+            'dose_units': np.array([x.dose_units for x in g], dtype=object),
+            'volume': np.array([_number(x.volume) for x in g], dtype=float),
+            'volume_units': np.array([x.volume_units for x in g], dtype=object),
+            'serial': np.array([architecture(x.roi) == 'serial' for x in g], dtype=bool),
+            'description': np.array(descriptions, dtype=object)}
+
+        self._by_key = {}
+        self._by_organ = {}
+        self._by_set = {}
+        for i, x in enumerate(g):
+            self._by_key.setdefault((x.roi, x.fractions, self.columns['endpoint'][i]), []).append(i)
+            self._by_organ.setdefault((x.roi, x.fractions), []).append(i)
+            self._by_set.setdefault((set_names[i], x.fractions), []).append(i)
+        logging.debug('Constraint table of {} constraints on {} organs from {} sets'.format(
+            len(g), len(set(x.roi for x in g)), len(sets)))
+
+    def __len__(self):
+        return len(self.goals)
+
+    @staticmethod
+    def _merge(*row_lists):
+        return sorted(set(i for rows in row_lists for i in rows))
+
+    def lookup(self, organ, fractions=None, endpoint=None, any_fractionation=True):
+        """
+        Rows of the constraints of an organ
+        :param organ: TG-263 organ name
+        :param fractions: number of fractions, None for the constraints without a fractionation
+        :param endpoint: endpoint, e.g. Max or D0.2cc, all endpoints if None
+        :param any_fractionation: include the constraints without a fractionation
+        :return: list of row indices in table order
+        """
+        if endpoint is None:
+            rows = self._by_organ.get((organ, fractions), [])
+            if any_fractionation and fractions is not None:
+                rows = self._merge(rows, self._by_organ.get((organ, None), []))
+        else:
+            rows = self._by_key.get((organ, fractions, endpoint), [])
+            if any_fractionation and fractions is not None:
+                rows = self._merge(rows, self._by_key.get((organ, None, endpoint), []))
+        return list(rows)
+
+    def set_rows(self, name, fractions=None, any_fractionation=True):
+        """
+        Rows of a goal set for a fractionation
+        :param name: goal set name
+        :param fractions: number of fractions, None for the constraints without a fractionation
+        :param any_fractionation: include the constraints without a fractionation
+        :return: list of row indices in table order
+        """
+        rows = self._by_set.get((name, fractions), [])
+        if any_fractionation and fractions is not None:
+            rows = self._merge(rows, self._by_set.get((name, None), []))
+        return list(rows)
+
+    def plan_constraints(self, rois, fractions=None, sets=None, any_fractionation=True):
+        """
+        Constraints of the ROIs of a plan
+        :param rois: list of plan ROI names
+        :param fractions: number of fractions of the plan
+        :param sets: only constraints of these goal sets, all sets if None
+        :param any_fractionation: include the constraints without a fractionation
+        :return: {roi: list of row indices} of the ROIs that have constraints
+        """
+        constraints = {}
+        for r in rois:
+            rows = self.lookup(r, fractions=fractions, any_fractionation=any_fractionation)
+            if sets is not None:
+                rows = [i for i in rows if self.columns['set'][i] in sets]
+            if rows:
+                constraints[r] = rows
+        return constraints
+
+    def query(self, organs=None, fractions=None, architecture=None, endpoint=None, sets=None,
+              any_fractionation=False):
+        """
+        Constraints matching all given criteria, as arrays
+        :param organs: list of organ names
+        :param fractions: number of fractions, None for all fractionations
+        :param architecture: 'serial' or 'parallel'
+        :param endpoint: endpoint, e.g. Max or D0.2cc
+        :param sets: list of goal set names
+        :param any_fractionation: with fractions, include the constraints without a fractionation
+        :return: dict of the column arrays of the matching rows, with their row indices under 'row'
+        """
+        c = self.columns
+        mask = np.ones(len(self), dtype=bool)
+        if organs is not None:
+            mask &= np.isin(c['organ'], list(organs))
+        if fractions is not None:
+            selected = c['fractions'] == fractions
+            if any_fractionation:
+                selected |= np.isnan(c['fractions'])
+            mask &= selected
+        if architecture is not None:
+            mask &= c['serial'] if architecture == 'serial' else ~c['serial']
+        if endpoint is not None:
+            mask &= c['endpoint'] == endpoint
+        if sets is not None:
+            mask &= np.isin(c['set'], list(sets))
+        return self.arrays(np.flatnonzero(mask))
+
+    def arrays(self, rows):
+        """
+        :param rows: row indices
+        :return: dict of the column arrays of the rows, with the row indices under 'row'
+        """
+        rows = np.asarray(rows, dtype=int)
+        arrays = dict((k, v[rows]) for k, v in self.columns.items())
+        arrays['row'] = rows
+        return arrays
+
+    def elements(self, rows):
+        """
+        :param rows: row indices
+        :return: list of the goal elements of the rows
+        """
+        return [self._elements[i] for i in rows]
+
+
+# Tables of this session by protocol folder: (modification stamp of the goal set files, ConstraintTable)
+_tables = {}
+
+
+def get_table(folder=None):
+    """
+    The constraint table of the stand-alone goal set files directly in a protocol folder (e.g. QUANTEC.xml and
+    TG101.xml in protocols or protocols/UW). A set name found in several files is taken from the first file only.
+    The table is rebuilt when the protocol index finds a goal set file of the folder added, changed or removed
+    :param folder: protocol folder, ProtocolIndex.protocol_folder if None
+    :return: ConstraintTable
+    """
+    index = ProtocolIndex.get_index()
+    folder = os.path.abspath(index.folder if folder is None else folder)
+    goalsets = [s for s in index.sets(kind='goalset', folder=folder) if s.protocol is None]
+    stamp = tuple((p, index.files[p]['mtime'], index.files[p]['size'])
+                  for p in sorted(set(s.path for s in goalsets)))
+    if folder not in _tables or _tables[folder][0] != stamp:
+        sets = {}
+        for s in goalsets:
+            if s.name not in sets:
+                for element in ProtocolIndex.parse(s.path).findall('set'):
+                    if element.find('name').text == s.name:
+                        sets[s.name] = element
+                        break
+        _tables[folder] = (stamp, ConstraintTable(sets))
+    return _tables[folder][1]
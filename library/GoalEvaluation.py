@@ -0,0 +1,285 @@
+""" Goal Evaluation
+
+    Incremental evaluation of the clinical goals of a plan. Each result is cached with the version of the ROI
+    geometry and of the plan dose it was computed from, so after an ROI edit only the goals on the changed ROIs are
+    evaluated again in RayStation, and goals are not evaluated again when nothing changed. A dose change, e.g. an
+    optimization iteration, changes every goal: all goals are evaluated again, and the ROI and dose fingerprints are
+    not read. The last result of every goal is kept with the time it was evaluated, for the TPO report
+    (WriteTpo.pdf) and the plan evaluation scripts.
+
+    A version is made of a counter, which scripts increment with roi_changed() and dose_changed() when they know
+    what they changed, and a fingerprint read from RayStation: the volume, bounding box and contour state of an ROI,
+    and the dose grid, fractions and beam state (BeamOperations.snapshot_key) of each beamset. The fingerprint also
+    catches changes made by hand in between script calls. Results evaluated without reading the fingerprints are
+    evaluated again the next time the fingerprints are read. Scripts that edit ROI geometry without holding a cache
+    call rois_changed(case, rois), which marks the ROIs as changed in every cache of the case
+    (StructureOperations does so for the ROIs it creates, deletes or moves).
+
+    Example Usage:
+    import GoalEvaluation
+    cache = GoalEvaluation.get_cache(patient=patient, case=case, exam=exam, plan=plan)
+    results = cache.evaluate()
+    plan.PlanOptimizations[0].RunOptimization()
+    cache.dose_changed()
+    results = cache.evaluate()  # All goals are evaluated again, without reading the fingerprints
+    case.PatientModel.RegionsOfInterest['Rectum'].CreateMarginGeometry(...)
+    cache.roi_changed('Rectum')
+    results = cache.evaluate()  # Only the goals on Rectum are evaluated again
+    failed = [r for r in results if r.passed is False]
+
+    Version history:
+    1.0.0 Goal results cached by ROI geometry and dose versions
+    1.0.1 Caches are kept per patient. After dose_changed() the goals are evaluated without reading the ROI and
+          dose fingerprints, which cannot save an evaluation when the dose changed.
+    1.0.2 rois_changed marks ROI edits in the caches of a case
+
+    This program is free software: you can redistribute it and/or modify it under
+    the terms of the GNU General Public License as published by the Free Software
+    Foundation, either version 3 of the License, or (at your option) any later
+    version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT
+    ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+    FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+    """
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.2'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+import time
+import logging
+import collections
+import connect
+import Goals
+import BeamOperations
+
+# Result of one clinical goal: value is None if RayStation could not evaluate the goal, evaluated is a time.time()
+GoalResult = collections.namedtuple('GoalResult', ['roi', 'goal', 'priority', 'value', 'passed', 'evaluated',
+                                                   'roi_version', 'dose_version'])
+
+# Fingerprint of a version whose fingerprint was not read, never equal to a fingerprint read from RayStation
+_unread = ('unread',)
+
+
+def goal_key(function):
+    """
+    Identity of a clinical goal, independent of the RayStation object that holds it
+    :param function: RS evaluation function
+    :return: tuple
+    """
+    g = function.PlanningGoal
+    return (function.ForRegionOfInterest.Name, g.Type, g.GoalCriteria, g.AcceptanceLevel, g.ParameterValue,
+            g.Priority)
+
+
+def roi_fingerprint(case, exam, roi):
+    """
+    State of an ROI geometry: contour presence, volume and bounding box
+    :param case: RS case
+    :param exam: RS exam
+    :param roi: ROI name
+    :return: tuple, None if the ROI has no contours
+    """
+    try:
+        geometry = case.PatientModel.StructureSets[exam.Name].RoiGeometries[roi]
+        if not geometry.HasContours():
+            return None
+        box = tuple((c.x, c.y, c.z) for c in geometry.GetBoundingBox())
+        return geometry.GetRoiVolume(), box
+
+    except Exception as e:
+        logging.debug('Geometry of {} could not be read: {}'.format(roi, e))
+        return None
+
+
+def dose_fingerprint(plan):
+    """
+    State of the plan dose: for each beamset, whether dose is computed, the dose grid, the number of fractions
+    and the state of each beam
+    :param plan: RS plan
+    :return: tuple
+    """
+    state = []
+    for b in plan.BeamSets:
+        try:
+            computed = b.FractionDose.DoseValues is not None
+        except Exception:
+            computed = None
+        try:
+            grid = b.GetDoseGrid()
+            grid = (grid.VoxelSize.x, grid.VoxelSize.y, grid.VoxelSize.z,
+                    grid.NrVoxels.x, grid.NrVoxels.y, grid.NrVoxels.z)
+        except Exception:
+            grid = None
+        try:
+            fractions = b.FractionationPattern.NumberOfFractions
+        except AttributeError:
+            fractions = None
+        state.append((b.DicomPlanLabel, computed, grid, fractions,
+                      tuple(BeamOperations.snapshot_key(beam) for beam in b.Beams)))
+    return tuple(state)
+
+
+class GoalEvaluationCache(object):
+    """
+    Clinical goal results of a plan, evaluated again only when the ROI geometry or the dose they depend on changes
+    """
+
+    def __init__(self, case, exam, plan, fingerprint=True):
+        """
+        :param case: RS case
+        :param exam: RS exam of the structure set the goals are evaluated on
+        :param plan: RS plan
+        :param fingerprint: read ROI and dose fingerprints from RayStation, if False only the counters are used
+        """
+        self.case = case
+        self.exam = exam
+        self.plan = plan
+        self.fingerprint = fingerprint
+        self.results = collections.OrderedDict()
+        self.evaluations = 0
+        self._roi_counters = {}
+        self._dose_counter = 0
+        self._evaluated_dose_counter = 0
+
+    def roi_changed(self, roi=None):
+        """
+        Marks the geometry of an ROI as changed
+        :param roi: ROI name, all ROIs if None
+        """
+        for r in [roi] if roi is not None else list(self._roi_counters) + [None]:
+            self._roi_counters[r] = self._roi_counters.get(r, 0) + 1
+
+    def dose_changed(self):
+        """
+        Marks the plan dose as changed, e.g. after an optimization iteration or dose computation
+        """
+        self._dose_counter += 1
+
+    def roi_version(self, roi, read=True):
+        """
+        :param roi: ROI name
+        :param read: read the fingerprint from RayStation
+        :return: version of the ROI geometry
+        """
+        counter = (self._roi_counters.get(roi, 0), self._roi_counters.get(None, 0))
+        if not self.fingerprint:
+            return counter, None
+        return counter, roi_fingerprint(self.case, self.exam, roi) if read else _unread
+
+    def dose_version(self, read=True):
+        """
+        :param read: read the fingerprint from RayStation
+        :return: version of the plan dose
+        """
+        if not self.fingerprint:
+            return self._dose_counter, None
+        return self._dose_counter, dose_fingerprint(self.plan) if read else _unread
+
+    def evaluate(self, functions=None):
+        """
+        Evaluates the clinical goals whose ROI geometry or dose changed since their last evaluation. After
+        dose_changed() every goal is evaluated and the fingerprints are not read.
+        :param functions: RS evaluation functions, all clinical goals of the plan if None
+        :return: list of GoalResult in the order of functions
+        """
+        if functions is None:
+            functions = list(self.plan.TreatmentCourse.EvaluationSetup.EvaluationFunctions)
+        # With a known dose change no cached result can be used, so the fingerprints would not save an evaluation
+        read = self._dose_counter == self._evaluated_dose_counter
+        self._evaluated_dose_counter = self._dose_counter
+        dose_version = self.dose_version(read=read)
+        roi_versions = {}
+        results = []
+        evaluated = 0
+        for f in functions:
+            key = goal_key(f)
+            roi = key[0]
+            if roi not in roi_versions:
+                roi_versions[roi] = self.roi_version(roi, read=read)
+            result = self.results.get(key)
+            if not read or result is None or result.roi_version != roi_versions[roi] or \
+                    result.dose_version != dose_version:
+                result = self._evaluate(f, roi, roi_versions[roi], dose_version)
+                self.results[key] = result
+                evaluated += 1
+            results.append(result)
+
+        self.evaluations += evaluated
+        logging.debug('{} of {} clinical goals evaluated, the others were unchanged'.format(evaluated,
+                                                                                            len(functions)))
+        return results
+
+    def result(self, function):
+        """
+        Last result of a clinical goal, without evaluating it
+        :param function: RS evaluation function
+        :return: GoalResult, None if the goal was never evaluated
+        """
+        return self.results.get(goal_key(function))
+
+    def _evaluate(self, function, roi, roi_version, dose_version):
+        try:
+            value = function.GetClinicalGoalValue()
+            passed = bool(function.EvaluateClinicalGoal())
+
+        except Exception as e:
+            logging.debug('Clinical goal {} on {} could not be evaluated: {}'.format(
+                Goals.print_goal(function, 'eval'), roi, e))
+            value = None
+            passed = None
+
+        return GoalResult(roi=roi, goal=Goals.print_goal(function, 'eval'), priority=function.PlanningGoal.Priority,
+                          value=value, passed=passed, evaluated=time.time(), roi_version=roi_version,
+                          dose_version=dose_version)
+
+
+# Caches of this session by patient ID, case, examination and plan name
+_caches = {}
+
+
+def _patient_id():
+    try:
+        return connect.get_current('Patient').PatientID
+    except Exception:
+        return None
+
+
+def get_cache(patient, case, exam, plan, fingerprint=True):
+    """
+    The goal evaluation cache of a plan in this session
+    :param patient: RS patient
+    :param case: RS case
+    :param exam: RS exam
+    :param plan: RS plan
+    :param fingerprint: see GoalEvaluationCache
+    :return: GoalEvaluationCache
+    """
+    key = (patient.PatientID, case.CaseName, exam.Name, plan.Name)
+    if key not in _caches:
+        _caches[key] = GoalEvaluationCache(case=case, exam=exam, plan=plan, fingerprint=fingerprint)
+    else:
+        # Scripts get new RayStation objects on every run
+        _caches[key].case, _caches[key].exam, _caches[key].plan = case, exam, plan
+    return _caches[key]
+
+
+def rois_changed(case, rois=None):
+    """
+    Marks ROI geometries as changed in every goal evaluation cache of a case of the current patient
+    :param case: RS case
+    :param rois: ROI name or list of ROI names, all ROIs if None
+    """
+    if rois is not None and not isinstance(rois, list):
+        rois = [rois]
+    patient_id = _patient_id()
+    for key, cache in _caches.items():
+        if key[0] == patient_id and key[1] == case.CaseName:
+            for r in rois if rois is not None else [None]:
+                cache.roi_changed(r)
@@ -23,6 +23,13 @@
         print 'Adding goal ' + Goals.print_goal(g, 'xml')
         Goals.add_goal(g, connect.get_current('Plan'))
 
+    Goal elements are compiled once into Goal records, which both functions also accept. Lists of goals can be
+    compiled, printed or added in one call with compile_goals(), print_goals() and add_goals().
+
+    goals = Goals.compile_goals(tree.findall('//goals/roi'))
+    print '\n'.join(filter(None, Goals.print_goals(goals)))
+    Goals.add_goals(goals, connect.get_current('Plan'), rois={'PTV': 'PTV_7000'})
+
     This program is free software: you can redistribute it and/or modify it under
     the terms of the GNU General Public License as published by the Free Software
     Foundation, either version 3 of the License, or (at your option) any later version.
@@ -37,7 +44,7 @@
 
 __author__ = 'Mark Geurts'
 __contact__ = 'mark.w.geurts@gmail.com'
-__version__ = '1.0.0'
+__version__ = '1.1.0'
 __license__ = 'GPLv3'
 __help__ = 'https://github.com/wrssc/ray_scripts/wiki/Protocol-XMLs'
 __copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
@@ -45,375 +52,266 @@ __copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
 import logging
 
 
-def print_goal(goal, goal_type='eval'):
-    left = None
-    symbol = None
-    right = None
-
-    if goal_type == 'xml':
-        if goal.find('type').text == 'DX':
-            if 'type' in goal.find('volume').attrib and goal.find('volume').attrib['type'] == 'residual':
-                left = 'DC{}{}'.format(goal.find('volume').text, goal.find('volume').attrib['units'])
-
-            else:
-                left = 'D{}{}'.format(goal.find('volume').text, goal.find('volume').attrib['units'])
-
-            if 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'le':
-                symbol = '&le;'
-
-            elif 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'lt':
-                symbol = '&lt;'
-
-            elif 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'ge':
-                symbol = '&ge;'
-
-            elif 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'gt':
-                symbol = '&gt;'
-
-            if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-                right = '{}%'.format(goal.find('dose').text)
-
-            else:
-                right = '{} Gy'.format(goal.find('dose').text)
-
-        elif goal.find('type').text == 'VX':
-            if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-                left = 'V{}%'.format(goal.find('dose').text)
-
-            else:
-                left = 'V{}Gy'.format(goal.find('dose').text)
-
-            if 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'le':
-                symbol = '&le;'
-
-            elif 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'lt':
-                symbol = '&lt;'
-
-            elif 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'ge':
-                symbol = '&ge;'
-
-            elif 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'gt':
-                symbol = '&gt;'
-
-            right = '{}{}'.format(goal.find('volume').text, goal.find('volume').attrib['units'])
-
-        elif goal.find('type').text == 'Max':
-            left = 'Max'
-            if 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'le':
-                symbol = '&le;'
-
-            else:
-                symbol = '&lt;'
-
-            if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-                right = '{}%'.format(goal.find('dose').text)
-
-            else:
-                right = '{} Gy'.format(goal.find('dose').text)
-
-        elif goal.find('type').text == 'Min':
-            left = 'Min'
-            if 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'ge':
-                symbol = '&ge;'
-
-            else:
-                symbol = '&gt;'
-
-            if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-                right = '{}%'.format(goal.find('dose').text)
-
-            else:
-                right = '{} Gy'.format(goal.find('dose').text)
-
-        elif goal.find('type').text == 'Mean':
-            left = 'Mean'
-            if 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'le':
-                symbol = '&le;'
-
-            elif 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'lt':
-                symbol = '&lt;'
-
-            elif 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'ge':
-                symbol = '&ge;'
+class Goal(object):
+    """
+    A clinical goal compiled once from a protocol <roi> goal element. Text values are kept as written in the
+    protocol so that they print unchanged, and missing elements or attributes are None.
+    """
+    __slots__ = ('roi', 'type', 'direction', 'dose', 'dose_units', 'dose_roi', 'volume', 'volume_units',
+                 'volume_type', 'index', 'priority', 'fractions')
+
+    def __init__(self, element):
+        """
+        :param element: ElementTree goal element
+        """
+        self.roi = _text(element, 'name')
+        self.type = _text(element, 'type')
+        self.direction = _attribute(element, 'type', 'dir')
+        self.dose = _text(element, 'dose')
+        self.dose_units = _attribute(element, 'dose', 'units')
+        self.dose_roi = _attribute(element, 'dose', 'roi')
+        self.volume = _text(element, 'volume')
+        self.volume_units = _attribute(element, 'volume', 'units')
+        self.volume_type = _attribute(element, 'volume', 'type')
+        self.index = _text(element, 'index')
+        priority = _text(element, 'priority')
+        self.priority = int(priority) if priority is not None else None
+        fractions = _text(element, 'fractions')
+        self.fractions = int(fractions) if fractions is not None else None
+
+    def __repr__(self):
+        return 'Goal({}, {})'.format(self.roi, print_goal(self, 'xml'))
+
+
+def _text(element, tag):
+    child = element.find(tag)
+    return child.text if child is not None else None
+
+
+def _attribute(element, tag, attribute):
+    child = element.find(tag)
+    return child.attrib.get(attribute) if child is not None else None
+
+
+def compile_goal(goal):
+    """
+    Compiles a goal element into a Goal, Goals are returned unchanged
+    :param goal: ElementTree goal element or Goal
+    :return: Goal
+    """
+    return goal if isinstance(goal, Goal) else Goal(goal)
 
-            elif 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'gt':
-                symbol = '&gt;'
 
-            if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-                right = '{}%'.format(goal.find('dose').text)
+def compile_goals(goals):
+    """
+    Compiles a list of goal elements
+    :param goals: list of ElementTree goal elements or Goals
+    :return: list of Goal
+    """
+    return [compile_goal(g) for g in goals]
 
-            else:
-                right = '{} Gy'.format(goal.find('dose').text)
 
-        elif goal.find('type').text == 'CI':
-            if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-                left = 'CI{}%'.format(goal.find('dose').text)
+# Symbols of the type dir attribute
+_symbols = {'le': '&le;', 'lt': '&lt;', 'ge': '&ge;', 'gt': '&gt;'}
 
-            else:
-                left = 'CI{}Gy'.format(goal.find('dose').text)
 
-            if 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'ge':
-                symbol = '&ge;'
+def _symbol(goal, default=None, allowed=('le', 'lt', 'ge', 'gt')):
+    return _symbols[goal.direction] if goal.direction in allowed else default
 
-            else:
-                symbol = '&gt;'
 
-            right = goal.find('index').text
+def _dose_text(goal, separator=' '):
+    return '{}%'.format(goal.dose) if goal.dose_units == '%' else '{}{}Gy'.format(goal.dose, separator)
 
-        elif goal.find('type').text == 'HI':
-            left = 'HI{}%'.format(goal.find('volume').text)
-            if 'dir' in goal.find('type').attrib and goal.find('type').attrib['dir'] == 'ge':
-                symbol = '&ge;'
 
-            else:
-                symbol = '&gt;'
+# Formatting of each protocol goal type, returning the left side, symbol and right side of the goal text
+_xml_formats = {
+    'DX': lambda g: ('{}{}{}'.format('DC' if g.volume_type == 'residual' else 'D', g.volume, g.volume_units),
+                     _symbol(g), _dose_text(g)),
+    'VX': lambda g: ('V' + _dose_text(g, ''), _symbol(g), '{}{}'.format(g.volume, g.volume_units)),
+    'Max': lambda g: ('Max', _symbol(g, '&lt;', ('le',)), _dose_text(g)),
+    'Min': lambda g: ('Min', _symbol(g, '&gt;', ('ge',)), _dose_text(g)),
+    'Mean': lambda g: ('Mean', _symbol(g), _dose_text(g)),
+    'CI': lambda g: ('CI' + _dose_text(g, ''), _symbol(g, '&gt;', ('ge',)), g.index),
+    'HI': lambda g: ('HI{}%'.format(g.volume), _symbol(g, '&gt;', ('ge',)), g.index)
+}
 
-            right = goal.find('index').text
 
-        if left is not None:
-            return '{} {} {}'.format(left, symbol, right)
+def print_goal(goal, goal_type='eval'):
+    """
+    TG-263 compliant text of a goal
+    :param goal: ElementTree goal element or Goal if goal_type is xml, RayStation evaluation function if eval
+    :param goal_type: xml or eval
+    :return: goal text, None if the goal type is not supported
+    """
+    if goal_type == 'xml':
+        goal = compile_goal(goal)
+        if goal.type in _xml_formats:
+            return '{} {} {}'.format(*_xml_formats[goal.type](goal))
 
         else:
             return None
 
     elif goal_type == 'eval':
-        text = None
-        if goal.PlanningGoal.Type == 'VolumeAtDose':
-            if goal.PlanningGoal.GoalCriteria == 'AtMost':
-                text = 'V{}Gy &lt; {}%'.format(goal.PlanningGoal.ParameterValue / 100,
-                                             goal.PlanningGoal.AcceptanceLevel * 100)
-
-            else:
-                text = 'V{}Gy &gt; {}%'.format(goal.PlanningGoal.ParameterValue / 100,
-                                             goal.PlanningGoal.AcceptanceLevel * 100)
-
-        elif goal.PlanningGoal.Type == 'AbsoluteVolumeAtDose':
-            if goal.PlanningGoal.GoalCriteria == 'AtMost':
-                text = 'V{}Gy &lt; {}cc'.format(goal.PlanningGoal.ParameterValue / 100,
-                                              goal.PlanningGoal.AcceptanceLevel)
-
-            else:
-                text = 'V{}Gy &gt; {}cc'.format(goal.PlanningGoal.ParameterValue / 100,
-                                              goal.PlanningGoal.AcceptanceLevel)
-
-        elif goal.PlanningGoal.Type == 'DoseAtVolume':
-            if goal.PlanningGoal.GoalCriteria == 'AtMost':
-                text = 'D{}% &lt; {} Gy'.format(goal.PlanningGoal.ParameterValue * 100,
-                                                goal.PlanningGoal.AcceptanceLevel / 100)
-            else:
-                text = 'D{}% &gt; {} Gy'.format(goal.PlanningGoal.ParameterValue * 100,
-                                                goal.PlanningGoal.AcceptanceLevel / 100)
-
-        elif goal.PlanningGoal.Type == 'DoseAtAbsoluteVolume':
-            if goal.PlanningGoal.GoalCriteria == 'AtMost':
-                text = 'D{}cc &lt; {} Gy'.format(goal.PlanningGoal.ParameterValue,
-                                                 goal.PlanningGoal.AcceptanceLevel / 100)
-            else:
-                text = 'D{}cc &gt; {} Gy'.format(goal.PlanningGoal.ParameterValue,
-                                                 goal.PlanningGoal.AcceptanceLevel / 100)
-
-        elif goal.PlanningGoal.Type == 'AverageDose':
-            if goal.PlanningGoal.GoalCriteria == 'AtMost':
-                text = 'Mean &lt; {} Gy'.format(goal.PlanningGoal.AcceptanceLevel / 100)
-
-            else:
-                text = 'Mean &gt; {} Gy'.format(goal.PlanningGoal.AcceptanceLevel / 100)
-
-        elif goal.PlanningGoal.Type == 'ConformityIndex':
-            text = 'CI{}Gy &gt; {} '.format(goal.PlanningGoal.ParameterValue / 100, goal.PlanningGoal.AcceptanceLevel)
+        g = goal.PlanningGoal
+        if g.Type in _eval_formats:
+            at_most, at_least, values = _eval_formats[g.Type]
+            return (at_most if g.GoalCriteria == 'AtMost' else at_least).format(*values(g))
 
-        elif goal.PlanningGoal.Type == 'HomogeneityIndex':
-            text = 'HI{}% &gt; {} '.format(goal.PlanningGoal.ParameterValue * 100, goal.PlanningGoal.AcceptanceLevel)
-
-        return text
+        else:
+            return None
 
 
-def add_goal(goal, plan, roi=None, targets=None, exam=None, case=None):
+def goal_endpoint(goal):
+    """
+    Endpoint of a goal, the left side of its TG-263 text, e.g. Max, Mean, D0.2cc or V20Gy
+    :param goal: ElementTree goal element or Goal
+    :return: endpoint text, None if the goal type is not supported
+    """
+    goal = compile_goal(goal)
+    return _xml_formats[goal.type](goal)[0] if goal.type in _xml_formats else None
+
+
+# Formatting of each RayStation planning goal type: the AtMost format, the AtLeast format and the values
+_eval_formats = {
+    'VolumeAtDose': ('V{}Gy &lt; {}%', 'V{}Gy &gt; {}%',
+                     lambda g: (g.ParameterValue / 100, g.AcceptanceLevel * 100)),
+    'AbsoluteVolumeAtDose': ('V{}Gy &lt; {}cc', 'V{}Gy &gt; {}cc',
+                             lambda g: (g.ParameterValue / 100, g.AcceptanceLevel)),
+    'DoseAtVolume': ('D{}% &lt; {} Gy', 'D{}% &gt; {} Gy',
+                     lambda g: (g.ParameterValue * 100, g.AcceptanceLevel / 100)),
+    'DoseAtAbsoluteVolume': ('D{}cc &lt; {} Gy', 'D{}cc &gt; {} Gy',
+                             lambda g: (g.ParameterValue, g.AcceptanceLevel / 100)),
+    'AverageDose': ('Mean &lt; {} Gy', 'Mean &gt; {} Gy', lambda g: (g.AcceptanceLevel / 100,)),
+    'ConformityIndex': ('CI{}Gy &gt; {} ', 'CI{}Gy &gt; {} ', lambda g: (g.ParameterValue / 100, g.AcceptanceLevel)),
+    'HomogeneityIndex': ('HI{}% &gt; {} ', 'HI{}% &gt; {} ', lambda g: (g.ParameterValue * 100, g.AcceptanceLevel))
+}
+
+
+def print_goals(goals, goal_type='xml'):
+    """
+    Texts of a list of goals, see print_goal
+    :param goals: list of ElementTree goal elements or Goals if goal_type is xml, evaluation functions if eval
+    :param goal_type: xml or eval
+    :return: list of goal texts
+    """
+    if goal_type == 'xml':
+        goals = compile_goals(goals)
 
-    if roi is None:
-        roi = goal.find('name').text
+    return [print_goal(g, goal_type) for g in goals]
 
-    if targets is None:
-        targets = {}
 
-    # If this is a VX goal
-    if goal.find('type').text == 'VX':
+def _criteria(goal):
+    # RayStation doesn't distinguish greater than from greater than or equal to
+    return 'AtLeast' if goal.direction in ('gt', 'ge') else 'AtMost'
 
-        # If greater than or greater than or equal to (RS doesn't distinguish)
-        if 'dir' in goal.find('type').attrib and \
-                (goal.find('type').attrib['dir'] == 'gt' or goal.find('type').attrib['dir'] == 'ge'):
-            criteria = 'AtLeast'
 
-        else:
-            criteria = 'AtMost'
+def _absolute_volume(goal):
+    return goal.volume_units == 'cc' or float(goal.volume) > 100
 
-        # If this is an absolute volume at dose goal
-        if ('units' in goal.find('volume').attrib and goal.find('volume').attrib['units'] == 'cc') \
-                or float(goal.find('volume').text) > 100:
-            goal_type = 'AbsoluteVolumeAtDose'
-            acceptance = float(goal.find('volume').text)
 
-        # Otherwise, assume this is a volume at dose goal
-        else:
-            goal_type = 'VolumeAtDose'
-            acceptance = float(goal.find('volume').text) / 100
+def _roi_volume(roi, exam, case):
+    return case.PatientModel.StructureSets[exam.Name].RoiGeometries[roi].GetRoiVolume()
 
-        if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-            if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['roi'] in targets:
-                parameter = float(goal.find('dose').text) * \
-                            sum(targets[goal.find('dose').attrib['roi']]['dose'])
 
-            else:
-                logging.debug('Goal {} type {} skipped as reference ROI not used'.format(goal.find('name').text,
-                                                                                         goal.find('type').text))
-                return False
+def _dose(goal, targets):
+    """
+    Dose of a goal in cGy, relative doses are scaled by the dose of the referenced target
+    :return: dose, None if the referenced target is not used
+    """
+    if goal.dose_units == '%':
+        if goal.dose_roi in targets:
+            return float(goal.dose) * sum(targets[goal.dose_roi]['dose'])
 
         else:
-            parameter = float(goal.find('dose').text) * 100
-
-    elif goal.find('type').text == 'DX':
-        if 'dir' in goal.find('type').attrib and \
-                (goal.find('type').attrib['dir'] == 'gt' or goal.find('type').attrib['dir'] == 'ge'):
-            criteria = 'AtLeast'
+            return None
 
-        else:
-            criteria = 'AtMost'
+    return float(goal.dose) * 100
 
-        if ('units' in goal.find('volume').attrib and goal.find('volume').attrib['units'] == 'cc') \
-                or float(goal.find('volume').text) > 100:
 
-            goal_type = 'DoseAtAbsoluteVolume'
-            if 'type' in goal.find('volume').attrib and goal.find('volume').attrib['type'] == 'residual' \
-                    and exam is not None and case is not None:
-                parameter = max(case.PatientModel.StructureSets[exam.Name].RoiGeometries.GetRoiVolume -
-                                float(goal.find('volume').text), 0)
+def _vx_goal(goal, roi, targets, exam, case):
+    if _absolute_volume(goal):
+        goal_type, acceptance = 'AbsoluteVolumeAtDose', float(goal.volume)
 
-            else:
-                parameter = float(goal.find('volume').text)
+    else:
+        goal_type, acceptance = 'VolumeAtDose', float(goal.volume) / 100
 
-        else:
-            goal_type = 'DoseAtVolume'
-            parameter = float(goal.find('volume').text) / 100
-
-        if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-            if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['roi'] in targets:
-                acceptance = float(goal.find('dose').text) * \
-                             sum(targets[goal.find('dose').attrib['roi']]['dose'])
-            else:
-                logging.debug('Goal {} type {} skipped as reference ROI not used'.format(goal.find('name').text,
-                                                                                         goal.find('type').text))
-                return False
+    return _criteria(goal), goal_type, acceptance, _dose(goal, targets)
 
-        else:
-            acceptance = float(goal.find('dose').text) * 100
 
-    elif goal.find('type').text == 'Max':
-        criteria = 'AtMost'
+def _dx_goal(goal, roi, targets, exam, case):
+    if _absolute_volume(goal):
         goal_type = 'DoseAtAbsoluteVolume'
-        if goal.find('volume') is not None:
-            parameter = float(goal.find('volume').text)
+        if goal.volume_type == 'residual' and exam is not None and case is not None:
+            parameter = max(_roi_volume(roi, exam, case) - float(goal.volume), 0)
 
         else:
-            parameter = 0.03
+            parameter = float(goal.volume)
 
-        if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-            if 'roi' in goal.find('dose').attrib and goal.find('dose').attrib['roi'] in targets:
-                acceptance = float(goal.find('dose').text) * \
-                             sum(targets[goal.find('dose').attrib['roi']]['dose'])
+    else:
+        goal_type, parameter = 'DoseAtVolume', float(goal.volume) / 100
 
-            else:
-                logging.debug('Goal {} type {} skipped as reference ROI not used'.format(goal.find('name').text,
-                                                                                         goal.find('type').text))
-                return False
+    return _criteria(goal), goal_type, _dose(goal, targets), parameter
 
-        else:
-            acceptance = float(goal.find('dose').text) * 100
 
-    elif goal.find('type').text == 'Min':
-        criteria = 'AtLeast'
-        goal_type = 'DoseAtAbsoluteVolume'
-        if goal.find('volume') is not None:
-            diff = float(goal.find('volume').text)
+def _max_goal(goal, roi, targets, exam, case):
+    parameter = float(goal.volume) if goal.volume is not None else 0.03
+    return 'AtMost', 'DoseAtAbsoluteVolume', _dose(goal, targets), parameter
 
-        else:
-            diff = 0.03
 
-        if case is not None and exam is not None:
-            parameter = max(0, case.PatientModel.StructureSets[exam.Name].RoiGeometries.GetRoiVolume - diff)
+def _min_goal(goal, roi, targets, exam, case):
+    diff = float(goal.volume) if goal.volume is not None else 0.03
+    parameter = max(0, _roi_volume(roi, exam, case) - diff) if case is not None and exam is not None else None
+    return 'AtLeast', 'DoseAtAbsoluteVolume', _dose(goal, targets), parameter
 
-        else:
-            parameter = None
 
-        if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-            if 'roi' in goal.find('dose').attrib and goal.find('dose').attrib['roi'] in targets:
-                acceptance = float(goal.find('dose').text) * \
-                             sum(targets[goal.find('dose').attrib['roi']]['dose'])
+def _mean_goal(goal, roi, targets, exam, case):
+    return _criteria(goal), 'AverageDose', _dose(goal, targets), None
 
-            else:
-                logging.debug('Goal {} type {} skipped as reference ROI not used'.format(goal.find('name').text,
-                                                                                         goal.find('type').text))
-                return False
 
-        else:
-            acceptance = float(goal.find('dose').text) * 100
+def _ci_goal(goal, roi, targets, exam, case):
+    return 'AtLeast', 'ConformityIndex', float(goal.index), _dose(goal, targets)
 
-    elif goal.find('type').text == 'Mean':
-        goal_type = 'AverageDose'
-        parameter = None
-        if 'dir' in goal.find('type').attrib and \
-                (goal.find('type').attrib['dir'] == 'gt' or goal.find('type').attrib['dir'] == 'ge'):
-            criteria = 'AtLeast'
 
-        else:
-            criteria = 'AtMost'
+def _hi_goal(goal, roi, targets, exam, case):
+    return 'AtLeast', 'HomogeneityIndex', float(goal.index), float(goal.volume) / 100
 
-        if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-            if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['roi'] in targets:
-                acceptance = float(goal.find('dose').text) * \
-                             sum(targets[goal.find('dose').attrib['roi']]['dose'])
 
-            else:
-                logging.debug('Goal {} type {} skipped as reference ROI not used'.format(goal.find('name').text,
-                                                                                         goal.find('type').text))
-                return False
+# RayStation clinical goal of each protocol goal type: (criteria, goal type, acceptance level, parameter value)
+_clinical_goals = {'VX': _vx_goal, 'DX': _dx_goal, 'Max': _max_goal, 'Min': _min_goal, 'Mean': _mean_goal,
+                   'CI': _ci_goal, 'HI': _hi_goal}
 
-        else:
-            acceptance = float(goal.find('dose').text) * 100
-
-    elif goal.find('type').text == 'CI':
-        criteria = 'AtLeast'
-        goal_type = 'ConformityIndex'
-        acceptance = float(goal.find('index').text)
-
-        if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['units'] == '%':
-            if 'units' in goal.find('dose').attrib and goal.find('dose').attrib['roi'] in targets:
-                parameter = float(goal.find('dose').text) * \
-                            sum(targets[goal.find('dose').attrib['roi']]['dose'])
-            else:
-                logging.debug('Goal {} type {} skipped as reference ROI not used'.format(goal.find('name').text,
-                                                                                         goal.find('type').text))
-                return False
+# Goal types whose dose is the parameter value rather than the acceptance level
+_dose_parameters = ('VX', 'CI')
 
-        else:
-            parameter = float(goal.find('dose').text) * 100
 
-    elif goal.find('type').text == 'HI':
-        criteria = 'AtLeast'
-        goal_type = 'HomogeneityIndex'
-        acceptance = float(goal.find('index').text)
-        parameter = float(goal.find('volume').text) / 100
+def add_goal(goal, plan, roi=None, targets=None, exam=None, case=None):
+    """
+    Adds a protocol goal to the clinical goals of a plan
+    :param goal: ElementTree goal element or Goal
+    :param plan: RayStation plan
+    :param roi: plan ROI name, the goal ROI name if None
+    :param targets: {target name: {'dose': list of doses}} used to scale relative doses
+    :param exam: examination, used for residual volume goals
+    :param case: case, used for residual volume goals
+    :return: True if the goal was added
+    """
+    goal = compile_goal(goal)
+    if roi is None:
+        roi = goal.roi
 
-    else:
-        logging.warning('Unknown goal type {} for structure {}'.format(goal.find('type').text,
-                                                                       goal.find('name').text))
-        return False
+    if targets is None:
+        targets = {}
 
-    if goal.find('priority') is not None:
-        priority = int(goal.find('priority').text)
+    if goal.type not in _clinical_goals:
+        logging.warning('Unknown goal type {} for structure {}'.format(goal.type, goal.roi))
+        return False
 
-    else:
-        priority = 1
+    criteria, goal_type, acceptance, parameter = _clinical_goals[goal.type](goal, roi, targets, exam, case)
+    if (parameter if goal.type in _dose_parameters else acceptance) is None:
+        logging.debug('Goal {} type {} skipped as reference ROI not used'.format(goal.roi, goal.type))
+        return False
 
+    priority = goal.priority if goal.priority is not None else 1
     logging.debug('Adding {} constraint {}, {}, {}, {}, priority {}'.
                   format(roi, criteria, goal_type, acceptance, parameter, priority))
 
@@ -441,3 +339,23 @@ def add_goal(goal, plan, roi=None, targets=None, exam=None, case=None):
         logging.warning('{} constraint {}, {}, {}, {}, priority {} could not be added: {}'.
                         format(roi, criteria, goal_type, acceptance, parameter, priority, str(e).splitlines()[0]))
         return False
+
+
+def add_goals(goals, plan, rois=None, targets=None, exam=None, case=None):
+    """
+    Adds a list of protocol goals to the clinical goals of a plan
+    :param goals: list of ElementTree goal elements or Goals
+    :param plan: RayStation plan
+    :param rois: {goal ROI name: plan ROI name}, goals of other ROIs use the goal ROI name
+    :param targets: {target name: {'dose': list of doses}} used to scale relative doses
+    :param exam: examination, used for residual volume goals
+    :param case: case, used for residual volume goals
+    :return: number of goals added
+    """
+    rois = {} if rois is None else rois
+    added = 0
+    for g in compile_goals(goals):
+        if add_goal(g, plan, roi=rois.get(g.roi, g.roi), targets=targets, exam=exam, case=case):
+            added += 1
+
+    return added
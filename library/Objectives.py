@@ -10,6 +10,7 @@ import logging
 import xml.etree.ElementTree
 import UserInterface
 import StructureOperations
+import ProtocolIndex
 from GeneralOperations import logcrit as logcrit
 
 
@@ -140,35 +141,39 @@ def select_objective_protocol(folder=None, filename=None, order_name=None, proto
             else:
                 logging.debug('No objectives found in {}'.format(o.find('name').text))
     else:
+        # Use the protocol index to find the orders with objectives, only files with elements to return are parsed
+        index = ProtocolIndex.get_index()
         for f in file_list:
             if f.endswith('.xml'):
-                # Parse the xml file
-                tree = xml.etree.ElementTree.parse(os.path.join(path_objectives, f))
+                path = os.path.join(path_objectives, f)
+                records = index.file_records(path)
+                if records is None:
+                    # Not in the protocol folder
+                    records = ProtocolIndex.file_records(path, ProtocolIndex.parse(path).getroot())
                 # Search first for a top level objectiveset
-                if tree.getroot().tag == 'objectiveset':
-                    n = tree.find('name').text
+                if records['root'] == 'objectiveset':
+                    n = records['sets'][0].name
                     if n in objective_sets:
                         # objective_sets[n].extend(tree.getroot())
                         logging.debug("Objective set {} already in list".format(n))
                     else:
+                        tree = ProtocolIndex.parse(path)
                         objective_sets[n] = tree
                         et_list.append(tree)
-                elif tree.getroot().tag == 'protocol':
+                elif records['root'] == 'protocol':
                     # Find the objectivesets:
                     # These get loaded for protocols regardless of orders
-                    protocol_obj_set = tree.findall('./objectiveset')
-                    for p in protocol_obj_set:
-                        et_list.append(p)
-                    orders = tree.findall('./order')
+                    if records['sets']:
+                        protocol_obj_set = ProtocolIndex.parse(path).findall('./objectiveset')
+                        for p in protocol_obj_set:
+                            et_list.append(p)
                     # Search the orders to find those with objectives and return the candidates
-                    # for the selectable objectives
-                    for o in orders:
-                        objectives = o.findall('./objectives')
-                        if objectives:
-                            n = o.find('name').text
-                            objective_sets[n] = o
+                    # for the selectable objectives. The order element is only loaded once selected
+                    for o in records['orders']:
+                        if o.objectives:
+                            objective_sets[o.name] = (path, o.name)
                         else:
-                            logging.debug('No objectives found in {}'.format(o.find('name').text))
+                            logging.debug('No objectives found in {}'.format(o.name))
 
     # Augment the list to include all xml files found with an "objectiveset" tag in name
     if order_name is not None:
@@ -196,6 +201,8 @@ def select_objective_protocol(folder=None, filename=None, order_name=None, proto
             logging.debug('User selected order: {} for objectives'.format(
                 input_dialog.values['i']))
             selected_order = objective_sets[input_dialog.values['i']]
+    if isinstance(selected_order, tuple):
+        selected_order = ProtocolIndex.order_element(*selected_order)
     # Add the order to the returned list
     if selected_order is not None:
         et_list.append(selected_order)
@@ -210,256 +217,302 @@ def select_objective_protocol(folder=None, filename=None, order_name=None, proto
     return et_list
 
 
-def reformat_objectives(objective_elements, translation_map=None):
+# RayStation function types of the protocol objective types, DX depends on the direction
+_function_types = {'Max': 'MaxDose',
+                   'Min': 'MinDose',
+                   'UD': 'UniformDose',
+                   'MinEud': 'MinEud',
+                   'MaxEud': 'MaxEud',
+                   'TarEud': 'TargetEud',
+                   'DFO': 'DoseFallOff'}
+_dvh_types = {'ge': 'MinDvh', 'gt': 'MinDvh', 'le': 'MaxDvh', 'lt': 'MaxDvh'}
+
+
+def _boolean(element, tag, attribute, default=False):
+    value = _attribute(element, tag, attribute)
+    if value is None:
+        return default
+    elif value in ('True', 'False'):
+        return value == 'True'
+    else:
+        logging.warning('Unsupported {} specification {}'.format(attribute, value))
+        return default
+
+
+def _text(element, tag):
+    child = element.find(tag)
+    return child.text if child is not None else None
+
+
+def _attribute(element, tag, attribute):
+    child = element.find(tag)
+    return child.attrib.get(attribute) if child is not None else None
+
+
+class Objective(object):
     """
-    This function takes the desired protocol file, order-based keyword?, and a dictionary of mappings
-    dictionary format: key = xml name, value = desired entry
-    :return:
+    An optimization objective resolved once from a protocol <roi> objective element. Doses are absolute in Gy,
+    relative doses being scaled by the reference dose of the matched target, except for the Dose Fall Off low dose
+    which is always in Gy. The element itself is not modified, so the same protocol objectives can be added to
+    several beamsets.
     """
-    # Parse each type in a separate function
-    # Add matching elements
-    # Add objective function should know whether something is absolute or relative for dose and volume
-    # TODO: Go back to planning structs and generate a mapping to be used for OTVs, etc
-    #  but for now, we'll match to the closest suffix
-
-    for objsets in objective_elements:
-        objectives = objsets.findall('./objectives/roi')
-        for o in objectives:
-            o_n = o.find('name').text
-            o_t = o.find('type').text
-            o_d = o.find('dose').text
-            # logging.debug('ROI: {} has a goal of type: {} with a dose level: {}%'.format(
-            #    o_n, o_t, o_d))
-            if o_n in translation_map:
-                s_roi = translation_map[o_n][0]
-                o.find('name').text = s_roi
-            # logging.debug('translation map used {} mapped to {}'.format(
-            #     o_n, s_roi))
-            else:
-                s_roi = None
-
-            if "%" in o.find('dose').attrib['units']:
-                # Define the unmatched and unmodified protocol name and dose
-                o_r = o.find('dose').attrib['roi']
-                # See if the goal is on a matched target and change the % dose of the attributed ROI
-                # to match the user input target and dose level for that named structure
-                # Correct the relative dose to the user-specified dose levels for this structure
-                if o_r in translation_map:
-                    # Change the dose attribute to absolute
-                    # TODO:: these change the xml object, might be needed for datamining project
-                    o.find('dose').attrib['units'] = "Gy"
-                    o.find('dose').attrib['roi'] = translation_map[o_r][0]
-                    s_dose = float(translation_map[o_r][1]) * float(o_d) / 100
-                    o.find('dose').text = str(s_dose)
-                    # logging.debug('Reassigned protocol dose attribute name:' +
-                    #               '{} to {}, for dose:{}% to {} Gy'.format(
-                    #                   o_r, o.find('dose').attrib['roi'], o_d, o.find('dose').text))
-                else:
-                    logging.warning('Unsuccessful match between relative dose goal for ROI: ' +
-                                    '{}. '.format(o_r) +
-                                    'The user did not match an existing roi to one required for this goal. ' +
-                                    'An arbitrary value of 0 may be added')
-                    s_dose = 0
-                    pass
-        return objective_elements
+    __slots__ = ('protocol_roi', 'roi', 'type', 'function_type', 'dose', 'low_dose', 'distance', 'volume',
+                 'volume_units', 'weight', 'constraint', 'adapt', 'robust', 'eud_a')
+
+    def __init__(self, element, roi=None, reference_dose=None, weight=None):
+        """
+        :param element: ElementTree objective element
+        :param roi: plan roi substituted for the protocol roi
+        :param reference_dose: dose in Gy of the matched target, used to resolve relative doses, or the
+                               substitute for an absolute dose
+        :param weight: substitute for the protocol weight
+        """
+        self.protocol_roi = _text(element, 'name')
+        self.roi = roi if roi else self.protocol_roi
+        self.type = _text(element, 'type')
+        if self.type == 'DX':
+            self.function_type = _dvh_types.get(_attribute(element, 'type', 'dir'))
+        else:
+            self.function_type = _function_types.get(self.type)
+        dose = float(_text(element, 'dose'))
+        if _attribute(element, 'dose', 'units') == '%':
+            # Relative doses are undefined without the dose of the referenced target
+            self.dose = dose * float(reference_dose) / 100 if reference_dose is not None else None
+        else:
+            self.dose = float(reference_dose) if reference_dose is not None else dose
+        low_dose = _attribute(element, 'dose', 'low')
+        self.low_dose = float(low_dose) if low_dose is not None else None
+        distance = _attribute(element, 'type', 'dist')
+        self.distance = float(distance) if distance is not None else None
+        self.volume = _text(element, 'volume')
+        self.volume = float(self.volume) if self.volume is not None else None
+        self.volume_units = _attribute(element, 'volume', 'units')
+        self.weight = float(weight) if weight else float(_text(element, 'weight'))
+        self.constraint = _boolean(element, 'type', 'constraint')
+        self.adapt = _boolean(element, 'type', 'adapt')
+        self.robust = _boolean(element, 'type', 'robust')
+        eud_a = _attribute(element, 'type', 'a')
+        self.eud_a = float(eud_a) if eud_a is not None else None
+
+    def __repr__(self):
+        return 'Objective({}, {}, {} Gy, weight {})'.format(self.roi, self.function_type, self.dose, self.weight)
+
+
+def compile_objective(obj, translation_map=None):
+    """
+    Resolves a protocol objective with the translation map of the user matched structures
+    :param obj: objective (roi-tag) ElementTree element, or Objective which is returned unchanged
+    :param translation_map: {protocol roi: [plan roi, dose in Gy]} of the user matched structures
+    :return: Objective, None if its relative dose refers to an unmatched protocol roi
+    """
+    if isinstance(obj, Objective):
+        return obj
+
+    translation_map = {} if translation_map is None else translation_map
+    o_n = obj.find('name').text
+    s_roi = translation_map[o_n][0] if o_n in translation_map else None
+    s_dose = None
+    if '%' in obj.find('dose').attrib['units']:
+        # Relative doses require the referenced protocol roi to have been matched to a plan dose
+        o_r = obj.find('dose').attrib['roi']
+        if o_r not in translation_map:
+            logging.debug('No match found protocol roi: {}, with a relative dose requiring protocol roi: {}'
+                          .format(o_n, o_r))
+            return None
+        s_dose = float(translation_map[o_r][1])
+    return Objective(obj, roi=s_roi, reference_dose=s_dose)
+
+
+def compile_objectives(objectives, translation_map=None):
+    """
+    Resolves a list of protocol objectives in one pass, leaving the ElementTree unchanged
+    :param objectives: list of objective (roi-tag) ElementTree elements or Objectives
+    :param translation_map: {protocol roi: [plan roi, dose in Gy]} of the user matched structures
+    :return: list of Objective, without the objectives whose relative dose could not be resolved
+    """
+    compiled = [compile_objective(o, translation_map=translation_map) for o in objectives]
+    return [o for o in compiled if o is not None]
+
+
+class RoiCache(object):
+    """
+    Contour presence and volume of the ROIs of an examination, each fetched from RayStation at most once
+    """
+
+    def __init__(self, case, exam):
+        """
+        :param case: RS case
+        :param exam: RS exam
+        """
+        self.case = case
+        self.exam = exam
+        self.names = None
+        self._contours = {}
+        self._volumes = {}
+
+    def prefetch(self, rois):
+        """
+        Fetches the contour presence and volume of a list of ROIs in one pass
+        :param rois: list of ROI names
+        """
+        for r in set(rois):
+            self.volume(r)
+
+    def contours(self, roi):
+        """
+        :param roi: ROI name
+        :return: True if the ROI exists and has contours on the examination
+        """
+        if self.names is None:
+            self.names = set(r.Name for r in self.case.PatientModel.RegionsOfInterest)
+        if roi not in self._contours:
+            self._contours[roi] = roi in self.names and \
+                bool(self.case.PatientModel.StructureSets[self.exam.Name].RoiGeometries[roi].HasContours())
+        return self._contours[roi]
+
+    def volume(self, roi):
+        """
+        :param roi: ROI name
+        :return: volume of the ROI in cc, None if it has no contours or the volume is undefined
+        """
+        if roi not in self._volumes:
+            self._volumes[roi] = None
+            try:
+                if self.contours(roi):
+                    self._volumes[roi] = self.case.PatientModel.StructureSets[self.exam.Name]. \
+                        RoiGeometries[roi].GetRoiVolume()
+            except Exception as e:
+                logging.warning('Error getting volume for {}: {}'.format(roi, e))
+        return self._volumes[roi]
+
+
+def add_objectives(objectives, exam, case, plan, beamset, translation_map=None, restrict_beamset=None,
+                   checking=True):
+    """
+    Adds a list of protocol objectives in one pass. The objectives are compiled with the translation map
+    first, the contours and volumes of all referenced ROIs are then fetched once and the optimization functions
+    are added in a single loop.
+    :param objectives: list of objective (roi-tag) ElementTree elements or compiled Objectives
+    :param exam: RS Exam
+    :param case: RS case
+    :param plan: RS plan
+    :param beamset: RS beamset
+    :param translation_map: {protocol roi: [plan roi, dose in Gy]} of the user matched structures
+    :param restrict_beamset: if co-optimization is used, the beamset the objectives are restricted to
+    :param checking: skip objectives whose plan roi has no contours
+    :return: number of objectives added
+    """
+    compiled = compile_objectives(objectives, translation_map=translation_map)
+    roi_cache = RoiCache(case=case, exam=exam)
+    roi_cache.prefetch([o.roi for o in compiled])
+    plan_optimization = plan.PlanOptimizations[find_optimization_index(plan=plan, beamset=beamset)]
+    added = 0
+    for o in compiled:
+        if add_objective(o, exam=exam, case=case, plan=plan, beamset=beamset, restrict_beamset=restrict_beamset,
+                         checking=checking, roi_cache=roi_cache, plan_optimization=plan_optimization):
+            added += 1
+    logging.debug('Added {} of {} objectives'.format(added, len(objectives)))
+    return added
 
 
 def add_objective(obj, exam, case, plan, beamset,
                   s_roi=None, s_dose=None,
-                  s_weight=None, restrict_beamset=None, checking=False):
+                  s_weight=None, restrict_beamset=None, checking=False, roi_cache=None, plan_optimization=None):
     """
-    adds an objective function to the optimization in RayStation after
-    :param obj: child (roi-tag) of an ElementTree - consider mak
+    adds an objective function to the optimization in RayStation
+    :param obj: child (roi-tag) of an ElementTree, or a compiled Objective
     :param exam: RS Exam
     :param case: RS case
     :param plan: RS plan
     :param beamset: RS beamset
-    :param s_roi: substitute roi for the name tag
+    :param s_roi: substitute roi for the name tag, ignored for an Objective
     :param s_dose: substitute dose for the dose tag, str dose in Gy, this will be used as
-                    reference dose in Dose Fall Off operations
-    :param s_weight: substitute weight from protocol-defined tag, str weight
+                    reference dose in Dose Fall Off operations. Ignored for an Objective
+    :param s_weight: substitute weight from protocol-defined tag, str weight. Ignored for an Objective
     :param restrict_beamset: if co-optimization is used, this is needed to restrict an objective to a
                             given beamset
-    :return: (none) although obj is directly modified by this function
+    :param roi_cache: RoiCache shared between objectives, a new one is used if None
+    :param plan_optimization: optimization of the beamset, found from the plan if None
+    :return: True if the objective was added, the element is not modified
     """
-    # Parse the objectives
-    #
-    # If an roi was specified replace the name tag
+    if not isinstance(obj, Objective):
+        obj = Objective(obj, roi=s_roi, reference_dose=s_dose, weight=s_weight)
+    roi = obj.roi
 
-    if s_roi:
-        protocol_roi = obj.find('name').text
-        roi = s_roi
-        obj.find('name').text = roi
-
-    else:
-        protocol_roi = obj.find('name').text
-        roi = obj.find('name').text
+    if roi_cache is None:
+        roi_cache = RoiCache(case=case, exam=exam)
 
     if checking:
-        roi_check = all(StructureOperations.check_roi(case=case, exam=exam, rois=roi))
-
-        if not roi_check:
+        if not roi_cache.contours(roi):
             logging.warning("Objective skipped for protocol ROI: {} since plan roi {} has no contours".format(
-                protocol_roi, roi))
-            return
+                obj.protocol_roi, roi))
+            return False
 
-    if s_roi:
+    if roi != obj.protocol_roi:
         logging.debug("Objective for protocol ROI: {} substituted with plan ROI: {}".format(
-            protocol_roi, s_roi))
-    #
-    # Deal with relative or absolute volumes, modify the volume tag
-    # (RayStation only allows relative volume roi's
-    # TODO: Check how to find existence of a tag in elementtree
-    # TODO: Clean up the debugging in here to one message
-    if obj.find('volume') is None:
-        volume = None
-    else:
-        # If the user specified an absolute volume convert this into %
-        if obj.find('volume').attrib["units"] == "cc":
-            try:
-                t = case.PatientModel.StructureSets[exam.Name]. \
-                    RoiGeometries[roi]
-                if t.HasContours():
-                    roi_vol = t.GetRoiVolume()
-                    volume = int(float(obj.find('volume').text) / roi_vol)
-                    logging.debug('ROI: {} Protocol volume {} substituted with {}'.format(
-                        obj.find('name').text, obj.find('volume').text, volume))
-                    obj.find('volume').text = str(volume)
-                    obj.find('volume').attrib["units"] = "%"
-                else:
-                    logging.warning('{} has no contours, index undefined'.format(roi))
-            except:
-                logging.warning('Error getting volume for {}, volume => 0.0'.format(roi))
-        elif obj.find('volume').attrib["units"] == "%":
-            volume = int(obj.find('volume').text)
-    # Modify the dose tag if relative
-    if s_dose:
-        if obj.find('dose').attrib["units"] == "%":
-            weighted_dose = float(s_dose) * float(obj.find('dose').text) / 100
-            logging.debug('ROI: {} Protocol dose {} {} substituted with {} Gy'.format(
-                obj.find('name').text, obj.find('dose').text, obj.find('dose').attrib["units"],
-                weighted_dose))
-            obj.find('dose').attrib["units"] = "Gy"
-            # Change the element to the substitute dose times the percentage of the reference
-            obj.find('dose').text = weighted_dose
-            dose = float(obj.find('dose').text) * 100
-        else:
-            logging.debug('ROI: {} Protocol dose {} {} substituted with {} Gy'.format(
-                obj.find('name').text, obj.find('dose').text, obj.find('dose').attrib["units"],
-                s_dose))
-            obj.find('dose').text = float(s_dose) * 100
-            dose = float(obj.find('dose').text) * 100
-    else:
-        dose = float(obj.find('dose').text) * 100
-    #
-    # Read the weight variable
-    if s_weight:
-        logging.debug('ROI: {} Protocol weight {} substituted with {}'.format(
-            obj.find('name').text, obj.find('weight').text, s_weight))
-        obj.find('weight').text = s_weight
-        weight = float(s_weight)
-    else:
-        weight = float(obj.find('weight').text)
-    # Correct type to RS supported naming
-    # If the objective does not require directional evaluation (like those in obj_types)
-    # we can reassign directly. Otherwise, we need to parse direction.
-    obj_types = {'Max': 'MaxDose',
-                 'Min': 'MinDose',
-                 'UD': 'UniformDose',
-                 'MinEud': 'MinEud',
-                 'MaxEud': 'MaxEud',
-                 'TarEud': 'TargetEud',
-                 'DFO': 'DoseFallOff'}
-    if obj.find('type').text in obj_types:
-        function_type = obj_types[obj.find('type').text]
-    elif obj.find('type').text == 'DX':
-        if obj.find('type').attrib['dir'] == "ge" or obj.find('type').attrib['dir'] == "gt":
-            function_type = 'MinDvh'
-        elif obj.find('type').attrib['dir'] == "le" or obj.find('type').attrib['dir'] == "lt":
-            function_type = 'MaxDvh'
-    else:
-        logging.debug('Unsupported function type for ROI: {} with type: {}'.format(
-            obj.find('name').text, obj.find('type').text))
+            obj.protocol_roi, roi))
+
+    if obj.function_type is None:
+        logging.warning('Unsupported function type for ROI: {} with type: {}'.format(roi, obj.type))
+        return False
+
+    if obj.dose is None:
+        logging.warning('Objective skipped for ROI: {} since its relative dose has no reference dose'.format(roi))
+        return False
     #
-    # Add special types
-    if 'Eud' in obj.find('type').text:
-        eud_a = float(obj.find('type').attrib['a'])
-    if 'constraint' not in obj.find('type').attrib:
-        constraint = False
-    else:
-        if obj.find('type').attrib['constraint'] == 'True':
-            constraint = True
-        elif obj.find('type').attrib['constraint'] == 'False':
-            constraint = False
-        else:
-            logging.warning('Unsupported constraint specification {}'.format(
-                obj.find('type').attrib['constraint']))
-    if 'adapt' in obj.find('type').attrib:
-        if obj.find('type').attrib['adapt'] == 'True':
-            adapt_dose = True
-        elif obj.find('type').attrib['adapt'] == 'False':
-            adapt_dose = False
-        else:
-            logging.warning('Unsupported type for attribute {}'.format(
-                obj.find('type').attrib['adapt']))
-    if obj.find('type').text == 'DFO':
-        if obj.find('dose').attrib['units'] == "%":
-            high_dose = 100 * float(s_dose) * float(obj.find('dose').text) / 100
-            low_dose = 100 * float(s_dose) * float(obj.find('dose').attrib['low']) / 100
-        elif obj.find('dose').attrib['units'] == "Gy":
-            high_dose = 100 * float(obj.find('dose').text)
-            low_dose = 100 * float(obj.find('dose').attrib['low'])
-        else:
-            logging.warning('Unsupported doses for Dose Fall Off')
-        if 'dist' in obj.find('type').attrib:
-            low_dose_dist = float(obj.find('type').attrib['dist'])
-        else:
-            logging.warning('Unknown low dose distance for Dose Fall Off')
+    # RayStation only allows relative volumes, absolute volumes are converted into % of the roi volume
+    volume = None
+    if obj.volume is not None:
+        if obj.volume_units == "cc":
+            roi_vol = roi_cache.volume(roi)
+            if roi_vol:
+                volume = int(100 * obj.volume / roi_vol)
+                logging.debug('ROI: {} Protocol volume {} cc substituted with {}%'.format(
+                    roi, obj.volume, volume))
+            else:
+                logging.warning('{} has no contours or volume, index undefined'.format(roi))
+        elif obj.volume_units == "%":
+            volume = int(obj.volume)
+    # Doses in cGy
+    dose = 100 * obj.dose
+
+    if obj.function_type == 'DoseFallOff':
+        if obj.low_dose is None or obj.distance is None:
+            logging.warning('Unknown low dose or low dose distance for Dose Fall Off on ROI: {}'.format(roi))
+            return False
+        high_dose = dose
+        low_dose = 100 * obj.low_dose
         logging.debug('DFO object found.  High Dose: {}, Low Dose: {}, Distance: {}'.format(
-            high_dose, low_dose, low_dose_dist))
-    if 'robust' in obj.find('type').attrib:
-        if obj.find('type').attrib['robust'] == 'False':
-            robust = False
-        elif obj.find('type').attrib['robust'] == 'True':
-            robust = True
-        else:
-            logging.warning('Unsupported robustness type {}'.format(obj.find('type').attrib['robust']))
-    else:
-        robust = False
+            high_dose, low_dose, obj.distance))
 
-    OptIndex = find_optimization_index(plan=plan, beamset=beamset)
-    plan_optimization = plan.PlanOptimizations[OptIndex]
+    if plan_optimization is None:
+        OptIndex = find_optimization_index(plan=plan, beamset=beamset)
+        plan_optimization = plan.PlanOptimizations[OptIndex]
 
     # Add the objective
-    # try:
-
-    o = plan_optimization.AddOptimizationFunction(FunctionType=function_type,
+    o = plan_optimization.AddOptimizationFunction(FunctionType=obj.function_type,
                                                   RoiName=roi,
-                                                  IsConstraint=constraint,
+                                                  IsConstraint=obj.constraint,
                                                   RestrictAllBeamsIndividually=False,
                                                   RestrictToBeam=None,
-                                                  IsRobust=robust,
+                                                  IsRobust=obj.robust,
                                                   RestrictToBeamSet=restrict_beamset,
                                                   UseRbeDose=False)
-    o.DoseFunctionParameters.Weight = weight
+    o.DoseFunctionParameters.Weight = obj.weight
     if volume:
         o.DoseFunctionParameters.PercentVolume = volume
-    if 'Eud' in function_type:
-        o.DoseFunctionParameters.EudParameterA = eud_a
+    if 'Eud' in obj.function_type:
+        o.DoseFunctionParameters.EudParameterA = obj.eud_a
         # Dose fall off type of optimization option.
-    if function_type == 'DoseFallOff':
+    if obj.function_type == 'DoseFallOff':
         o.DoseFunctionParameters.HighDoseLevel = high_dose
         o.DoseFunctionParameters.LowDoseLevel = low_dose
-        o.DoseFunctionParameters.LowDoseDistance = low_dose_dist
-        o.DoseFunctionParameters.AdaptToTargetDoseLevels = adapt_dose
+        o.DoseFunctionParameters.LowDoseDistance = obj.distance
+        o.DoseFunctionParameters.AdaptToTargetDoseLevels = obj.adapt
         # For all types other than DoseFallOff, the dose is simply entered here
     else:
         o.DoseFunctionParameters.DoseLevel = dose
     logging.debug("Added objective for ROI: " +
                   "{}, type {}, dose {}, weight {}, for beamset {} with restriction: {}".format(
-                      roi, function_type, dose, weight, beamset.DicomPlanLabel, restrict_beamset))
-
-# except:
-#     logging.debug("Failed to add objective for ROI:" +
-#                   " {}, type {}, dose {}, weight {}, for beamset {}".format(
-#                       roi, function_type, dose, weight, restrict_beamset))
+                      roi, obj.function_type, dose, obj.weight, beamset.DicomPlanLabel, restrict_beamset))
+    return True
@@ -0,0 +1,548 @@
+""" Offline Evaluation
+
+    Evaluates the clinical goals of a protocol order on exported plans without RayStation. The RTDOSE and
+    RTSTRUCT files of each plan are read from disk, every contour is rasterized onto the dose grid (in-plane partial
+    volumes are resolved by supersampling each voxel) and the cumulative DVH of each ROI is computed from the voxel
+    doses. The goal types of Goals.print_goal (DX, VX, Max, Min, Mean, CI and HI) are evaluated with the same
+    conventions Goals.add_goal uses for RayStation clinical goals, and plans are evaluated in parallel processes.
+
+    Example Usage:
+    import OfflineEvaluation
+    plan = OfflineEvaluation.PlanEvaluation.from_folder('/exports/Patient1')
+    goals = OfflineEvaluation.order_goals('UW Prostate', 'Prostate Only')
+    results = plan.evaluate(goals, rois={'PTV_p': 'PTV_7920'}, targets={'PTV_p': 79.2})
+    doses, volumes = plan.dvh('Rectum').curve()
+    # Many plans, one process per CPU
+    jobs = [{'folder': f, 'protocol': 'UW Prostate', 'order': 'Prostate Only', 'targets': {'PTV_p': 79.2}}
+            for f in folders]
+    for job, results in OfflineEvaluation.evaluate_plans(jobs):
+        ...
+
+    Command line:
+    python OfflineEvaluation.py --protocol "UW Prostate" --order "Prostate Only" --target PTV_p=79.2 \
+        --roi PTV_p=PTV_7920 --protocol-folder ../protocols/UW --output audit.csv /exports/Patient1 /exports/Patient2
+
+    Version history:
+    1.0.0 DVH and clinical goal evaluation of exported RTDOSE and RTSTRUCT files
+    1.0.1 Goals are read from the protocol files of one folder (protocol_folder), not from every folder with a
+          protocol of the same name such as protocols/Retired
+
+    This program is free software: you can redistribute it and/or modify it under
+    the terms of the GNU General Public License as published by the Free Software
+    Foundation, either version 3 of the License, or (at your option) any later
+    version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT
+    ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+    FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+    """
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.1'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+import os
+import sys
+import csv
+import logging
+import argparse
+import collections
+import multiprocessing
+import numpy as np
+import pydicom
+import Goals
+import ProtocolIndex
+
+# Volume in cc used for Max and Min goals without a volume, as in Goals.add_goal
+point_volume = 0.03
+
+# Dose grid in Gy indexed [z, y, x], with the patient coordinates (mm) of the voxel centers along each axis
+DoseGrid = collections.namedtuple('DoseGrid', ['dose', 'x', 'y', 'z'])
+
+# Result of one goal: value and limit are in the goal units (Gy, % or cc, or the index), passed is None when the
+# goal could not be evaluated (e.g. the ROI has no contours or a relative dose references an unmatched target)
+GoalResult = collections.namedtuple('GoalResult', ['roi', 'structure', 'goal', 'value', 'limit', 'units', 'passed'])
+
+
+def read_dose(paths):
+    """
+    Reads the dose of a plan. A PLAN summation is used if present, otherwise the doses (e.g. of each beam) are summed.
+    :param paths: RTDOSE file paths
+    :return: DoseGrid
+    """
+    datasets = [pydicom.dcmread(p) for p in paths]
+    plan_doses = [d for d in datasets if getattr(d, 'DoseSummationType', '') == 'PLAN']
+    datasets = plan_doses[:1] if plan_doses else datasets
+    grid = None
+    for d in datasets:
+        orientation = [float(v) for v in d.ImageOrientationPatient]
+        if not np.allclose(orientation, [1, 0, 0, 0, 1, 0], atol=1e-3):
+            raise ValueError('Dose grid orientation {} is not supported'.format(orientation))
+
+        if getattr(d, 'DoseUnits', 'GY') != 'GY':
+            logging.warning('Dose units of {} are {}, not Gy'.format(d.filename, d.DoseUnits))
+        origin = [float(v) for v in d.ImagePositionPatient]
+        offsets = np.array([float(v) for v in d.GridFrameOffsetVector])
+        # Offsets are relative to the origin if the first is zero, otherwise they are z coordinates
+        z = offsets + origin[2] if offsets[0] == 0 else offsets
+        x = origin[0] + np.arange(d.Columns) * float(d.PixelSpacing[1])
+        y = origin[1] + np.arange(d.Rows) * float(d.PixelSpacing[0])
+        dose = d.pixel_array.reshape(len(z), d.Rows, d.Columns) * float(d.DoseGridScaling)
+        if grid is None:
+            grid = DoseGrid(dose=dose.astype(float), x=x, y=y, z=z)
+        elif dose.shape == grid.dose.shape and np.allclose(origin, [grid.x[0], grid.y[0], grid.z[0]]):
+            grid.dose[...] += dose
+        else:
+            raise ValueError('Dose {} is not on the grid of the other doses of the plan'.format(d.filename))
+
+    return grid
+
+
+def read_structures(path):
+    """
+    Reads the closed planar contours of an RTSTRUCT file
+    :param path: RTSTRUCT file path
+    :return: {ROI name: {z: list of N x 2 arrays of contour x, y points}}
+    """
+    ds = pydicom.dcmread(path)
+    names = dict((r.ROINumber, r.ROIName) for r in ds.StructureSetROISequence)
+    rois = {}
+    for r in getattr(ds, 'ROIContourSequence', []):
+        planes = rois.setdefault(names.get(r.ReferencedROINumber), {})
+        for c in getattr(r, 'ContourSequence', []):
+            if getattr(c, 'ContourGeometricType', 'CLOSED_PLANAR') != 'CLOSED_PLANAR':
+                continue
+            points = np.array([float(v) for v in c.ContourData]).reshape(-1, 3)
+            planes.setdefault(round(points[0, 2], 2), []).append(points[:, :2])
+
+    return rois
+
+
+def find_files(folder):
+    """
+    RTDOSE and RTSTRUCT files of an exported plan
+    :param folder: folder searched recursively
+    :return: (list of RTDOSE paths, RTSTRUCT path or None)
+    """
+    doses = []
+    structures = None
+    for directory, _, names in os.walk(folder):
+        for n in sorted(names):
+            p = os.path.join(directory, n)
+            try:
+                modality = pydicom.dcmread(p, stop_before_pixels=True).Modality
+            except Exception:
+                continue
+            if modality == 'RTDOSE':
+                doses.append(p)
+            elif modality == 'RTSTRUCT' and structures is None:
+                structures = p
+
+    return doses, structures
+
+
+def polygon_mask(xs, ys, polygon):
+    """
+    Even-odd fill of a polygon on a grid of points. Each edge only visits the grid rows it crosses.
+    :param xs: ascending x coordinates of the grid columns
+    :param ys: ascending y coordinates of the grid rows
+    :param polygon: N x 2 array of polygon vertices
+    :return: boolean array [row, column], True inside the polygon
+    """
+    inside = np.zeros((len(ys), len(xs)), dtype=bool)
+    x0, y0 = polygon[:, 0], polygon[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    for a, b, c, d in zip(x0, y0, x1, y1):
+        if b == d:
+            continue
+        # Rows with min(b, d) <= y < max(b, d), so a vertex shared by two edges is crossed once
+        r0, r1 = np.searchsorted(ys, [min(b, d), max(b, d)], 'left')
+        if r0 == r1:
+            continue
+        crossing = a + (ys[r0:r1] - b) * (c - a) / (d - b)
+        inside[r0:r1] ^= xs[np.newaxis, :] < crossing[:, np.newaxis]
+
+    return inside
+
+
+def roi_mask(planes, grid, supersample=4):
+    """
+    Fraction of each dose voxel inside an ROI. Each dose plane uses the contours of the nearest structure plane
+    within half a structure slice, and voxels are divided into supersample x supersample points in plane.
+    :param planes: {z: list of contours} of the ROI, see read_structures
+    :param grid: DoseGrid
+    :param supersample: points per voxel along x and y
+    :return: array [z, y, x] of fractions between 0 and 1
+    """
+    mask = np.zeros(grid.dose.shape)
+    if not planes:
+        return mask
+    zs = np.array(sorted(planes))
+    slice_width = np.min(np.diff(zs)) if len(zs) > 1 else abs(grid.z[1] - grid.z[0]) if len(grid.z) > 1 else 1.
+    dx, dy = grid.x[1] - grid.x[0], grid.y[1] - grid.y[0]
+    offsets = (np.arange(supersample) + 0.5) / supersample - 0.5
+    for k, z in enumerate(grid.z):
+        i = np.argmin(np.abs(zs - z))
+        if abs(zs[i] - z) > slice_width / 2. + 1e-3:
+            continue
+        contours = planes[zs[i]]
+        points = np.vstack(contours)
+        # Voxels within the bounding box of the contours
+        c0, c1 = np.searchsorted(grid.x, [points[:, 0].min() - dx, points[:, 0].max() + dx])
+        r0, r1 = np.searchsorted(grid.y, [points[:, 1].min() - dy, points[:, 1].max() + dy])
+        if c0 == c1 or r0 == r1:
+            continue
+        xs = (grid.x[c0:c1, np.newaxis] + offsets * dx).ravel()
+        ys = (grid.y[r0:r1, np.newaxis] + offsets * dy).ravel()
+        inside = np.zeros((len(ys), len(xs)), dtype=bool)
+        for c in contours:
+            # Contours on the same plane are combined even-odd, so inner contours are holes
+            inside ^= polygon_mask(xs, ys, c)
+        mask[k, r0:r1, c0:c1] = inside.reshape(r1 - r0, supersample, c1 - c0, supersample).mean(axis=(1, 3))
+
+    return mask
+
+
+class Dvh(object):
+    """
+    Cumulative dose volume histogram of an ROI, computed from the dose and partial volume of each voxel
+    """
+
+    def __init__(self, dose, volumes):
+        """
+        :param dose: voxel doses in Gy
+        :param volumes: volume in cc of the ROI in each voxel
+        """
+        selected = volumes > 0
+        order = np.argsort(dose[selected], kind='mergesort')
+        self.doses = dose[selected][order]
+        weights = volumes[selected][order]
+        self.volume = float(weights.sum())
+        # Volume below each dose, [0] = 0
+        self._below = np.concatenate(([0.], np.cumsum(weights)))
+        self.min = float(self.doses[0]) if self.volume > 0 else None
+        self.max = float(self.doses[-1]) if self.volume > 0 else None
+        self.mean = float(np.dot(self.doses, weights) / self.volume) if self.volume > 0 else None
+
+    def volume_at_dose(self, dose):
+        """
+        :param dose: dose in Gy
+        :return: volume in cc receiving at least dose
+        """
+        return self.volume - self._below[np.searchsorted(self.doses, dose, 'left')]
+
+    def dose_at_volume(self, volume):
+        """
+        :param volume: volume in cc
+        :return: the highest dose in Gy received by at least volume
+        """
+        if self.volume <= 0:
+            return None
+        # Volume receiving at least doses[i], decreasing with i; the last i where it is at least volume
+        reached = self.volume - self._below[:-1]
+        i = np.searchsorted(-reached, -volume, 'right') - 1
+        return float(self.doses[max(i, 0)])
+
+    def curve(self, bin_width=0.01):
+        """
+        :param bin_width: dose bin width in Gy
+        :return: (doses, volumes) arrays of the cumulative DVH in Gy and cc
+        """
+        doses = np.arange(0., (self.max or 0.) + bin_width, bin_width)
+        return doses, self.volume - self._below[np.searchsorted(self.doses, doses, 'left')]
+
+
+class PlanEvaluation(object):
+    """
+    Dose and structures of one exported plan, with the ROI masks and DVHs computed on first use
+    """
+
+    def __init__(self, grid, structures, supersample=4):
+        """
+        :param grid: DoseGrid
+        :param structures: {ROI name: planes}, see read_structures
+        :param supersample: in plane points per voxel dimension for partial volumes
+        """
+        self.grid = grid
+        self.structures = structures
+        self.supersample = supersample
+        self.voxel_volume = abs(np.diff(grid.x[:2]).sum() * np.diff(grid.y[:2]).sum() *
+                                (np.diff(grid.z[:2]).sum() if len(grid.z) > 1 else 1.)) / 1000.
+        self._dvhs = {}
+        self._isodose = np.sort(grid.dose.ravel())
+
+    @classmethod
+    def from_folder(cls, folder, supersample=4):
+        """
+        :param folder: folder with the RTDOSE and RTSTRUCT files of a plan
+        :param supersample: in plane points per voxel dimension for partial volumes
+        :return: PlanEvaluation
+        """
+        doses, structures = find_files(folder)
+        if not doses or structures is None:
+            raise IOError('{} does not contain both an RTDOSE and an RTSTRUCT file'.format(folder))
+        return cls(read_dose(doses), read_structures(structures), supersample=supersample)
+
+    def dvh(self, roi):
+        """
+        :param roi: ROI name
+        :return: Dvh, None if the ROI has no contours on the dose grid
+        """
+        if roi not in self._dvhs:
+            mask = roi_mask(self.structures.get(roi), self.grid, self.supersample)
+            self._dvhs[roi] = Dvh(self.grid.dose, mask * self.voxel_volume) if mask.any() else None
+        return self._dvhs[roi]
+
+    def isodose_volume(self, dose):
+        """
+        :param dose: dose in Gy
+        :return: volume in cc of the dose grid receiving at least dose
+        """
+        return (len(self._isodose) - np.searchsorted(self._isodose, dose, 'left')) * self.voxel_volume
+
+    def evaluate(self, goals, rois=None, targets=None):
+        """
+        Evaluates protocol goals
+        :param goals: list of goal elements or Goals.Goal
+        :param rois: {protocol ROI name: plan ROI name}, other ROIs are looked up by their protocol name
+        :param targets: {protocol target name: dose in Gy} used to scale relative doses
+        :return: list of GoalResult
+        """
+        rois = {} if rois is None else rois
+        targets = {} if targets is None else targets
+        return [self.evaluate_goal(g, rois.get(g.roi, g.roi), targets) for g in Goals.compile_goals(goals)]
+
+    def evaluate_goal(self, goal, structure, targets):
+        """
+        :param goal: Goals.Goal
+        :param structure: plan ROI name of the goal
+        :param targets: {protocol target name: dose in Gy}
+        :return: GoalResult
+        """
+        text = Goals.print_goal(goal, 'xml')
+        dvh = self.dvh(structure)
+        if goal.type not in _evaluations or dvh is None:
+            if dvh is None:
+                logging.debug('Goal {} on {} skipped, ROI has no contours'.format(text, structure))
+            return GoalResult(goal.roi, structure, text, None, None, None, None)
+
+        dose = None
+        if goal.dose is not None:
+            if goal.dose_units == '%':
+                if goal.dose_roi in targets:
+                    dose = float(goal.dose) / 100. * targets[goal.dose_roi]
+
+                else:
+                    logging.debug('Goal {} on {} skipped as reference ROI not used'.format(text, structure))
+                    return GoalResult(goal.roi, structure, text, None, None, None, None)
+
+            else:
+                dose = float(goal.dose)
+
+        value, limit, units, at_least = _evaluations[goal.type](self, goal, dvh, dose)
+        passed = value >= limit if at_least else value <= limit
+        return GoalResult(goal.roi, structure, text, float(value), limit, units, bool(passed))
+
+
+def _at_least(goal):
+    # Greater than and greater than or equal to are not distinguished, as in RayStation
+    return goal.direction in ('gt', 'ge')
+
+
+def _absolute_volume(goal):
+    return goal.volume_units == 'cc' or float(goal.volume) > 100
+
+
+def _dx(plan, goal, dvh, dose):
+    if _absolute_volume(goal):
+        volume = max(dvh.volume - float(goal.volume), 0) if goal.volume_type == 'residual' else float(goal.volume)
+
+    else:
+        volume = float(goal.volume) / 100. * dvh.volume
+
+    return dvh.dose_at_volume(volume), dose, 'Gy', _at_least(goal)
+
+
+def _vx(plan, goal, dvh, dose):
+    volume = dvh.volume_at_dose(dose)
+    if _absolute_volume(goal):
+        return volume, float(goal.volume), 'cc', _at_least(goal)
+
+    return 100. * volume / dvh.volume, float(goal.volume), '%', _at_least(goal)
+
+
+def _max(plan, goal, dvh, dose):
+    volume = float(goal.volume) if goal.volume is not None else point_volume
+    return dvh.dose_at_volume(volume), dose, 'Gy', False
+
+
+def _min(plan, goal, dvh, dose):
+    volume = float(goal.volume) if goal.volume is not None else point_volume
+    return dvh.dose_at_volume(max(dvh.volume - volume, 0)), dose, 'Gy', True
+
+
+def _mean(plan, goal, dvh, dose):
+    return dvh.mean, dose, 'Gy', _at_least(goal)
+
+
+def _ci(plan, goal, dvh, dose):
+    # Fraction of the isodose volume that is inside the ROI
+    isodose = plan.isodose_volume(dose)
+    return (dvh.volume_at_dose(dose) / isodose if isodose > 0 else 0.), float(goal.index), None, True
+
+
+def _hi(plan, goal, dvh, dose):
+    # Dose to x% of the ROI over the dose to (100 - x)%
+    x = float(goal.volume) / 100.
+    high = dvh.dose_at_volume((1 - x) * dvh.volume)
+    return (dvh.dose_at_volume(x * dvh.volume) / high if high else 0.), float(goal.index), None, True
+
+
+# Evaluation of each goal type: (value, limit, units, True if the value must be at least the limit)
+_evaluations = {'DX': _dx, 'VX': _vx, 'Max': _max, 'Min': _min, 'Mean': _mean, 'CI': _ci, 'HI': _hi}
+
+
+def order_goals(protocol, order=None, index=None, protocol_folder=None):
+    """
+    Goal elements of a protocol and one of its orders, including the goals of referenced goal sets
+    :param protocol: protocol name
+    :param order: order name, None for the protocol level goals only
+    :param index: ProtocolIndex, the session index if None
+    :param protocol_folder: folder of the protocol files, the first folder in use with the protocol if None
+    :return: list of Goals.Goal
+    """
+    index = ProtocolIndex.get_index() if index is None else index
+    if protocol_folder is None:
+        protocol_folder = index.folder_of(protocol=protocol)
+        if protocol_folder is None:
+            logging.warning('Protocol {} not found'.format(protocol))
+            return []
+    protocol_folder = os.path.abspath(protocol_folder)
+    # Goal sets of the protocol folder first, then of any folder in use
+    goalsets = {}
+    for s in index.sets(kind='goalset', folder=protocol_folder):
+        goalsets.setdefault(s.name, s.path)
+    for s in index.sets(kind='goalset'):
+        if not index.retired(s.path):
+            goalsets.setdefault(s.name, s.path)
+    elements = []
+    for p in index.protocols(folder=protocol_folder).get(protocol, []):
+        elements += _goal_elements(ProtocolIndex.parse(p.path).getroot(), goalsets)
+        o = ProtocolIndex.order_element(p.path, order) if order is not None else None
+        if o is not None:
+            elements += _goal_elements(o, goalsets)
+
+    return Goals.compile_goals(elements)
+
+
+def _goal_elements(element, goalsets):
+    elements = element.findall('goals/roi')
+    for s in element.findall('goals/goalset') + element.findall('goalset'):
+        name = s.find('name').text
+        if name not in goalsets:
+            logging.warning('Goal set {} not found'.format(name))
+            continue
+        for g in ProtocolIndex.parse(goalsets[name]).findall('set'):
+            if g.find('name').text == name:
+                for r in g.findall('roi'):
+                    # Goals of a set take the priority of the set reference
+                    if s.find('priority') is not None:
+                        r.append(s.find('priority'))
+                    elements.append(r)
+
+    return elements
+
+
+def evaluate_job(job):
+    """
+    Evaluates one plan, see evaluate_plans
+    :param job: dictionary with keys folder, protocol and optionally order, protocol_folder, rois, targets and
+                supersample
+    :return: list of GoalResult, or the error message if the plan could not be evaluated
+    """
+    try:
+        plan = PlanEvaluation.from_folder(job['folder'], supersample=job.get('supersample', 4))
+        goals = order_goals(job['protocol'], job.get('order'), protocol_folder=job.get('protocol_folder'))
+        return plan.evaluate(goals, rois=job.get('rois'), targets=job.get('targets'))
+
+    except Exception as e:
+        logging.warning('Plan {} could not be evaluated: {}'.format(job['folder'], e))
+        return str(e)
+
+
+def evaluate_plans(jobs, processes=None):
+    """
+    Evaluates many plans in parallel processes
+    :param jobs: list of dictionaries, see evaluate_job
+    :param processes: number of processes, the number of CPUs if None, no pool if 1
+    :return: list of (job, results) in the order of jobs
+    """
+    if processes == 1 or len(jobs) < 2:
+        return [(j, evaluate_job(j)) for j in jobs]
+
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        return list(zip(jobs, pool.map(evaluate_job, jobs)))
+
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _pairs(values, convert=str):
+    result = {}
+    for v in values or []:
+        k, _, x = v.partition('=')
+        result[k] = convert(x)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluate protocol goals on exported RTDOSE and RTSTRUCT files')
+    parser.add_argument('folders', nargs='+', help='one folder of DICOM files per plan')
+    parser.add_argument('--protocol', required=True)
+    parser.add_argument('--order', help='order of the protocol')
+    parser.add_argument('--protocol-folder', help='folder of the protocol files (default: first folder in use)')
+    parser.add_argument('--target', action='append', help='protocol target dose, e.g. PTV_p=79.2 (Gy)')
+    parser.add_argument('--roi', action='append', help='plan ROI of a protocol ROI, e.g. PTV_p=PTV_7920')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--supersample', type=int, default=4, help='in plane points per voxel dimension')
+    parser.add_argument('--output', help='csv file of the results (default: print)')
+    args = parser.parse_args(argv)
+
+    jobs = [{'folder': f, 'protocol': args.protocol, 'order': args.order, 'protocol_folder': args.protocol_folder,
+             'rois': _pairs(args.roi), 'targets': _pairs(args.target, float), 'supersample': args.supersample}
+            for f in args.folders]
+    rows = []
+    for job, results in evaluate_plans(jobs, processes=args.processes):
+        if not isinstance(results, list):
+            rows.append([job['folder'], None, None, None, None, None, None, 'error: ' + results])
+            continue
+        for r in results:
+            rows.append([job['folder'], r.roi, r.structure, r.goal, r.value, r.limit, r.units,
+                         {True: 'pass', False: 'fail', None: 'not evaluated'}[r.passed]])
+
+    header = ['plan', 'roi', 'structure', 'goal', 'value', 'limit', 'units', 'result']
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    else:
+        for r in rows:
+            print('\t'.join('' if v is None else '{:.4g}'.format(v) if isinstance(v, float) else str(v) for v in r))
+
+    failed = sum(1 for r in rows if r[-1] == 'fail')
+    logging.info('{} goals on {} plans, {} failed'.format(len(rows), len(jobs), failed))
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -22,7 +22,18 @@
         'reset_beams': True,
         'segment_weight': True,
         'reduce_oar': True,
-        'n_iterations': 6}
+        'n_iterations': 6,
+        'convergence_tolerance': 0.01,
+        'convergence_window': 2,
+        'time_budget': 3600,
+        'grid_refine_tolerance': 0.05,
+        'telemetry': True,
+        'checkpoint_every': 2,
+        'resume': False,
+        'headless': False,
+        'seed_protocol': 'UW Prostate',
+        'seed_template': 'AbdPelv Central 2Arc',
+        'goal_evaluation': True}
 
     optimize_plan(patient=Patient,
                   case=case,
@@ -62,6 +73,45 @@
     2.0.3 Adding Jaw locking, including support for lock-to-jaw max for TrueBeamStX
     2.0.4 Added calls to BeamOperations for checking jaw limits. I wanted to avoid causing jaws to be set larger
           than allowed. Currently, the jaws will be the maximum X1, Y1 (least negative) and minimum X2, Y2
+    2.0.5 Record the objective and constituent function values after each warm start, and stop the warm starts
+          early when the objective stops improving (convergence_tolerance over convergence_window warm starts)
+          or the time_budget [s] is spent. Pending dose grid changes, segment weight and reduce OAR still run.
+    2.0.6 Adaptive dose grid schedule (DoseGridScheduler): with grid_refine_tolerance the grid is refined from
+          dose_dim1 toward dose_dim4 when the objective improvement on the current grid falls below the tolerance.
+          The final warm start is always on dose_dim4, and each grid switch and its time are reported.
+    2.0.7 Per-phase and per-iteration telemetry (OptimizationTelemetry) appended as JSON lines to a per-patient
+          file in telemetry_dir. Use read_telemetry to load many runs into numpy arrays.
+    2.0.8 Checkpoints (OptimizationCheckpoint): with checkpoint_every > 0 the patient is saved and a checkpoint
+          written after setup, every checkpoint_every warm starts, segment weight and reduce OAR. resume=True
+          skips the completed steps and continues from the last checkpoint of the beamset.
+    2.0.9 headless=True runs without the status window or dialogs, for the batch queue of
+          automated_plan_optimization.
+    2.1.0 Warm-start solution library (SolutionLibrary): SolutionLibrary.store saves the segments of an approved
+          plan per protocol and beamset template. With seed_protocol and seed_template the beams are seeded from
+          the solution with the nearest target geometry before the first iteration, or after the cold start when
+          the beams have no segments yet.
+    2.1.1 goal_evaluation=True evaluates the clinical goals after each warm start with the GoalEvaluation cache
+          of the plan, logging the failed goals. Goals on unchanged ROIs are not re-read between warm starts, and
+          the last results are available to WriteTpo.pdf(evaluations=GoalEvaluation.get_cache(...)).
+    2.1.2 The ConvergencePolicy objective improvement is only measured over warm starts on the same dose grid, so
+          a grid change inside the window no longer stops the warm starts.
+    2.1.3 Library seeding runs once before the first iteration, after converting beams without segments
+          (convert_segments), instead of after the cold start. optimize_plan registers seeded beamsets and
+          store_solutions stores them in the library when the plan is approved (general/ExportMenu.py).
+    2.1.4 The goal evaluation cache is kept per patient. Every goal is evaluated after a warm start, since the
+          dose changed, and the ROI fingerprints are no longer read between warm starts.
+    2.1.5 Telemetry is off unless telemetry=True, and identifies the patient by OptimizationRuntime.anonymous_id
+          instead of the PatientID, in the file name and the records.
+    2.1.6 The checkpoint is only removed after a complete run: all warm starts run or converged, and the segment
+          weight and Reduce OAR dose steps done when requested. A failed Reduce OAR dose is run again on resume.
+    2.1.7 Library solutions and the solution registry identify the patient by anonymous_id, and the logs and the
+          report name a library solution by its plan, beamset, protocol and template only (SolutionLibrary.label).
+    2.1.8 The beam snapshots are dropped after every optimization (invalidate_optimized_snapshots), since
+          BeamOperations.snapshot_key no longer reads the leaf positions.
+    2.1.9 The checkpoint is named and identified by the anonymous_id of the patient, and is not resumed when the
+          plan was modified after it was written.
+    2.1.10 The goals are evaluated again after a warm start only when the dose fingerprint changed.
+    2.1.11 check_min_jaws keeps the minimum aperture when the locked jaws are moved off MLC violations.
 
 
     This program is free software: you can redistribute it and/or modify it under
@@ -99,10 +149,21 @@ import connect
 import UserInterface
 import datetime
 import sys
+import os
+import json
 import math
+import numpy as np
 import PlanOperations
 import BeamOperations
+import GeneralOperations
+import GoalEvaluation
 from GeneralOperations import logcrit as logcrit
+from OptimizationRuntime import telemetry_dir, read_records, anonymous_id
+
+# Directory of the optimize_plan checkpoint files
+checkpoint_dir = os.path.join(os.path.expanduser('~'), 'RayScripts', 'optimization_checkpoints')
+# Directory of the warm-start solution library, one file per protocol and beamset template
+solution_dir = os.path.join(os.path.expanduser('~'), 'RayScripts', 'optimization_solutions')
 
 
 def make_variable_grid_list(n_iterations, variable_dose_grid):
@@ -155,6 +216,811 @@ def make_variable_grid_list(n_iterations, variable_dose_grid):
     return change_grid
 
 
+def objective_values(plan_optimization):
+    """
+    Read the total objective value and the value of each constituent function of a plan optimization
+    :param plan_optimization: RS plan optimization
+    :return: total (None if not yet optimized), {'<roi>: <function type>': value}
+    """
+    if plan_optimization.Objective.FunctionValue is None:
+        return None, {}
+    total = plan_optimization.Objective.FunctionValue.FunctionValue
+    values = {}
+    for i, f in enumerate(plan_optimization.Objective.ConstituentFunctions):
+        try:
+            function_type = f.DoseFunctionParameters.FunctionType
+        except AttributeError:
+            function_type = 'Function{}'.format(i)
+        key = '{}: {}'.format(f.ForRegionOfInterest.Name, function_type)
+        # Functions of the same type on the same roi are numbered
+        if key in values:
+            key = '{} ({})'.format(key, i)
+        try:
+            values[key] = f.FunctionValue.FunctionValue
+        except AttributeError:
+            values[key] = None
+    return total, values
+
+
+class ConvergencePolicy(object):
+    """
+    Early termination of the warm start loop of optimize_plan.
+    The objective after each warm start is recorded, and the loop stops when the relative improvement of the
+    total objective over the last window warm starts is below tolerance, or when the wall-clock budget is spent.
+    A dose grid change changes the objective values, so the improvement is only measured over warm starts on the
+    same dose grid: grid_changed() starts a new window.
+
+    tolerance: relative improvement below which the optimization is converged, None to never stop on improvement
+    window: number of warm starts the improvement is measured over
+    time_budget: wall-clock budget in seconds for the warm start loop, None for no budget
+    min_iterations: warm starts always run before stopping
+    totals: total objective value after each warm start
+    values: constituent function values after each warm start
+    times: elapsed seconds at the end of each warm start
+    grid_start: index in totals of the first warm start on the current dose grid
+    """
+
+    def __init__(self, tolerance=None, window=2, time_budget=None, min_iterations=2):
+        self.tolerance = tolerance
+        self.window = max(int(window), 1)
+        self.time_budget = time_budget
+        self.min_iterations = max(int(min_iterations), self.window)
+        self.start = datetime.datetime.now()
+        self.totals = []
+        self.values = []
+        self.times = []
+        self.grid_start = 0
+
+    def record(self, total, values=None):
+        self.totals.append(total)
+        self.values.append(values if values is not None else {})
+        self.times.append((datetime.datetime.now() - self.start).total_seconds())
+
+    def grid_changed(self):
+        # The dose grid changes before the next warm start, earlier objective values are not compared with it
+        self.grid_start = len(self.totals)
+
+    def relative_improvement(self, window=None):
+        # Relative decrease of the total objective over the last window warm starts on the current dose grid
+        if window is None:
+            window = self.window
+        if len(self.totals) - self.grid_start <= window:
+            return None
+        previous = self.totals[-1 - window]
+        current = self.totals[-1]
+        if previous is None or current is None:
+            return None
+        if previous == 0:
+            return 0.
+        return (previous - current) / abs(previous)
+
+    def stop_reason(self):
+        """
+        :return: a string describing why the warm starts should stop, None to continue
+        """
+        if len(self.totals) < self.min_iterations:
+            return None
+        if self.time_budget is not None and self.times[-1] >= self.time_budget:
+            return 'time budget of {} s spent after {:.0f} s'.format(self.time_budget, self.times[-1])
+        improvement = self.relative_improvement()
+        if self.tolerance is not None and improvement is not None and improvement < self.tolerance:
+            return 'relative improvement {:.2e} over {} warm starts is below {}'.format(
+                improvement, self.window, self.tolerance)
+        return None
+
+
+class DoseGridScheduler(object):
+    """
+    Dose grid schedule of the warm starts of optimize_plan.
+    With a tolerance, the schedule is adaptive: the optimization starts on the coarsest grid, and moves to the
+    next finer grid only when the relative objective improvement of the last warm start on the current grid falls
+    below tolerance. The final warm start always runs on the clinical (last) grid.
+    Without a tolerance, the fixed schedule of make_variable_grid_list is used.
+
+    grids: grid sizes [cm] from coarsest to the clinical grid
+    n_iterations: number of warm starts
+    tolerance: relative improvement below which the grid is refined, None for the fixed schedule
+    min_iterations_per_grid: warm starts run on a grid before its improvement is evaluated
+    schedule: the fixed schedule (see make_variable_grid_list), None if adaptive
+    current: the current grid size, None before the first change
+    switches: list of {'Iteration', 'Grid', 'Improvement', 'Seconds'} for each grid change
+    """
+
+    def __init__(self, grids, n_iterations, tolerance=None, min_iterations_per_grid=2):
+        self.grids = list(grids)
+        self.n_iterations = n_iterations
+        self.tolerance = tolerance
+        self.min_iterations_per_grid = max(int(min_iterations_per_grid), 2)
+        self.level = -1
+        self.current = None
+        self.switch_iteration = 0
+        self.switches = []
+        if self.adaptive:
+            self.schedule = None
+        else:
+            variable_dose_grid = {
+                'delta_grid': self.grids,
+                'grid_adjustment_iteration': [0,
+                                              int(n_iterations / 2),
+                                              int(3 * n_iterations / 4),
+                                              int(n_iterations - 1)]}
+            self.schedule = make_variable_grid_list(n_iterations, variable_dose_grid)
+
+    @property
+    def adaptive(self):
+        return self.tolerance is not None
+
+    def next_grid(self, iteration, totals=None):
+        """
+        Grid to change to before a warm start
+        :param iteration: index of the warm start about to run
+        :param totals: total objective value after each completed warm start
+        :return: the new grid size, or 0 if the grid does not change
+        """
+        if not self.adaptive:
+            return self.schedule[iteration]
+        level = self.level
+        if iteration == self.n_iterations - 1:
+            level = len(self.grids) - 1
+        elif iteration == 0:
+            level = 0
+        elif iteration - self.switch_iteration >= self.min_iterations_per_grid and \
+                level < len(self.grids) - 1 and totals is not None and len(totals) >= 2:
+            previous, current = totals[-2], totals[-1]
+            if previous is not None and current is not None:
+                improvement = (previous - current) / abs(previous) if previous != 0 else 0.
+                if improvement < self.tolerance:
+                    logging.info('Objective improvement {:.2e} below {}, refining the dose grid'.format(
+                        improvement, self.tolerance))
+                    level += 1
+        if level == self.level:
+            return 0
+        self.level = level
+        return self.grids[level]
+
+    def pending_grid(self, iteration):
+        """
+        Grid the optimization should finish on when the warm starts stop before n_iterations
+        :param iteration: index of the next warm start that will not run
+        :return: grid size, or 0 if the current grid is already the final grid
+        """
+        if not self.adaptive:
+            remaining = [g for g in self.schedule[iteration:] if g != 0]
+            return remaining[-1] if remaining else 0
+        if self.current != self.grids[-1]:
+            self.level = len(self.grids) - 1
+            return self.grids[-1]
+        return 0
+
+    def apply(self, plan, iteration, grid, improvement=None):
+        """
+        Change the plan dose grid and record the switch and its time
+        :param plan: RS plan
+        :param iteration: index of the warm start the grid is changed before
+        :param grid: voxel size [cm]
+        :param improvement: relative objective improvement that triggered the change
+        :return: start and finish times of the change
+        """
+        time_initial = datetime.datetime.now()
+        plan.SetDefaultDoseGrid(
+            VoxelSize={
+                'x': grid,
+                'y': grid,
+                'z': grid})
+        plan.TreatmentCourse.TotalDose.UpdateDoseGridStructures()
+        time_final = datetime.datetime.now()
+        self.current = grid
+        self.switch_iteration = iteration
+        self.switches.append({'Iteration': iteration, 'Grid': grid, 'Improvement': improvement,
+                              'Seconds': (time_final - time_initial).total_seconds()})
+        return time_initial, time_final
+
+    def state(self):
+        # Schedule position, for checkpoints
+        return {'Level': self.level, 'Current': self.current, 'SwitchIteration': self.switch_iteration,
+                'Switches': self.switches}
+
+    def restore(self, state):
+        # Continue the schedule from a checkpoint state, the plan is already on the current grid
+        self.level = state['Level']
+        self.current = state['Current']
+        self.switch_iteration = state['SwitchIteration']
+        self.switches[:] = state['Switches']
+
+
+class HeadlessStatus(object):
+    """
+    Stand-in for UserInterface.ScriptStatus when optimize_plan runs without a user interface.
+    Steps are logged rather than displayed, and the run can not be aborted.
+    """
+
+    def __init__(self, steps=None):
+        self.steps = list(steps) if steps is not None else []
+        self.current_step = -1
+
+    def next_step(self, text='', num=None):
+        if num is None:
+            self.current_step += 1
+        else:
+            self.current_step = num
+        self.current_step = min(self.current_step, len(self.steps) - 1)
+        logging.info('Step {}: {} {}'.format(self.current_step + 1, self.steps[self.current_step], text))
+
+    def add_step(self, text=''):
+        self.steps.append(text)
+
+    def update_text(self, text=''):
+        logging.info('Step {}: {}'.format(self.current_step + 1, text))
+
+    def finish(self, text=''):
+        logging.info('Finished at step {}: {}'.format(self.current_step + 1, text))
+
+    def close(self):
+        pass
+
+    def aborted(self):
+        return False
+
+
+class OptimizationTelemetry(object):
+    """
+    Structured record of an optimize_plan run: one JSON line per phase and iteration is appended to
+    <telemetry_dir>/<anonymous_id>.jsonl. Every record has the keys Run, Patient, Plan, BeamSet, Phase, Iteration,
+    Start, Seconds and Elapsed, along with the phase specific values passed to emit. Patient is the anonymous_id
+    of the PatientID, which is not written. Telemetry is off unless enabled.
+    Writing is best effort: if the file can not be written, telemetry is disabled for the rest of the run.
+
+    path: the telemetry file
+    run: identifier of this run (start time)
+    enabled: False when telemetry is off or could not be written
+    """
+
+    def __init__(self, patient, plan, beamset, directory=None, enabled=False):
+        self.start = datetime.datetime.now()
+        self.run = self.start.strftime('%Y%m%d%H%M%S%f')
+        self.enabled = enabled
+        try:
+            patient_id = anonymous_id(patient.PatientID)
+        except AttributeError:
+            patient_id = 'unknown'
+        self.identity = {'Run': self.run, 'Patient': patient_id, 'Plan': plan.Name,
+                         'BeamSet': beamset.DicomPlanLabel}
+        self.path = os.path.join(telemetry_dir if directory is None else directory, '{}.jsonl'.format(patient_id))
+
+    def emit(self, phase, iteration=None, time_initial=None, time_final=None, **values):
+        """
+        Append a record to the telemetry file
+        :param phase: name of the optimization phase, e.g. Iteration, GridChange, JawLock
+        :param iteration: warm start number the record belongs to
+        :param time_initial: start of the phase, defaults to now
+        :param time_final: end of the phase, defaults to now
+        :param values: phase specific values, must be JSON serializable
+        """
+        if not self.enabled:
+            return
+        time_final = datetime.datetime.now() if time_final is None else time_final
+        time_initial = time_final if time_initial is None else time_initial
+        record = dict(self.identity)
+        record.update({'Phase': phase, 'Iteration': iteration, 'Start': time_initial.isoformat(),
+                       'Seconds': (time_final - time_initial).total_seconds(),
+                       'Elapsed': (time_final - self.start).total_seconds()})
+        record.update(values)
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+        except (IOError, OSError) as e:
+            logging.warning('Optimization telemetry could not be written to {}: {}'.format(self.path, e))
+            self.enabled = False
+
+
+class OptimizationCheckpoint(object):
+    """
+    Checkpoint of an optimize_plan run, so a run interrupted by a RayStation failure or an abort can be resumed.
+    The checkpoint is written to <checkpoint_dir>/<anonymous_id>_<Plan>_<BeamSet>.json only after the patient is
+    saved, so the recorded steps always match the saved plan. The modification time of the plan is recorded when it
+    is written, and a checkpoint of a plan modified since is not resumed.
+
+    Steps are named Setup, Iteration:<n>, Converged, SegmentWeight and ReduceOAR. The state records the completed
+    steps, the number of completed warm starts, the dose grid schedule position, the objective history, the jaw
+    limit decisions and the time spent in each step.
+
+    path: the checkpoint file
+    enabled: False when checkpoints are off
+    state: the checkpoint state dictionary
+    """
+
+    # Inputs that must match for a checkpoint to be resumed
+    matched_inputs = ['n_iterations', 'fluence_only', 'vary_grid', 'grid_refine_tolerance', 'segment_weight',
+                      'reduce_oar', 'dose_dim1', 'dose_dim2', 'dose_dim3', 'dose_dim4']
+
+    def __init__(self, patient, plan, beamset, inputs, directory=None, enabled=True):
+        self.enabled = enabled
+        self.plan = plan
+        try:
+            patient_id = patient.PatientID
+        except AttributeError:
+            patient_id = 'unknown'
+        identity = {'Patient': anonymous_id(patient_id), 'Plan': plan.Name, 'BeamSet': beamset.DicomPlanLabel}
+        name = '_'.join([identity['Patient'], identity['Plan'], identity['BeamSet']])
+        name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+        self.path = os.path.join(checkpoint_dir if directory is None else directory, '{}.json'.format(name))
+        self.state = {'Identity': identity,
+                      'Inputs': {k: inputs.get(k) for k in self.matched_inputs},
+                      'Completed': [],
+                      'Iteration': 0,
+                      'Grid': None,
+                      'Totals': [],
+                      'Values': [],
+                      'JawLimits': {},
+                      'Seconds': {},
+                      'StopReason': None,
+                      'ReduceOARSuccess': False,
+                      'Saved': None,
+                      'Modified': None}
+
+    def modified(self):
+        # Modification time of the plan, None where RayStation does not report one
+        try:
+            return str(self.plan.ModificationInfo.ModificationTime)
+        except AttributeError:
+            return None
+
+    def load(self):
+        """
+        Load the checkpoint of this patient, plan and beamset
+        :return: True if a checkpoint with matching inputs of the unmodified plan was loaded
+        """
+        if not os.path.isfile(self.path):
+            logging.info('No optimization checkpoint found at {}'.format(self.path))
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning('Optimization checkpoint {} could not be read: {}'.format(self.path, e))
+            return False
+        if state.get('Identity') != self.state['Identity'] or state.get('Inputs') != self.state['Inputs']:
+            logging.warning('Optimization checkpoint {} does not match the current inputs, starting over'.format(
+                self.path))
+            return False
+        if state.get('Modified') != self.modified():
+            logging.warning('Plan {} was modified after checkpoint {} was written, starting over'.format(
+                self.plan.Name, self.path))
+            return False
+        self.state = state
+        return True
+
+    def completed(self, step):
+        return step in self.state['Completed']
+
+    def complete(self, step, seconds=None, **values):
+        """
+        Record a completed step, the checkpoint is only written by save
+        :param step: step name
+        :param seconds: time spent on the step
+        :param values: state values to update
+        """
+        if step not in self.state['Completed']:
+            self.state['Completed'].append(step)
+        if seconds is not None:
+            self.state['Seconds'][step] = seconds
+        self.state.update(values)
+
+    def save(self, patient):
+        """
+        Save the patient and write the checkpoint
+        :param patient: RS patient
+        :return: True if the checkpoint was written
+        """
+        if not self.enabled:
+            return False
+        try:
+            patient.Save()
+        except Exception as e:
+            logging.warning('Patient could not be saved, checkpoint not written: {}'.format(e))
+            return False
+        self.state['Saved'] = datetime.datetime.now().isoformat()
+        self.state['Modified'] = self.modified()
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'w') as f:
+                json.dump(self.state, f, default=str)
+        except (IOError, OSError) as e:
+            logging.warning('Optimization checkpoint could not be written to {}: {}'.format(self.path, e))
+            return False
+        logging.debug('Optimization checkpoint written after {}'.format(self.state['Completed'][-1:]))
+        return True
+
+    def clear(self):
+        # Remove the checkpoint once the optimization is complete
+        if os.path.isfile(self.path):
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                logging.warning('Optimization checkpoint {} could not be removed: {}'.format(self.path, e))
+
+
+def target_geometry(case, beamset, target=None):
+    """
+    Volume and bounding box extent of the target of a beamset, used to match library solutions
+    :param case: RS case
+    :param beamset: RS beamset
+    :param target: name of the target ROI, the prescription structure of the beamset if None
+    :return: {'Target': name, 'Volume': [cc], 'Extent': [x, y, z] [cm]} or None if the target is not found
+    """
+    try:
+        if target is None:
+            target = beamset.Prescription.PrimaryDosePrescription.OnStructure.Name
+        exam = beamset.GetPlanningExamination()
+        roi_geometry = case.PatientModel.StructureSets[exam.Name].RoiGeometries[target]
+        volume = roi_geometry.GetRoiVolume()
+        box = roi_geometry.GetBoundingBox()
+    except Exception as e:
+        logging.warning('Target geometry of beamset {} not found: {}'.format(beamset.DicomPlanLabel, e))
+        return None
+    return {'Target': target,
+            'Volume': float(volume),
+            'Extent': [float(abs(box[1].x - box[0].x)),
+                       float(abs(box[1].y - box[0].y)),
+                       float(abs(box[1].z - box[0].z))]}
+
+
+def beam_geometry(beam):
+    # Gantry, arc stop, collimator and couch angles of a beam, None where the beam has no such angle
+    return [getattr(beam, a, None) for a in ['GantryAngle', 'ArcStopGantryAngle', 'InitialCollimatorAngle',
+                                             'CouchAngle']]
+
+
+class SolutionLibrary(object):
+    """
+    Library of optimized solutions of approved plans for one protocol and beamset template. Each solution stores
+    the target geometry, the dose per fraction and the segment shapes, weights and MU of every beam, and is kept in
+    <solution_dir>/<protocol>_<template>.json.
+
+    A new plan of the same protocol and template is seeded from the solution with the nearest target geometry:
+    the distance is the root sum square of the log ratios of the target volume and bounding box extents, and only
+    solutions with the same beam angles are considered. Patient is the anonymous_id of the PatientID of the source
+    plan, which is not written, and is not shown (see label).
+
+    path: the library file
+    solutions: list of solution dictionaries
+    """
+
+    # Angle tolerance [deg] for a library beam to match a beam of the new plan
+    angle_tolerance = 1.
+
+    def __init__(self, protocol, template, directory=None):
+        self.protocol = protocol
+        self.template = template
+        name = '_'.join([protocol, template])
+        name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+        self.path = os.path.join(solution_dir if directory is None else directory, '{}.json'.format(name))
+        self.solutions = []
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.solutions = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                logging.warning('Solution library {} could not be read: {}'.format(self.path, e))
+
+    def store(self, patient, case, plan, beamset, target=None, require_approval=True):
+        """
+        Add the optimized solution of a beamset to the library, replacing an earlier solution of the same beamset
+        :param patient: RS patient
+        :param case: RS case
+        :param plan: RS plan
+        :param beamset: RS beamset
+        :param target: name of the target ROI, the prescription structure of the beamset if None
+        :param require_approval: only store solutions of approved plans
+        :return: True if the solution was stored
+        """
+        if require_approval and (plan.Review is None or plan.Review.ApprovalStatus != 'Approved'):
+            logging.warning('Plan {} is not approved, solution not stored'.format(plan.Name))
+            return False
+        geometry = target_geometry(case, beamset, target=target)
+        if geometry is None:
+            return False
+        beams = []
+        for b in sorted(beamset.Beams, key=lambda x: x.Number):
+            snapshot = BeamOperations.beam_snapshot(b)
+            if not snapshot.has_segments:
+                logging.warning('Beam {} has no segments, solution not stored'.format(b.Name))
+                return False
+            beams.append({'Name': b.Name,
+                          'Geometry': beam_geometry(b),
+                          'MU': b.BeamMU,
+                          'Segments': [{'Jaws': snapshot.jaws[i].tolist(),
+                                        'Leaves': snapshot.banks[:, :, i].T.tolist(),
+                                        'Weight': float(snapshot.weights[i])}
+                                       for i in range(snapshot.number_segments)]})
+        try:
+            patient_id = patient.PatientID
+        except AttributeError:
+            patient_id = 'unknown'
+        solution = {'Patient': anonymous_id(patient_id),
+                    'Plan': plan.Name,
+                    'BeamSet': beamset.DicomPlanLabel,
+                    'Saved': datetime.datetime.now().isoformat(),
+                    'DosePerFraction': dose_per_fraction(beamset),
+                    'Beams': beams}
+        solution.update(geometry)
+        self.solutions = [s for s in self.solutions if [s['Patient'], s['Plan'], s['BeamSet']] !=
+                          [solution['Patient'], plan.Name, beamset.DicomPlanLabel]]
+        self.solutions.append(solution)
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'w') as f:
+                json.dump(self.solutions, f)
+        except (IOError, OSError) as e:
+            logging.warning('Solution library {} could not be written: {}'.format(self.path, e))
+            return False
+        logging.info('Solution of {} stored in {}, {} solutions'.format(
+            beamset.DicomPlanLabel, self.path, len(self.solutions)))
+        return True
+
+    def label(self, solution):
+        """
+        Name of a library solution for logs and reports, without the patient
+        :param solution: library solution
+        :return: str
+        """
+        return '{}/{} ({} {})'.format(solution['Plan'], solution['BeamSet'], self.protocol, self.template)
+
+    def matches(self, solution, beamset):
+        """
+        Pair the beams of a beamset with the beams of a library solution
+        :param solution: library solution
+        :param beamset: RS beamset
+        :return: list of (RS beam, library beam) or None if the beam angles do not match
+        """
+        beams = sorted(beamset.Beams, key=lambda x: x.Number)
+        if len(beams) != len(solution['Beams']):
+            return None
+        for b, s in zip(beams, solution['Beams']):
+            for a, l in zip(beam_geometry(b), s['Geometry']):
+                if (a is None) != (l is None):
+                    return None
+                if a is not None and abs((float(a) - float(l) + 180.) % 360. - 180.) > self.angle_tolerance:
+                    return None
+        return list(zip(beams, solution['Beams']))
+
+    def nearest(self, case, beamset, target=None, max_distance=None):
+        """
+        Library solution with the nearest target geometry and matching beam angles
+        :param case: RS case
+        :param beamset: RS beamset
+        :param target: name of the target ROI, the prescription structure of the beamset if None
+        :param max_distance: solutions further than this distance are not used
+        :return: (solution, distance) or (None, None)
+        """
+        geometry = target_geometry(case, beamset, target=target)
+        if geometry is None or not self.solutions:
+            return None, None
+        features = np.log(np.maximum([geometry['Volume']] + geometry['Extent'], 1e-3))
+        candidates = [s for s in self.solutions if self.matches(s, beamset) is not None]
+        if not candidates:
+            logging.info('No solution in {} matches the beams of {}'.format(self.path, beamset.DicomPlanLabel))
+            return None, None
+        library = np.log(np.maximum([[s['Volume']] + s['Extent'] for s in candidates], 1e-3))
+        distance = np.sqrt(np.sum((library - features) ** 2, axis=1))
+        i = int(np.argmin(distance))
+        if max_distance is not None and distance[i] > max_distance:
+            logging.info('Nearest solution {} is too far ({:.2f}) from {}'.format(
+                self.label(candidates[i]), distance[i], beamset.DicomPlanLabel))
+            return None, None
+        return candidates[i], float(distance[i])
+
+    def seed(self, beamset, solution):
+        """
+        Set the segment shapes, weights and MU of the beams of a beamset to a library solution. Beams are only seeded
+        when they already have the same number of segments and leaves as the library beam (see convert_segments).
+        The MU are scaled by the ratio of the dose per fraction.
+        :param beamset: RS beamset
+        :param solution: library solution
+        :return: number of beams seeded
+        """
+        pairs = self.matches(solution, beamset)
+        if pairs is None:
+            return 0
+        scale = 1.
+        dose = dose_per_fraction(beamset)
+        if dose and solution.get('DosePerFraction'):
+            scale = dose / solution['DosePerFraction']
+        seeded = 0
+        for b, s in pairs:
+            try:
+                segments = b.Segments
+                number_segments = len(segments)
+            except Exception:
+                number_segments = 0
+            if number_segments != len(s['Segments']) or \
+                    len(segments[0].LeafPositions[0]) != len(s['Segments'][0]['Leaves'][0]):
+                logging.debug('Beam {} has {} segments, the library beam {}, not seeded'.format(
+                    b.Name, number_segments, len(s['Segments'])))
+                continue
+            for segment, stored in zip(segments, s['Segments']):
+                lp = segment.LeafPositions
+                for l in range(len(lp[0])):
+                    lp[0][l] = stored['Leaves'][0][l]
+                    lp[1][l] = stored['Leaves'][1][l]
+                segment.LeafPositions = lp
+                segment.JawPositions = stored['Jaws']
+                segment.RelativeWeight = stored['Weight']
+            b.BeamMU = s['MU'] * scale
+            BeamOperations.invalidate_beam_snapshot(b)
+            seeded += 1
+        return seeded
+
+
+def dose_per_fraction(beamset):
+    # Prescription dose per fraction of a beamset, None without a prescription
+    try:
+        return float(beamset.Prescription.PrimaryDosePrescription.DoseValue /
+                     beamset.FractionationPattern.NumberOfFractions)
+    except (AttributeError, TypeError, ZeroDivisionError):
+        return None
+
+
+def invalidate_optimized_snapshots(plan_optimization):
+    # Drop the cached BeamOperations.beam_snapshot of every beam an optimization may have changed
+    for b in plan_optimization.OptimizedBeamSets:
+        for beam in b.Beams:
+            BeamOperations.invalidate_beam_snapshot(beam)
+
+
+def convert_segments(plan_optimization, preparation_iterations):
+    """
+    Create the segments of the beams with a short optimization that stops one iteration after segment conversion,
+    so a library solution can be seeded before the first warm start. The iteration settings are restored.
+    :param plan_optimization: RS plan optimization
+    :param preparation_iterations: fluence iterations before the segment conversion
+    """
+    parameters = plan_optimization.OptimizationParameters
+    maximum = parameters.Algorithm.MaxNumberOfIterations
+    preparation = parameters.DoseCalculation.IterationsInPreparationsPhase
+    parameters.Algorithm.MaxNumberOfIterations = preparation_iterations + 1
+    parameters.DoseCalculation.IterationsInPreparationsPhase = preparation_iterations
+    try:
+        plan_optimization.RunOptimization()
+    finally:
+        parameters.Algorithm.MaxNumberOfIterations = maximum
+        parameters.DoseCalculation.IterationsInPreparationsPhase = preparation
+        invalidate_optimized_snapshots(plan_optimization)
+
+
+def _registry_path(directory=None):
+    return os.path.join(solution_dir if directory is None else directory, 'registry.json')
+
+
+def _read_registry(directory=None):
+    path = _registry_path(directory)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logging.warning('Solution registry {} could not be read: {}'.format(path, e))
+        return {}
+
+
+def _write_registry(registry, directory=None):
+    path = _registry_path(directory)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump(registry, f)
+    except (IOError, OSError) as e:
+        logging.warning('Solution registry {} could not be written: {}'.format(path, e))
+
+
+def _registry_key(patient, plan, beamset):
+    try:
+        patient_id = patient.PatientID
+    except AttributeError:
+        patient_id = 'unknown'
+    return '/'.join([anonymous_id(patient_id), plan.Name, beamset.DicomPlanLabel])
+
+
+def register_solution(patient, plan, beamset, protocol, template, directory=None):
+    """
+    Record the protocol and beamset template of an optimized beamset, so its solution is stored in the library of
+    that protocol and template when the plan is approved
+    :param patient: RS patient
+    :param plan: RS plan
+    :param beamset: RS beamset
+    :param protocol: protocol name
+    :param template: beamset template name
+    :param directory: library directory, solution_dir if None
+    """
+    registry = _read_registry(directory)
+    registry[_registry_key(patient, plan, beamset)] = [protocol, template]
+    _write_registry(registry, directory)
+
+
+def store_solutions(patient, case, plan, directory=None):
+    """
+    Store the solutions of the registered beamsets of an approved plan in their libraries, see register_solution.
+    Called when the plan is approved (general/ExportMenu.py)
+    :param patient: RS patient
+    :param case: RS case
+    :param plan: RS plan
+    :param directory: library directory, solution_dir if None
+    :return: list of the DicomPlanLabel of the beamsets stored
+    """
+    registry = _read_registry(directory)
+    stored = []
+    for b in plan.BeamSets:
+        key = _registry_key(patient, plan, b)
+        if key not in registry:
+            continue
+        protocol, template = registry[key]
+        if SolutionLibrary(protocol, template, directory=directory).store(patient, case, plan, b):
+            stored.append(b.DicomPlanLabel)
+            del registry[key]
+    if stored:
+        _write_registry(registry, directory)
+    return stored
+
+
+def plan_state(plan, plan_optimization):
+    """
+    Dose grid, segment and MU state of the beams of a plan optimization, for telemetry
+    :param plan: RS plan
+    :param plan_optimization: RS plan optimization
+    :return: {'Grid': voxel size [cm], 'Voxels': number of dose grid voxels, 'Segments': total number of segments,
+        'MU': total MU, 'Beams': {beam name: [number of segments, MU]}}
+    """
+    state = {'Grid': None, 'Voxels': None, 'Segments': 0, 'MU': 0., 'Beams': {}}
+    try:
+        grid = plan.TreatmentCourse.TotalDose.InDoseGrid
+        state['Grid'] = grid.VoxelSize.x
+        state['Voxels'] = grid.NrVoxels.x * grid.NrVoxels.y * grid.NrVoxels.z
+    except AttributeError:
+        logging.debug('Dose grid of plan {} not available for telemetry'.format(plan.Name))
+    for ts in plan_optimization.OptimizationParameters.TreatmentSetupSettings:
+        for bs in ts.BeamSettings:
+            beam = bs.ForBeam
+            try:
+                n_segments = len(beam.Segments)
+            except (AttributeError, TypeError):
+                n_segments = 0
+            state['Beams'][beam.Name] = [n_segments, beam.BeamMU]
+            state['Segments'] += n_segments
+            state['MU'] += beam.BeamMU
+    return state
+
+
+# Numeric fields returned by read_telemetry by default
+telemetry_fields = ['Iteration', 'Seconds', 'Elapsed', 'Objective', 'Grid', 'Voxels', 'Segments', 'MU']
+
+
+def read_telemetry(paths=None, phase='Iteration', fields=None):
+    """
+    Load the telemetry of many optimize_plan runs into numpy arrays, one element per record
+    :param paths: telemetry files or directories of telemetry files, telemetry_dir if not supplied
+    :param phase: only records of this phase are returned, None for all records
+    :param fields: numeric fields to return (missing values are nan), telemetry_fields if not supplied
+    :return: {'Run', 'Patient', 'Plan', 'BeamSet', 'Phase': numpy arrays of str, <field>: numpy float arrays,
+        'Functions': list of the constituent function values of each record}
+    """
+    if fields is None:
+        fields = telemetry_fields
+    records = read_records(paths, phase=phase)
+    data = {}
+    for key in ['Run', 'Patient', 'Plan', 'BeamSet', 'Phase']:
+        data[key] = np.array([str(r.get(key)) for r in records])
+    for key in fields:
+        data[key] = np.array([np.nan if r.get(key) is None else r.get(key) for r in records], dtype=float)
+    data['Functions'] = [r.get('Functions', {}) for r in records]
+    return data
+
+
 def select_rois_for_treat(plan, beamset, rois=None):
     """ For the beamset supplie set treat settings
     :param beamset: RS beamset or ForTreatmentSetup object
@@ -244,12 +1110,13 @@ def set_treat_margins(beam, rois, margins=None):
                                               Roi=r)
 
 
-def check_min_jaws(plan_opt, min_dim):
+def check_min_jaws(plan_opt, min_dim, telemetry=None):
     """
     This function takes in the beamset, looks for field sizes that are less than a minimum
     resets the beams, and sets iteration count to back to zero
     :param beamset: current RS beamset
     :param min_dim: size of smallest desired aperture
+    :param telemetry: optional OptimizationTelemetry, jaw-lock events are recorded
     :return jaw_change: if a change was required return True, else False
     # This will not work with jaw tracking!!!
 
@@ -260,6 +1127,8 @@ def check_min_jaws(plan_opt, min_dim):
     # min_dimension * (1 + epsilon) will be used to lock jaws
     epsilon = 0.1
     jaw_change = False
+    # Machines loaded for the violation checks of the locked jaws
+    machines = {}
     # n_mlc = 64
     # y_thick_inner = 0.25
     # y_thick_outer = 0.5
@@ -279,19 +1148,17 @@ def check_min_jaws(plan_opt, min_dim):
                 logging.debug("Plan is not VMAT or SNS, behavior will not be clear for check")
 
             if plan_is_optimized:
-                # Find the minimum jaw position, first set to the maximum
-                min_x_aperture = 40
-                min_y_aperture = 40
-                for s in b.ForBeam.Segments:
-                    # Find the minimum aperture in each beam
-                    if s.JawPositions[1] - s.JawPositions[0] <= min_x_aperture:
-                        min_x1 = s.JawPositions[0]
-                        min_x2 = s.JawPositions[1]
-                        min_x_aperture = min_x2 - min_x1
-                    if s.JawPositions[3] - s.JawPositions[2] <= min_y_aperture:
-                        min_y1 = s.JawPositions[2]
-                        min_y2 = s.JawPositions[3]
-                        min_y_aperture = min_y2 - min_y1
+                # Find the minimum aperture in each beam from the segment jaw positions
+                jaws = BeamOperations.beam_snapshot(b.ForBeam).jaws
+                x_apertures = jaws[:, 1] - jaws[:, 0]
+                y_apertures = jaws[:, 3] - jaws[:, 2]
+                # Use the last segment with the minimum aperture
+                i_x = len(x_apertures) - 1 - np.argmin(x_apertures[::-1])
+                i_y = len(y_apertures) - 1 - np.argmin(y_apertures[::-1])
+                min_x1, min_x2 = float(jaws[i_x, 0]), float(jaws[i_x, 1])
+                min_x_aperture = min_x2 - min_x1
+                min_y1, min_y2 = float(jaws[i_y, 2]), float(jaws[i_y, 3])
+                min_y_aperture = min_y2 - min_y1
 
                 # If the minimum size in x is smaller than min_dim, set the minimum to a proportion of min_dim
                 # Use floor and ceil functions to ensure rounding to the nearest mm
@@ -305,8 +1172,8 @@ def check_min_jaws(plan_opt, min_dim):
                     x1 = math.floor(10 * x1) / 10
                     logging.debug('x-aperture is being set to X1={}, X2={}'.format(x1, x2))
                 else:
-                    x2 = s.JawPositions[1]
-                    x1 = s.JawPositions[0]
+                    x2 = float(jaws[-1, 1])
+                    x1 = float(jaws[-1, 0])
                 # If the minimum size in y is smaller than min_dim, set the minimum to a proportion of min_dim
                 if min_y_aperture <= min_dim * (1 + epsilon):
                     logging.info('Minimum y-aperture is smaller than {} resetting beams'.format(min_dim))
@@ -318,12 +1185,27 @@ def check_min_jaws(plan_opt, min_dim):
                     y1 = math.floor(10 * y1) / 10
                     logging.debug('y-aperture is being set to Y1={}, Y2={}'.format(y1, y2))
                 else:
-                    y2 = s.JawPositions[3]
-                    y1 = s.JawPositions[2]
+                    y2 = float(jaws[-1, 3])
+                    y1 = float(jaws[-1, 2])
                 if min_x_aperture <= min_dim or min_y_aperture <= min_dim:
                     logging.info('Jaw size offset necessary on beam: {}, X = {}, Y = {}, with min dimension {}'
                                  .format(b.ForBeam.Name, min_x_aperture, min_y_aperture, min_dim))
                     jaw_change = True
+                    # Move the locked jaws off any carriage or y-jaw violation of the current leaf positions,
+                    # keeping the minimum aperture
+                    machine_name = b.ForBeam.MachineReference.MachineName
+                    if machine_name not in machines:
+                        machines[machine_name] = GeneralOperations.get_machine(machine_name=machine_name)
+                    beam_mlc = BeamOperations.mlc_properties(b.ForBeam, machine=machines[machine_name])
+                    if beam_mlc.has_segments:
+                        constrained = beam_mlc.constrain_jaws([x1, x2, y1, y2], min_aperture=min_dim)
+                        if constrained != [x1, x2, y1, y2]:
+                            logging.debug('Locked jaws on beam {} moved from {} to {} to satisfy MLC limits'
+                                          .format(b.ForBeam.Name, [x1, x2, y1, y2], constrained))
+                            x1, x2, y1, y2 = constrained
+                    if telemetry is not None:
+                        telemetry.emit('JawLock', Beam=b.ForBeam.Name, Jaws=[x1, x2, y1, y2],
+                                       MinimumAperture=[min_x_aperture, min_y_aperture], MinDimension=min_dim)
                     try:
                         # Uncomment to automatically set jaw limits
                         b.EditBeamOptimizationSettings(
@@ -347,7 +1229,7 @@ def check_min_jaws(plan_opt, min_dim):
     return jaw_change
 
 
-def reduce_oar_dose(plan_optimization):
+def reduce_oar_dose(plan_optimization, headless=False):
     """
     Function will search the objective list and sort by target and oar generates
     then executes the reduce_oar command.
@@ -374,8 +1256,9 @@ def reduce_oar_dose(plan_optimization):
             composite_objectives.append(index)
     # If composite objectives are found warn the user
     if composite_objectives:
-        connect.await_user_input("ReduceOAR with composite optimization is not supported " +
-                                 "by RaySearch at this time")
+        if not headless:
+            connect.await_user_input("ReduceOAR with composite optimization is not supported " +
+                                     "by RaySearch at this time")
         logging.warning("reduce_oar_dose: " +
                         "RunReduceOARDoseOptimization not executed due to the presence of" +
                         "CompositeDose objectives")
@@ -414,6 +1297,7 @@ def reduce_oar_dose(plan_optimization):
                 OrgansAtRiskToImprove=oars,
                 TargetsToMaintain=targets,
                 OrgansAtRiskToMaintain=oars)
+            invalidate_optimized_snapshots(plan_optimization)
             return True
         except:
             return False
@@ -482,6 +1366,15 @@ def optimization_report(fluence_only, vary_grid, reduce_oar, segment_weight, **r
                         iteration, time_iteration_delta.total_seconds()))
                     on_screen_message += "Iteration {}: Time Required {} s\n".format(
                         iteration + 1, time_iteration_delta.total_seconds())
+                convergence = report_inputs.get('convergence')
+                if convergence is not None:
+                    for iteration, total in enumerate(convergence.totals):
+                        logging.info("Objective: Aperture-based optimization iteration {}: {}".format(
+                            iteration, total))
+                if report_inputs.get('seed') is not None:
+                    on_screen_message += "Seeded from library solution {}\n".format(report_inputs['seed'])
+                if report_inputs.get('stop_reason') is not None:
+                    on_screen_message += "Warm starts stopped early: {}\n".format(report_inputs['stop_reason'])
                 logging.info("Time: Total Aperture-based optimization (seconds): {}".format(
                     time_iteration_total.total_seconds()))
                 logcrit("Time: Total Aperture-based optimization (seconds): {}".format(
@@ -503,6 +1396,11 @@ def optimization_report(fluence_only, vary_grid, reduce_oar, segment_weight, **r
                         grid_change, time_dose_grid_delta.total_seconds()))
                 logging.info("Time: Dose Grid changes (seconds): {}".format(
                     time_dose_grid.total_seconds()))
+                for switch in report_inputs.get('grid_switches', []):
+                    logging.info("Dose Grid: {} cm before iteration {}, improvement {}, {} s".format(
+                        switch['Grid'], switch['Iteration'] + 1, switch['Improvement'], switch['Seconds']))
+                    on_screen_message += "Dose grid changed to {} cm before iteration {}\n".format(
+                        switch['Grid'], switch['Iteration'] + 1)
                 on_screen_message += "Total time of the dose grid changes was: {} s\n".format(
                     time_dose_grid.total_seconds())
             except KeyError:
@@ -585,11 +1483,29 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
         dose_dim4 = optimization_inputs.get('dose_dim4', 0.2)
 
     maximum_iteration = optimization_inputs.get('n_iterations', 12)
+    # Relative objective improvement below which an adaptive dose grid is refined, None for a fixed schedule
+    grid_refine_tolerance = optimization_inputs.get('grid_refine_tolerance', None)
     fluence_only = optimization_inputs.get('fluence_only', False)
     reset_beams = optimization_inputs.get('reset_beams', True)
     reduce_oar = optimization_inputs.get('reduce_oar', True)
     segment_weight = optimization_inputs.get('segment_weight', False)
     gantry_spacing = optimization_inputs.get('gantry_spacing', 2)
+    # Run without dialogs or the status window, e.g. from a batch queue
+    headless = optimization_inputs.get('headless', False)
+    # Save the patient and write a checkpoint every checkpoint_every warm starts (0 for no checkpoints),
+    # resume continues from the last checkpoint of this beamset
+    checkpoint_every = optimization_inputs.get('checkpoint_every', 0)
+    resume = optimization_inputs.get('resume', False)
+    # Seed the beams from the nearest solution of the protocol and beamset template library, see SolutionLibrary
+    seed_protocol = optimization_inputs.get('seed_protocol', None)
+    seed_template = optimization_inputs.get('seed_template', None)
+    # Evaluate the clinical goals after each warm start, see GoalEvaluation
+    goal_evaluation = optimization_inputs.get('goal_evaluation', False)
+    # Early termination of the warm starts, see ConvergencePolicy
+    convergence = ConvergencePolicy(
+        tolerance=optimization_inputs.get('convergence_tolerance', None),
+        window=optimization_inputs.get('convergence_window', 2),
+        time_budget=optimization_inputs.get('time_budget', None))
 
     # Reporting
     report_inputs = {
@@ -599,7 +1515,8 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
         'second_intermediate_iteration': second_intermediate_iteration,
         'maximum_iteration': maximum_iteration,
         'reset_beams': reset_beams,
-        'gantry_spacing': gantry_spacing
+        'gantry_spacing': gantry_spacing,
+        'convergence': convergence
     }
     if vary_grid:
         report_inputs['dose_dim1'] = dose_dim1
@@ -610,22 +1527,32 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
     # Start the clock on the script at this time
     # Timing
     report_inputs['time_total_initial'] = datetime.datetime.now()
-
+    telemetry = OptimizationTelemetry(patient, plan, beamset,
+                                      directory=optimization_inputs.get('telemetry_dir', None),
+                                      enabled=optimization_inputs.get('telemetry', False))
+    telemetry.emit('Start', Inputs={k: v for k, v in optimization_inputs.items()
+                                    if isinstance(v, (bool, int, float, str)) or v is None})
+    checkpoint = OptimizationCheckpoint(patient, plan, beamset, optimization_inputs,
+                                        directory=optimization_inputs.get('checkpoint_dir', None),
+                                        enabled=checkpoint_every > 0 and not fluence_only)
+    resumed = False
+    if resume and not fluence_only:
+        resumed = checkpoint.load()
+        if resumed:
+            logcrit('{} optimization resumed from checkpoint after {} warm starts, saved {}'.format(
+                beamset.DicomPlanLabel, checkpoint.state['Iteration'], checkpoint.state['Saved']))
+            telemetry.emit('Resume', iteration=checkpoint.state['Iteration'], Completed=checkpoint.state['Completed'])
+
+    run_complete = False
     if fluence_only:
         logging.info('Fluence only: {}'.format(fluence_only))
     else:
         # If the dose grid is to be varied during optimization unload the grid parameters
         if vary_grid:
-            variable_dose_grid = {
-                'delta_grid': [dose_dim1,
-                               dose_dim2,
-                               dose_dim3,
-                               dose_dim4],
-                'grid_adjustment_iteration': [0,
-                                              int(maximum_iteration / 2),
-                                              int(3 * maximum_iteration / 4),
-                                              int(maximum_iteration - 1)]}
-            change_dose_grid = make_variable_grid_list(maximum_iteration, variable_dose_grid)
+            grid_scheduler = DoseGridScheduler(grids=[dose_dim1, dose_dim2, dose_dim3, dose_dim4],
+                                               n_iterations=maximum_iteration,
+                                               tolerance=grid_refine_tolerance)
+            report_inputs['grid_switches'] = grid_scheduler.switches
 
     save_at_complete = optimization_inputs.get('save', False)
     # Making the variable status script, arguably move to main()
@@ -637,10 +1564,10 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
         status_steps.append('Optimize Fluence Only')
     else:
         for i in range(maximum_iteration):
-            # Update message for changing the dose grids.
-            if vary_grid:
-                if change_dose_grid[i] != 0:
-                    status_steps.append('Change dose grid to: {} cm'.format(change_dose_grid[i]))
+            # Update message for changing the dose grids. Adaptive grid changes are reported with the iteration
+            if vary_grid and not grid_scheduler.adaptive:
+                if grid_scheduler.schedule[i] != 0:
+                    status_steps.append('Change dose grid to: {} cm'.format(grid_scheduler.schedule[i]))
             ith_step = 'Complete Iteration:' + str(i + 1)
             status_steps.append(ith_step)
         if segment_weight:
@@ -659,10 +1586,13 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
     ))
 
     # Change the status steps to indicate each iteration
-    status = UserInterface.ScriptStatus(
-        steps=status_steps,
-        docstring=__doc__,
-        help=__help__)
+    if headless:
+        status = HeadlessStatus(steps=status_steps)
+    else:
+        status = UserInterface.ScriptStatus(
+            steps=status_steps,
+            docstring=__doc__,
+            help=__help__)
 
     status.next_step("Setting initialization variables")
     logging.info('Set some variables like Niterations, Nits={}'.format(maximum_iteration))
@@ -723,9 +1653,13 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
     # Note: pretty worried about the hard-coded zero above. I don't know when it gets incremented
     # it is clear than when co-optimization occurs, we have more than one entry in here...
 
-    # Reset
-    if reset_beams:
+    # Reset, unless resuming from a checkpoint
+    if reset_beams and resumed:
+        status.next_step("Resuming optimization, reset skipped")
+    elif reset_beams:
+        time_initial = datetime.datetime.now()
         plan.PlanOptimizations[OptIndex].ResetOptimization()
+        telemetry.emit('Reset', time_initial=time_initial)
         status.next_step("Resetting Optimization")
 
     if plan_optimization.Objective.FunctionValue is None:
@@ -746,6 +1680,7 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
         # Start the clock for the fluence only optimization
         report_inputs.setdefault('time_iteration_initial', []).append(datetime.datetime.now())
         plan.PlanOptimizations[OptIndex].RunOptimization()
+        invalidate_optimized_snapshots(plan_optimization)
         # Stop the clock
         report_inputs.setdefault('time_iteration_final', []).append(datetime.datetime.now())
         # Consider converting this to the report_inputs
@@ -754,12 +1689,24 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
             current_objective_function = 0
         else:
             current_objective_function = plan_optimization.Objective.FunctionValue.FunctionValue
+        total, function_values = objective_values(plan_optimization)
+        telemetry.emit('Fluence', iteration=1, time_initial=report_inputs['time_iteration_initial'][-1],
+                       time_final=report_inputs['time_iteration_final'][-1], Objective=total,
+                       Functions=function_values, **plan_state(plan, plan_optimization))
         logging.info('Current total objective function value at iteration {} is {}'.format(
             Optimization_Iteration, current_objective_function))
         reduce_oar_success = False
     else:
         logging.info('Full optimization')
-        for ts in treatment_setup_settings:
+        # Index the optimization settings once for all beam limit checks
+        settings_index = BeamOperations.OptimizationSettingsIndex(plan)
+        # Beam and jaw setup is already complete in a resumed optimization
+        time_initial = datetime.datetime.now()
+        if checkpoint.completed('Setup'):
+            setup_settings = []
+        else:
+            setup_settings = treatment_setup_settings
+        for ts in setup_settings:
             # Set properties of the beam optimization
             if ts.ForTreatmentSetup.DeliveryTechnique == 'TomoHelical':
                 logging.debug('Tomo plan - control point spacing not set')
@@ -803,21 +1750,27 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
                     logging.info('Current Machine is {} setting max jaw limits'.format(machine_ref))
 
                     limit = [-20, 20, -10.8, 10.8]
+                    limits = {}
                     for beams in ts.BeamSettings:
-                        # Reference the beamset by the subobject in ForTreatmentSetup
-                        success = BeamOperations.check_beam_limits(beams.ForBeam.Name,
-                                                                   plan=plan,
-                                                                   beamset=ts.ForTreatmentSetup,
-                                                                   limit=limit,
-                                                                   change=True,
-                                                                   verbose_logging=True)
-                        if not success:
+                        limits[beams.ForBeam.Name] = limit
+                    # Reference the beamset by the subobject in ForTreatmentSetup
+                    success = BeamOperations.check_beamset_limits(plan=plan,
+                                                                  beamset=ts.ForTreatmentSetup,
+                                                                  limits=limits,
+                                                                  change=True,
+                                                                  verbose_logging=True,
+                                                                  settings_index=settings_index)
+                    telemetry.emit('JawLimits', Machine=machine_ref, Limits=limits, Success=success)
+                    checkpoint.state['JawLimits'][ts.ForTreatmentSetup.DicomPlanLabel] = success
+                    for beam_name in limits:
+                        if not success[beam_name]:
                             # If there are MU then this field has already been optimized with the wrong jaw limits
                             # For Shame....
                             logging.debug('This beamset is already optimized with unconstrained jaws. Reset needed')
-                            UserInterface.WarningBox('Restart Required: Attempt to limit TrueBeamSTx ' +
-                                                     'jaws failed - check reset beams' +
-                                                     ' on next attempt at this script')
+                            if not headless:
+                                UserInterface.WarningBox('Restart Required: Attempt to limit TrueBeamSTx ' +
+                                                         'jaws failed - check reset beams' +
+                                                         ' on next attempt at this script')
                             status.finish('Restart required')
                             sys.exit('Restart Required: Select reset beams on next run of script.')
             elif ts.ForTreatmentSetup.DeliveryTechnique == 'DynamicArc':
@@ -841,9 +1794,10 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
                                 # If there are MU then this field has already been optimized with the wrong gantry
                                 # spacing. For shame....
                                 logging.info('This beamset is already optimized with > 2 degrees.  Reset needed')
-                                UserInterface.WarningBox('Restart Required: Attempt to correct final gantry ' +
-                                                         'spacing failed - check reset beams' +
-                                                         ' on next attempt at this script')
+                                if not headless:
+                                    UserInterface.WarningBox('Restart Required: Attempt to correct final gantry ' +
+                                                             'spacing failed - check reset beams' +
+                                                             ' on next attempt at this script')
                                 status.finish('Restart required')
                                 sys.exit('Restart Required: Select reset beams on next run of script.')
                             else:
@@ -853,21 +1807,27 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
                 if machine_ref == 'TrueBeamSTx':
                     logging.info('Current Machine is {} setting max jaw limits'.format(machine_ref))
                     limit = [-20, 20, -10.8, 10.8]
+                    limits = {}
                     for beams in ts.BeamSettings:
-                        # Reference the beamset by the subobject in ForTreatmentSetup
-                        success = BeamOperations.check_beam_limits(beams.ForBeam.Name,
-                                                                   plan=plan,
-                                                                   beamset=ts.ForTreatmentSetup,
-                                                                   limit=limit,
-                                                                   change=True,
-                                                                   verbose_logging=True)
-                        if not success:
+                        limits[beams.ForBeam.Name] = limit
+                    # Reference the beamset by the subobject in ForTreatmentSetup
+                    success = BeamOperations.check_beamset_limits(plan=plan,
+                                                                  beamset=ts.ForTreatmentSetup,
+                                                                  limits=limits,
+                                                                  change=True,
+                                                                  verbose_logging=True,
+                                                                  settings_index=settings_index)
+                    telemetry.emit('JawLimits', Machine=machine_ref, Limits=limits, Success=success)
+                    checkpoint.state['JawLimits'][ts.ForTreatmentSetup.DicomPlanLabel] = success
+                    for beam_name in limits:
+                        if not success[beam_name]:
                             # If there are MU then this field has already been optimized with the wrong jaw limits
                             # For Shame....
                             logging.debug('This beamset is already optimized with unconstrained jaws. Reset needed')
-                            UserInterface.WarningBox('Restart Required: Attempt to limit TrueBeamSTx ' +
-                                                     'jaws failed - check reset beams' +
-                                                     ' on next attempt at this script')
+                            if not headless:
+                                UserInterface.WarningBox('Restart Required: Attempt to limit TrueBeamSTx ' +
+                                                         'jaws failed - check reset beams' +
+                                                         ' on next attempt at this script')
                             status.finish('Restart required')
                             sys.exit('Restart Required: Select reset beams on next run of script.')
                 # for beams in ts.BeamSettings:
@@ -935,39 +1895,100 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
             #         ts.SegmentConversion.MinNumberOfOpenLeafPairs = min_leaf_pairs
             #         ts.SegmentConversion.MinLeafEndSeparation = min_leaf_end_separation
             #         ts.SegmentConversion.MaxNumberOfSegments = str(maximum_segments)
-
-        while Optimization_Iteration != maximum_iteration:
+        if not checkpoint.completed('Setup'):
+            checkpoint.complete('Setup', seconds=(datetime.datetime.now() - time_initial).total_seconds())
+            checkpoint.save(patient)
+
+        seed_solution = None
+        if seed_protocol is not None and seed_template is not None:
+            # The solution is stored in the library when the plan is approved, see store_solutions
+            register_solution(patient, plan, beamset, seed_protocol, seed_template,
+                              directory=optimization_inputs.get('seed_dir', None))
+        if seed_protocol is not None and seed_template is not None and not resumed:
+            seed_library = SolutionLibrary(seed_protocol, seed_template,
+                                           directory=optimization_inputs.get('seed_dir', None))
+            seed_solution, seed_distance = seed_library.nearest(
+                case, beamset, target=optimization_inputs.get('seed_target', None),
+                max_distance=optimization_inputs.get('seed_max_distance', None))
+            if seed_solution is not None:
+                logging.info('Nearest library solution is {}, distance {:.2f}'.format(
+                    seed_library.label(seed_solution), seed_distance))
+
+        stop_reason = None
+        if resumed:
+            # Continue the warm starts, grid schedule and objective history from the checkpoint
+            Optimization_Iteration = checkpoint.state['Iteration']
+            stop_reason = checkpoint.state['StopReason']
+            convergence.totals = list(checkpoint.state['Totals'])
+            convergence.values = list(checkpoint.state['Values'])
+            convergence.times = [0.] * len(convergence.totals)
+            if vary_grid and checkpoint.state['Grid'] is not None:
+                grid_scheduler.restore(checkpoint.state['Grid'])
+                convergence.grid_start = grid_scheduler.switch_iteration
+            if Optimization_Iteration > 0:
+                plan_optimization_parameters.Algorithm.MaxNumberOfIterations = second_maximum_iteration
+                plan_optimization_parameters.DoseCalculation.IterationsInPreparationsPhase = \
+                    second_intermediate_iteration
+                status.next_step(
+                    text='Resuming after iteration {} of {}'.format(Optimization_Iteration, maximum_iteration),
+                    num=status_steps.index('Complete Iteration:' + str(Optimization_Iteration)))
+        if seed_solution is not None:
+            # Seed the beams once before the first iteration. The library segments replace existing segments, so
+            # beams without segments are first converted to segments with a short optimization
+            if not all(BeamOperations.beam_snapshot(b).has_segments for b in beamset.Beams):
+                logging.info('Converting {} to segments before seeding'.format(beamset.DicomPlanLabel))
+                convert_segments(plan_optimization, initial_intermediate_iteration)
+            seeded = seed_library.seed(beamset, seed_solution)
+            if seeded:
+                logcrit('{} seeded from library solution {}, {} beams'.format(
+                    beamset.DicomPlanLabel, seed_library.label(seed_solution), seeded))
+                telemetry.emit('Seed', iteration=Optimization_Iteration, SeedPlan=seed_solution['Plan'],
+                               Distance=seed_distance, Beams=seeded)
+                report_inputs['seed'] = seed_library.label(seed_solution)
+                # A seeded plan continues as a warm start
+                plan_optimization_parameters.Algorithm.MaxNumberOfIterations = second_maximum_iteration
+                plan_optimization_parameters.DoseCalculation.IterationsInPreparationsPhase = \
+                    second_intermediate_iteration
+            else:
+                logging.info('The segments of {} do not match library solution {}, not seeded'.format(
+                    beamset.DicomPlanLabel, seed_library.label(seed_solution)))
+        while Optimization_Iteration != maximum_iteration and not checkpoint.completed('Converged'):
             if plan_optimization.Objective.FunctionValue is None:
                 previous_objective_function = 0
             else:
                 previous_objective_function = plan_optimization.Objective.FunctionValue.FunctionValue
-            # If the change_dose_grid list has a non-zero element change the dose grid
+            # If the grid scheduler returns a non-zero grid change the dose grid
             if vary_grid:
-                if change_dose_grid[Optimization_Iteration] != 0:
-                    status.next_step(
-                        'Variable dose grid used.  Dose grid now {} cm'.format(
-                            change_dose_grid[Optimization_Iteration]))
-                    logging.info(
-                        'Running current value of change_dose_grid is {}'.format(change_dose_grid))
-                    DoseDim = change_dose_grid[Optimization_Iteration]
-                    # Start Clock on the dose grid change
-                    report_inputs.setdefault('time_dose_grid_initial', []).append(datetime.datetime.now())
-                    plan.SetDefaultDoseGrid(
-                        VoxelSize={
-                            'x': DoseDim,
-                            'y': DoseDim,
-                            'z': DoseDim})
-                    plan.TreatmentCourse.TotalDose.UpdateDoseGridStructures()
-                    # Stop the clock for the dose grid change
-                    report_inputs.setdefault('time_dose_grid_final', []).append(datetime.datetime.now())
+                DoseDim = grid_scheduler.next_grid(Optimization_Iteration, convergence.totals)
+                if DoseDim != 0:
+                    if not grid_scheduler.adaptive:
+                        status.next_step('Variable dose grid used.  Dose grid now {} cm'.format(DoseDim))
+                        logging.info(
+                            'Running current value of change_dose_grid is {}'.format(grid_scheduler.schedule))
+                    else:
+                        logging.info('Adaptive dose grid changed to {} cm at iteration {}'.format(
+                            DoseDim, Optimization_Iteration + 1))
+                    improvement = convergence.relative_improvement(window=1)
+                    time_initial, time_final = grid_scheduler.apply(plan, Optimization_Iteration, DoseDim,
+                                                                    improvement=improvement)
+                    convergence.grid_changed()
+                    report_inputs.setdefault('time_dose_grid_initial', []).append(time_initial)
+                    report_inputs.setdefault('time_dose_grid_final', []).append(time_final)
+                    telemetry.emit('GridChange', iteration=Optimization_Iteration + 1, time_initial=time_initial,
+                                   time_final=time_final, Grid=DoseDim, Adaptive=grid_scheduler.adaptive)
             # Start the clock
             report_inputs.setdefault('time_iteration_initial', []).append(datetime.datetime.now())
-            status.next_step(
-                text='Running current iteration = {} of {}'.format(Optimization_Iteration + 1, maximum_iteration))
+            if vary_grid and grid_scheduler.adaptive:
+                status.next_step(text='Running current iteration = {} of {} on the {} cm dose grid'.format(
+                    Optimization_Iteration + 1, maximum_iteration, grid_scheduler.current))
+            else:
+                status.next_step(
+                    text='Running current iteration = {} of {}'.format(Optimization_Iteration + 1, maximum_iteration))
             logging.info(
                 'Current iteration = {} of {}'.format(Optimization_Iteration + 1, maximum_iteration))
             # Run the optimization
             plan.PlanOptimizations[OptIndex].RunOptimization()
+            invalidate_optimized_snapshots(plan_optimization)
             # Stop the clock
             report_inputs.setdefault('time_iteration_final', []).append(datetime.datetime.now())
             Optimization_Iteration += 1
@@ -976,16 +1997,87 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
             plan_optimization_parameters.Algorithm.MaxNumberOfIterations = second_maximum_iteration
             plan_optimization_parameters.DoseCalculation.IterationsInPreparationsPhase = second_intermediate_iteration
             # Outputs for debug
-            current_objective_function = plan_optimization.Objective.FunctionValue.FunctionValue
+            current_objective_function, function_values = objective_values(plan_optimization)
+            convergence.record(current_objective_function, function_values)
+            telemetry.emit('Iteration', iteration=Optimization_Iteration,
+                           time_initial=report_inputs['time_iteration_initial'][-1],
+                           time_final=report_inputs['time_iteration_final'][-1], Objective=current_objective_function,
+                           Functions=function_values, **plan_state(plan, plan_optimization))
             logging.info(
                 'At iteration {} total objective function is {}, compared to previous {}'.format(
                     Optimization_Iteration,
                     current_objective_function,
                     previous_objective_function))
             previous_objective_function = current_objective_function
+            if goal_evaluation:
+                # The dose fingerprint tells if the warm start changed the dose
+                goal_cache = GoalEvaluation.get_cache(patient=patient, case=case,
+                                                      exam=beamset.GetPlanningExamination(), plan=plan)
+                goal_results = goal_cache.evaluate()
+                failed_goals = [r.goal for r in goal_results if r.passed is False]
+                logging.info('At iteration {} {} of {} clinical goals fail: {}'.format(
+                    Optimization_Iteration, len(failed_goals), len(goal_results), '; '.join(failed_goals)))
+            checkpoint.complete('Iteration:{}'.format(Optimization_Iteration),
+                                seconds=(report_inputs['time_iteration_final'][-1] -
+                                         report_inputs['time_iteration_initial'][-1]).total_seconds(),
+                                Iteration=Optimization_Iteration, Totals=convergence.totals,
+                                Values=convergence.values,
+                                Grid=grid_scheduler.state() if vary_grid else None)
+            if checkpoint_every > 0 and Optimization_Iteration % checkpoint_every == 0:
+                checkpoint.save(patient)
+            stop_reason = convergence.stop_reason()
+            if stop_reason is not None and Optimization_Iteration != maximum_iteration:
+                logcrit('{} warm starts stopped after iteration {} of {}: {}'.format(
+                    beamset.DicomPlanLabel, Optimization_Iteration, maximum_iteration, stop_reason))
+                break
+
+        # After an early stop, finish with one warm start on the final dose grid if a grid change is pending
+        if stop_reason is not None and Optimization_Iteration != maximum_iteration and \
+                not checkpoint.completed('Converged'):
+            pending_grid = 0
+            if vary_grid:
+                pending_grid = grid_scheduler.pending_grid(Optimization_Iteration)
+            last_iteration_step = status_steps.index('Complete Iteration:' + str(maximum_iteration))
+            if pending_grid:
+                status.next_step(text='Optimization converged: {}'.format(stop_reason), num=last_iteration_step - 1)
+                DoseDim = pending_grid
+                logging.info('Pending dose grid change to {} cm applied after early stop'.format(DoseDim))
+                time_initial, time_final = grid_scheduler.apply(plan, Optimization_Iteration, DoseDim,
+                                                                improvement=convergence.relative_improvement(window=1))
+                convergence.grid_changed()
+                report_inputs.setdefault('time_dose_grid_initial', []).append(time_initial)
+                report_inputs.setdefault('time_dose_grid_final', []).append(time_final)
+                telemetry.emit('GridChange', iteration=Optimization_Iteration + 1, time_initial=time_initial,
+                               time_final=time_final, Grid=DoseDim, Adaptive=grid_scheduler.adaptive)
+                status.next_step(text='Running final iteration on the {} cm dose grid'.format(DoseDim))
+                report_inputs.setdefault('time_iteration_initial', []).append(datetime.datetime.now())
+                plan.PlanOptimizations[OptIndex].RunOptimization()
+                invalidate_optimized_snapshots(plan_optimization)
+                report_inputs.setdefault('time_iteration_final', []).append(datetime.datetime.now())
+                Optimization_Iteration += 1
+                current_objective_function, function_values = objective_values(plan_optimization)
+                convergence.record(current_objective_function, function_values)
+                telemetry.emit('Iteration', iteration=Optimization_Iteration,
+                               time_initial=report_inputs['time_iteration_initial'][-1],
+                               time_final=report_inputs['time_iteration_final'][-1],
+                               Objective=current_objective_function, Functions=function_values,
+                               **plan_state(plan, plan_optimization))
+                logging.info('At final iteration {} total objective function is {}'.format(
+                    Optimization_Iteration, current_objective_function))
+            else:
+                status.next_step(text='Optimization converged: {}'.format(stop_reason), num=last_iteration_step)
+        report_inputs['stop_reason'] = stop_reason
+        if stop_reason is not None and not checkpoint.completed('Converged'):
+            telemetry.emit('Converged', iteration=Optimization_Iteration, Reason=stop_reason)
+            checkpoint.complete('Converged', Iteration=Optimization_Iteration, StopReason=stop_reason,
+                                Totals=convergence.totals, Values=convergence.values,
+                                Grid=grid_scheduler.state() if vary_grid else None)
+            checkpoint.save(patient)
 
         # Finish with a Reduce OAR Dose Optimization
-        if segment_weight:
+        if segment_weight and checkpoint.completed('SegmentWeight'):
+            status.next_step('Segment weight only optimization completed before resuming')
+        elif segment_weight:
             if beamset.DeliveryTechnique == 'TomoHelical':
                 status.next_step('TomoHelical Plan skipping Segment weight only optimization')
                 logging.warning('Segment weight based optimization is not supported for TomoHelical')
@@ -998,8 +2090,9 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
                 if cooptimization:
                     logging.warning("Co-optimized segment weight-based optimization is" +
                                     " not supported by RaySearch at this time.")
-                    connect.await_user_input("Segment-weight optimization with composite optimization is not supported " +
-                                             "by RaySearch at this time")
+                    if not headless:
+                        connect.await_user_input("Segment-weight optimization with composite optimization is not " +
+                                                 "supported by RaySearch at this time")
                 else:
                     for ts in treatment_setup_settings:
                         for beams in ts.BeamSettings:
@@ -1008,31 +2101,65 @@ def optimize_plan(patient, case, plan, beamset, **optimization_inputs):
                                     OptimizationTypes=["SegmentMU"]
                                 )
                     plan.PlanOptimizations[OptIndex].RunOptimization()
+                    invalidate_optimized_snapshots(plan_optimization)
                     logging.info('Current total objective function value at iteration {} is {}'.format(
                         Optimization_Iteration, plan_optimization.Objective.FunctionValue.FunctionValue))
                 report_inputs['time_segment_weight_final'] = datetime.datetime.now()
+                total, function_values = objective_values(plan_optimization)
+                telemetry.emit('SegmentWeight', time_initial=report_inputs['time_segment_weight_initial'],
+                               time_final=report_inputs['time_segment_weight_final'], Objective=total,
+                               Functions=function_values, **plan_state(plan, plan_optimization))
+            checkpoint.complete('SegmentWeight', seconds=(report_inputs['time_segment_weight_final'] -
+                                                          report_inputs['time_segment_weight_initial']).total_seconds())
+            checkpoint.save(patient)
 
         # Finish with a Reduce OAR Dose Optimization
         reduce_oar_success = False
-        if reduce_oar:
+        if reduce_oar and checkpoint.completed('ReduceOAR'):
+            status.next_step('Reduce OAR dose completed before resuming')
+            reduce_oar_success = checkpoint.state['ReduceOARSuccess']
+        elif reduce_oar:
             if beamset.DeliveryTechnique == 'TomoHelical':
                 status.next_step('TomoHelical Plan skipping reduce oar dose optimization')
                 logging.warning('Segment weight based optimization is not supported for TomoHelical')
                 report_inputs['time_reduce_oar_initial'] = datetime.datetime.now()
                 report_inputs['time_reduce_oar_final'] = datetime.datetime.now()
+                checkpoint.complete('ReduceOAR', ReduceOARSuccess=False)
             else:
                 status.next_step('Running ReduceOar Dose')
                 report_inputs['time_reduceoar_initial'] = datetime.datetime.now()
-                reduce_oar_success = reduce_oar_dose(plan_optimization=plan_optimization)
+                reduce_oar_success = reduce_oar_dose(plan_optimization=plan_optimization, headless=headless)
                 report_inputs['time_reduceoar_final'] = datetime.datetime.now()
+                total, function_values = objective_values(plan_optimization)
+                telemetry.emit('ReduceOAR', time_initial=report_inputs['time_reduceoar_initial'],
+                               time_final=report_inputs['time_reduceoar_final'], Success=reduce_oar_success,
+                               Objective=total, Functions=function_values, **plan_state(plan, plan_optimization))
                 if reduce_oar_success:
                     logging.info('ReduceOAR successfully completed')
                 else:
                     logging.warning('ReduceOAR failed')
                 logging.info('Current total objective function value at iteration {} is {}'.format(
                     Optimization_Iteration, plan_optimization.Objective.FunctionValue))
+                # A failed Reduce OAR dose is run again when the optimization is resumed
+                if reduce_oar_success:
+                    checkpoint.complete('ReduceOAR', seconds=(report_inputs['time_reduceoar_final'] -
+                                                              report_inputs['time_reduceoar_initial']).total_seconds(),
+                                        ReduceOARSuccess=reduce_oar_success)
+                    checkpoint.save(patient)
+
+        run_complete = (Optimization_Iteration == maximum_iteration or checkpoint.completed('Converged')) and \
+            (not segment_weight or checkpoint.completed('SegmentWeight')) and \
+            (not reduce_oar or checkpoint.completed('ReduceOAR'))
 
     report_inputs['time_total_final'] = datetime.datetime.now()
+    telemetry.emit('Finish', time_initial=report_inputs['time_total_initial'],
+                   time_final=report_inputs['time_total_final'])
+    # Only a complete run removes its checkpoint, an aborted or failed run can still be resumed
+    if fluence_only or run_complete:
+        checkpoint.clear()
+    elif checkpoint.enabled:
+        logging.warning('Optimization of {} did not complete, checkpoint {} kept for resume'.format(
+            beamset.DicomPlanLabel, checkpoint.path))
     if save_at_complete:
         try:
             patient.Save()
@@ -0,0 +1,333 @@
+""" Optimization Runtime
+
+    Predicts the wall time of an optimize_plan run from the telemetry of earlier runs, and suggests the cheapest
+    optimization configuration that historically reached a given objective value. The module does not use
+    RayStation and can be run on any workstation with access to the telemetry files.
+
+    Each run in the telemetry (see OptimizationOperations.OptimizationTelemetry) is summarized by its configuration
+    (n_iterations, vary_grid, gantry_spacing) and plan size (beams, control points, dose grid voxels and ROIs with
+    objectives). A least squares model of log wall time on the log of these features is fit to the runs.
+
+    Example Usage:
+    import OptimizationRuntime
+    runs = OptimizationRuntime.read_runs()
+    model = OptimizationRuntime.RuntimeModel().fit(runs)
+    seconds = model.predict({'n_iterations': 6, 'vary_grid': True, 'gantry_spacing': 2,
+                             'Beams': 2, 'ControlPoints': 180, 'Voxels': 2.5e6, 'Rois': 14})
+    suggestions = OptimizationRuntime.suggest(runs, model, beamset='Pros_VMA_R_A_')
+
+    Command line:
+    python OptimizationRuntime.py predict --beams 2 --control-points 180 --voxels 2.5e6 --rois 14 --n-iterations 6
+    python OptimizationRuntime.py suggest --beamset Pros_VMA_R_A_
+
+    Version history:
+    1.0.0 Runtime model and configuration suggestions from optimize_plan telemetry
+    1.0.1 ConvergencePolicy moved from OptimizationOperations, improvement measured on one dose grid only
+    1.0.2 Telemetry identifies patients by anonymous_id instead of the PatientID
+    1.0.3 anonymous_id is an HMAC with a random site secret (identity_key_path) rather than a plain hash
+    1.0.4 ConvergencePolicy moved back to OptimizationOperations
+
+    This program is free software: you can redistribute it and/or modify it under
+    the terms of the GNU General Public License as published by the Free Software
+    Foundation, either version 3 of the License, or (at your option) any later
+    version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT
+    ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+    FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+    """
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.4'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+import os
+import sys
+import json
+import hmac
+import hashlib
+import binascii
+import logging
+import argparse
+import numpy as np
+
+# Directory of the per-patient optimization telemetry files
+telemetry_dir = os.path.join(os.path.expanduser('~'), 'RayScripts', 'optimization_telemetry')
+# Secret of this site for anonymous_id, created on first use. It is kept outside of the repository and the
+# telemetry, so the identifiers can not be reversed by hashing candidate PatientIDs
+identity_key_path = os.path.join(os.path.expanduser('~'), 'RayScripts', 'identity_key')
+
+# Configuration inputs of a run and the optimize_plan default of each
+configuration_defaults = {'n_iterations': 12, 'vary_grid': False, 'gantry_spacing': 2}
+# Plan size of a run
+plan_features = ['Beams', 'ControlPoints', 'Voxels', 'Rois']
+
+# Secret read from identity_key_path
+_identity_key = None
+
+
+def identity_key(path=None):
+    """
+    The site secret of anonymous_id, a random key written to path on first use
+    :param path: key file, identity_key_path if None
+    :return: key bytes
+    """
+    global _identity_key
+    path = identity_key_path if path is None else path
+    if _identity_key is not None and _identity_key[0] == path:
+        return _identity_key[1]
+    if not os.path.isfile(path):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(binascii.hexlify(os.urandom(32)).decode('ascii'))
+        logging.info('Created the identity key {}'.format(path))
+    with open(path, 'r') as f:
+        key = f.read().strip().encode('ascii')
+    _identity_key = (path, key)
+    return key
+
+
+def anonymous_id(patient_id, key_path=None):
+    """
+    Identifier of a patient in the telemetry and the solution library, so they do not contain the PatientID
+    :param patient_id: PatientID
+    :param key_path: key file, identity_key_path if None
+    :return: the first 16 hexadecimal digits of the HMAC-SHA256 of the PatientID with the site secret
+    """
+    return hmac.new(identity_key(key_path), str(patient_id).encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+
+def read_records(paths=None, phase=None):
+    """
+    Read the records of telemetry files
+    :param paths: telemetry files or directories of telemetry files, telemetry_dir if not supplied
+    :param phase: only records of this phase are returned, None for all records
+    :return: list of record dictionaries in file order
+    """
+    if paths is None:
+        paths = [telemetry_dir]
+    elif not isinstance(paths, list):
+        paths = [paths]
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files += sorted(os.path.join(p, f) for f in os.listdir(p) if f.endswith('.jsonl'))
+        else:
+            files.append(p)
+    records = []
+    for f in files:
+        with open(f, 'r') as lines:
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.debug('Skipping unreadable telemetry line in {}'.format(f))
+                    continue
+                if phase is None or record.get('Phase') == phase:
+                    records.append(record)
+    return records
+
+
+def read_runs(paths=None):
+    """
+    Summarize each completed optimize_plan run in the telemetry
+    :param paths: telemetry files or directories of telemetry files, telemetry_dir if not supplied
+    :return: list of run dictionaries with Run, Patient, Plan, BeamSet, the configuration inputs, the plan features,
+        Iterations (warm starts run), Seconds (wall time) and Objective (final objective value)
+    """
+    grouped = {}
+    order = []
+    for r in read_records(paths):
+        if r.get('Run') not in grouped:
+            grouped[r.get('Run')] = []
+            order.append(r.get('Run'))
+        grouped[r.get('Run')].append(r)
+    runs = []
+    for key in order:
+        records = grouped[key]
+        phases = [r.get('Phase') for r in records]
+        if 'Finish' not in phases or 'Fluence' in phases or 'Resume' in phases:
+            # Only complete, uninterrupted aperture-based runs describe the cost of a configuration
+            continue
+        inputs = records[phases.index('Start')].get('Inputs', {}) if 'Start' in phases else {}
+        iterations = [r for r in records if r.get('Phase') == 'Iteration']
+        if not iterations:
+            continue
+        last = iterations[-1]
+        rois = set()
+        for r in iterations:
+            rois.update(k.split(':')[0] for k in (r.get('Functions') or {}))
+        run = {'Run': key,
+               'Patient': records[0].get('Patient'),
+               'Plan': records[0].get('Plan'),
+               'BeamSet': records[0].get('BeamSet'),
+               'Beams': len(last.get('Beams') or {}),
+               'ControlPoints': last.get('Segments'),
+               'Voxels': max(r.get('Voxels') or 0 for r in iterations),
+               'Rois': len(rois),
+               'Iterations': len(iterations),
+               'Seconds': records[phases.index('Finish')].get('Elapsed'),
+               'Objective': [r.get('Objective') for r in records if r.get('Objective') is not None][-1:]}
+        run['Objective'] = run['Objective'][0] if run['Objective'] else None
+        for k, v in configuration_defaults.items():
+            run[k] = inputs.get(k, v) if inputs.get(k) is not None else v
+        runs.append(run)
+    return runs
+
+
+def configuration(run):
+    # The configuration inputs of a run as a hashable key
+    return tuple((k, run.get(k, configuration_defaults[k])) for k in sorted(configuration_defaults))
+
+
+class RuntimeModel(object):
+    """
+    Least squares model of the log wall time of an optimize_plan run:
+    log(seconds) = c0 + c1 log(n_iterations) + c2 vary_grid + c3 log(gantry_spacing)
+                   + c4 log(beams) + c5 log(control points) + c6 log(voxels) + c7 log(rois)
+    A small ridge term keeps the fit stable when only a few configurations have been run.
+
+    coefficients: fitted coefficients, None before fit
+    residual: root mean square of the log residuals, used for the prediction range
+    n_runs: number of runs the model was fit to
+    """
+
+    ridge = 1e-3
+
+    def __init__(self):
+        self.coefficients = None
+        self.residual = None
+        self.n_runs = 0
+
+    @staticmethod
+    def features(run):
+        """
+        Feature vector of a run or a proposed configuration
+        :param run: dictionary with the configuration inputs and plan features
+        :return: numpy array
+        """
+        values = [run.get('n_iterations', configuration_defaults['n_iterations']),
+                  run.get('gantry_spacing', configuration_defaults['gantry_spacing'])]
+        values += [run.get(k) or 1 for k in plan_features]
+        logs = np.log(np.maximum(np.array(values, dtype=float), 1.))
+        return np.concatenate([[1., logs[0], float(bool(run.get('vary_grid', False)))], logs[1:]])
+
+    def fit(self, runs):
+        """
+        Fit the model to historical runs
+        :param runs: list of runs, see read_runs
+        :return: the model
+        """
+        runs = [r for r in runs if r.get('Seconds')]
+        if not runs:
+            raise ValueError('No completed optimization runs in the telemetry')
+        x = np.array([self.features(r) for r in runs])
+        y = np.log(np.array([r['Seconds'] for r in runs], dtype=float))
+        a = np.dot(x.T, x) + self.ridge * np.eye(x.shape[1])
+        self.coefficients = np.linalg.solve(a, np.dot(x.T, y))
+        self.residual = float(np.sqrt(np.mean((np.dot(x, self.coefficients) - y) ** 2)))
+        self.n_runs = len(runs)
+        logging.debug('Runtime model fit to {} runs, rms log residual {:.3f}'.format(self.n_runs, self.residual))
+        return self
+
+    def predict(self, run):
+        """
+        Predicted wall time of a run
+        :param run: dictionary with the configuration inputs and plan features
+        :return: predicted seconds
+        """
+        if self.coefficients is None:
+            raise ValueError('Runtime model has not been fit')
+        return float(np.exp(np.dot(self.features(run), self.coefficients)))
+
+    def predict_range(self, run):
+        # Predicted seconds and the one standard deviation range of the fit
+        seconds = self.predict(run)
+        return seconds, seconds * np.exp(-self.residual), seconds * np.exp(self.residual)
+
+
+def suggest(runs, model, plan=None, beamset=None, objective=None, tolerance=0.02):
+    """
+    Configurations that historically reached an objective value, cheapest predicted first
+    :param runs: list of runs, see read_runs
+    :param model: fitted RuntimeModel
+    :param plan: plan features {'Beams', 'ControlPoints', 'Voxels', 'Rois'}, the median of the matching runs if None
+    :param beamset: only runs of beamsets with this DicomPlanLabel are compared, all runs if None
+    :param objective: objective value to reach, the best objective of the matching runs if None
+    :param tolerance: relative tolerance on the objective value
+    :return: list of {'Configuration', 'Seconds' (predicted), 'Runs' (number reaching the objective),
+        'Objective' (best reached)} sorted by predicted seconds
+    """
+    matching = [r for r in runs if r.get('Objective') is not None and (beamset is None or r['BeamSet'] == beamset)]
+    if not matching:
+        return []
+    if objective is None:
+        objective = min(r['Objective'] for r in matching)
+    reached = [r for r in matching if r['Objective'] <= objective + tolerance * abs(objective)]
+    if plan is None:
+        plan = {k: float(np.median([r[k] or 1 for r in reached])) for k in plan_features}
+    suggestions = {}
+    for r in reached:
+        key = configuration(r)
+        if key not in suggestions:
+            proposal = dict(plan)
+            proposal.update(dict(key))
+            suggestions[key] = {'Configuration': dict(key), 'Seconds': model.predict(proposal), 'Runs': 0,
+                                'Objective': r['Objective']}
+        suggestions[key]['Runs'] += 1
+        suggestions[key]['Objective'] = min(suggestions[key]['Objective'], r['Objective'])
+    return sorted(suggestions.values(), key=lambda s: s['Seconds'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Predict optimize_plan wall time from telemetry')
+    parser.add_argument('command', choices=['predict', 'suggest'])
+    parser.add_argument('--telemetry', nargs='*', default=None,
+                        help='telemetry files or directories (default {})'.format(telemetry_dir))
+    parser.add_argument('--beams', type=int)
+    parser.add_argument('--control-points', type=int, help='total control points (segments) of all beams')
+    parser.add_argument('--voxels', type=float, help='dose grid voxels on the clinical grid')
+    parser.add_argument('--rois', type=int, help='ROIs with optimization functions')
+    parser.add_argument('--n-iterations', type=int, default=configuration_defaults['n_iterations'])
+    parser.add_argument('--vary-grid', action='store_true')
+    parser.add_argument('--gantry-spacing', type=float, default=configuration_defaults['gantry_spacing'])
+    parser.add_argument('--beamset', help='compare runs of this beamset DicomPlanLabel only')
+    parser.add_argument('--objective', type=float, help='objective value to reach (default: best in the telemetry)')
+    parser.add_argument('--tolerance', type=float, default=0.02, help='relative tolerance on the objective')
+    args = parser.parse_args(argv)
+
+    runs = read_runs(args.telemetry)
+    model = RuntimeModel().fit(runs)
+    print('Model fit to {} runs, typical error x{:.2f}'.format(model.n_runs, np.exp(model.residual)))
+    plan = {'Beams': args.beams, 'ControlPoints': args.control_points, 'Voxels': args.voxels, 'Rois': args.rois}
+    if args.command == 'predict':
+        missing = [k for k, v in plan.items() if v is None]
+        if missing:
+            parser.error('predict requires the plan features {}'.format(', '.join(sorted(missing))))
+        plan.update({'n_iterations': args.n_iterations, 'vary_grid': args.vary_grid,
+                     'gantry_spacing': args.gantry_spacing})
+        seconds, low, high = model.predict_range(plan)
+        print('Predicted wall time {:.0f} s ({:.0f} - {:.0f} s)'.format(seconds, low, high))
+    else:
+        if any(v is None for v in plan.values()):
+            plan = None
+        suggestions = suggest(runs, model, plan=plan, beamset=args.beamset, objective=args.objective,
+                              tolerance=args.tolerance)
+        if not suggestions:
+            print('No runs reached the objective')
+            return 1
+        for s in suggestions:
+            print('{:8.0f} s  objective {:.4g} in {} runs  {}'.format(
+                s['Seconds'], s['Objective'], s['Runs'],
+                ', '.join('{}={}'.format(k, v) for k, v in sorted(s['Configuration'].items()))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
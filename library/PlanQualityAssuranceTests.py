@@ -40,7 +40,9 @@ __license__ = 'GPLv3'
 __copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
 
 import logging
+import numpy as np
 import StructureOperations
+import BeamOperations
 
 
 def simfiducial_test(case, exam, poi=None):
@@ -73,15 +75,10 @@ def cps_test(beamset, nominal_cps=2):
     error = ''
     if beamset.DeliveryTechnique == 'DynamicArc':
         for b in beamset.Beams:
-            cps_error = False
             logging.debug('Beam name is {}'.format(b.Name))
-            s_o = 0
-            for s in b.Segments:
-                s_i = s.DeltaGantryAngle
-                cps_spacing = s_i - s_o
-                s_o = s_i
-                if cps_spacing > nominal_cps:
-                    cps_error = True
+            delta_gantry = BeamOperations.beam_snapshot(b).delta_gantry
+            cps_spacing = np.diff(np.concatenate(([0.], delta_gantry)))
+            cps_error = bool(np.any(cps_spacing > nominal_cps))
             if cps_error:
                 error += 'Beam {} has a control point with spacing exceeding {}\n'.format(b.Name, nominal_cps)
 
@@ -0,0 +1,613 @@
+""" Protocol Index
+
+    Parses the xml files of the protocols folder once into compact records of the protocols, orders,
+    prescriptions, goals, objectives, goal and objective sets, beamset templates and TG-263 structures.
+    The records are pickled to a cache file together with the modification time, size and md5 hash of each
+    file, so a file is only parsed again when it changes. Scripts that need the xml elements themselves
+    (e.g. the TPO dialog) use parse, which parses each file at most once per session.
+
+    Example Usage:
+    import ProtocolIndex
+    index = ProtocolIndex.get_index()
+    orders = index.orders(protocol='UW Prostate')
+    rois = index.roi_names(folder=os.path.join(ProtocolIndex.protocol_folder, 'UW'))
+    tree = ProtocolIndex.parse(orders[0].path)
+    # Goals of an order on the ROIs of a plan, keyed by plan ROI name
+    goals = index.match_rois(index.order_references(orders[0].name, kinds=['goal'],
+                                                    folder=os.path.dirname(orders[0].path)), ['PTV_p', 'Bladder'])
+    # ROI names and order names of a file without building its tree
+    names = [v for k, v in ProtocolIndex.stream(path, kinds=['roi', 'order'])]
+
+    Version history:
+    1.0.0 Protocol records cached by file modification time and hash
+    1.0.1 Inverted index of ROI (and TG-263 alias) and order name to the prescription, goal and objective records
+    1.0.2 Streaming loader for ROI names, TG-263 aliases and order names, used to index TG-263 files
+    1.0.3 Protocols and orders are indexed by (folder, name), so a protocol of the same name in another folder
+          (e.g. protocols/Retired) is no longer merged in. Retired folders are left out of the inverted index
+
+    This program is free software: you can redistribute it and/or modify it under
+    the terms of the GNU General Public License as published by the Free Software
+    Foundation, either version 3 of the License, or (at your option) any later
+    version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT
+    ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+    FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+    """
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.3'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+import os
+import copy
+import pickle
+import hashlib
+import logging
+import collections
+import xml.etree.ElementTree
+
+# Root of the protocol xml files
+protocol_folder = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'protocols'))
+# Pickled protocol records
+cache_path = os.path.join(os.path.expanduser('~'), 'RayScripts', 'protocol_index.pkl')
+# Increment when the records change, older cache files are then ignored
+cache_version = 2
+# Folders of protocols no longer in use, left out of the inverted index and of default folder lookups
+retired_folders = ('Retired',)
+
+# A <roi> entry of a prescription, goal, goal set or objective list. Numeric values are floats (None if absent),
+# attributes holds the xml attributes of the children as ('child.attribute', value) pairs
+# and the text of any other children as ('child', text) pairs
+RoiRecord = collections.namedtuple('RoiRecord', ['name', 'type', 'dose', 'volume', 'priority', 'weight',
+                                                 'attributes'])
+ProtocolRecord = collections.namedtuple('ProtocolRecord', ['name', 'path', 'institutions', 'diagnoses', 'ct',
+                                                           'prescriptions', 'goals', 'goalsets', 'objectivesets',
+                                                           'beamsets', 'orders'])
+OrderRecord = collections.namedtuple('OrderRecord', ['name', 'protocol', 'path', 'prefix', 'fractions',
+                                                     'techniques', 'prescriptions', 'goals', 'goalsets',
+                                                     'objectives', 'objectivesets', 'beamsets'])
+# Goal sets (kind 'goalset') and objective sets (kind 'objectiveset'), protocol is None for stand-alone files
+SetRecord = collections.namedtuple('SetRecord', ['name', 'kind', 'protocol', 'path', 'rois'])
+BeamsetRecord = collections.namedtuple('BeamsetRecord', ['name', 'template', 'protocol', 'path', 'technique',
+                                                         'dicom_name', 'beams'])
+Tg263Record = collections.namedtuple('Tg263Record', ['name', 'aliases'])
+# Entry of the inverted index: kind is prescription, goal or objective, order is None for protocol level records,
+# set is the goal or objective set the record came from (None if listed directly), priority is the priority of
+# the goal set reference where the record has none of its own and folder is the folder of the protocol file
+RoiReference = collections.namedtuple('RoiReference', ['kind', 'protocol', 'order', 'set', 'priority', 'record',
+                                                       'folder'])
+
+
+def _text(element, tag):
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return None
+    return child.text.strip()
+
+
+def _number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def roi_record(element):
+    """
+    Compact record of a <roi> element
+    :param element: xml element
+    :return: RoiRecord
+    """
+    attributes = []
+    for child in element:
+        if child.tag not in ['name', 'type', 'dose', 'volume', 'priority', 'weight'] and child.text:
+            attributes.append((child.tag, child.text.strip()))
+        for k, v in child.attrib.items():
+            attributes.append(('{}.{}'.format(child.tag, k), v))
+    return RoiRecord(name=_text(element, 'name'),
+                     type=_text(element, 'type'),
+                     dose=_number(_text(element, 'dose')),
+                     volume=_number(_text(element, 'volume')),
+                     priority=_number(_text(element, 'priority')),
+                     weight=_number(_text(element, 'weight')),
+                     attributes=tuple(sorted(attributes)))
+
+
+def _names(elements):
+    return tuple(_text(e, 'name') for e in elements)
+
+
+def _goalsets(elements):
+    # Goal set references as (name, priority) pairs
+    return tuple((_text(e, 'name'), _number(_text(e, 'priority'))) for e in elements)
+
+
+def _beamset_record(element, template, protocol, path):
+    return BeamsetRecord(name=_text(element, 'name'), template=template, protocol=protocol, path=path,
+                         technique=_text(element, 'technique'), dicom_name=_text(element, 'DicomName'),
+                         beams=len(element.findall('beam')))
+
+
+def file_records(path, root):
+    """
+    Records of one parsed protocol file
+    :param path: path of the file
+    :param root: root element of the file
+    :return: {'root': root tag, 'rois': names of all <roi> elements in document order, 'protocols', 'orders',
+        'sets', 'beamsets', 'tg263': lists of records}
+    """
+    records = {'root': root.tag, 'rois': [], 'protocols': [], 'orders': [], 'sets': [], 'beamsets': [],
+               'tg263': []}
+    records['rois'] = [n for n in (_text(r, 'name') for r in root.iter('roi')) if n is not None]
+    if root.tag == 'protocol':
+        name = _text(root, 'name')
+        for o in root.findall('order'):
+            records['orders'].append(OrderRecord(
+                name=_text(o, 'name'),
+                protocol=name,
+                path=path,
+                prefix=_text(o, 'prefix'),
+                fractions=_number(_text(o, 'prescription/fractions')),
+                techniques=tuple(t.text for t in o.findall('prescription/technique')),
+                prescriptions=tuple(roi_record(r) for r in o.findall('prescription/roi')),
+                goals=tuple(roi_record(r) for r in o.findall('goals/roi')),
+                goalsets=_goalsets(o.findall('goals/goalset') + o.findall('goalset')),
+                objectives=tuple(roi_record(r) for r in o.findall('objectives/roi')),
+                objectivesets=_names(o.findall('objectiveset')),
+                beamsets=_names(o.findall('beamset'))))
+            for b in o.findall('beamset'):
+                records['beamsets'].append(_beamset_record(b, None, name, path))
+        for s in root.findall('objectiveset'):
+            records['sets'].append(SetRecord(name=_text(s, 'name'), kind='objectiveset', protocol=name, path=path,
+                                             rois=tuple(roi_record(r) for r in s.findall('objectives/roi'))))
+        for b in root.findall('beamset'):
+            records['beamsets'].append(_beamset_record(b, None, name, path))
+        records['protocols'].append(ProtocolRecord(
+            name=name,
+            path=path,
+            institutions=tuple(i.text for i in root.findall('institutions/institution')),
+            diagnoses=tuple(d.text for d in root.findall('diagnoses/icd')),
+            ct=tuple((c.attrib.get('institution'), c.text) for c in root.findall('ct/protocol')),
+            prescriptions=tuple(roi_record(r) for r in root.findall('prescription/roi')),
+            goals=tuple(roi_record(r) for r in root.findall('goals/roi')),
+            goalsets=_goalsets(root.findall('goals/goalset') + root.findall('goalset')),
+            objectivesets=_names(root.findall('objectiveset')),
+            beamsets=_names(root.findall('beamset')),
+            orders=tuple(o.name for o in records['orders'])))
+    elif root.tag == 'goalsets':
+        for s in root.findall('set'):
+            records['sets'].append(SetRecord(name=_text(s, 'name'), kind='goalset', protocol=None, path=path,
+                                             rois=tuple(roi_record(r) for r in s.findall('roi'))))
+    elif root.tag == 'objectiveset':
+        records['sets'].append(SetRecord(name=_text(root, 'name'), kind='objectiveset', protocol=None, path=path,
+                                         rois=tuple(roi_record(r) for r in root.findall('objectives/roi'))))
+    elif root.tag == 'templates':
+        for t in root.findall('beam_template'):
+            for b in t.findall('beamset'):
+                records['beamsets'].append(_beamset_record(b, _text(t, 'name'), None, path))
+    elif root.tag == 'roiset':
+        for r in root.findall('roi'):
+            alias = _text(r, 'Alias')
+            records['tg263'].append(Tg263Record(name=_text(r, 'name'),
+                                                aliases=tuple(alias.split(',')) if alias else ()))
+    return records
+
+
+# Parsed xml trees of this session: {path: (modification time, size, root element)}
+_trees = {}
+
+
+def parse(path):
+    """
+    Drop-in replacement for xml.etree.ElementTree.parse of a protocol file. Each file is parsed once per session
+    (again if it changes) and a copy of the tree is returned, so callers may modify it.
+    :param path: path to the xml file
+    :return: xml.etree.ElementTree.ElementTree
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    cached = _trees.get(path)
+    if cached is None or cached[0] != stat.st_mtime or cached[1] != stat.st_size:
+        cached = (stat.st_mtime, stat.st_size, xml.etree.ElementTree.parse(path).getroot())
+        _trees[path] = cached
+    return xml.etree.ElementTree.ElementTree(copy.deepcopy(cached[2]))
+
+
+def order_element(path, name):
+    """
+    The <order> element of a protocol file with a given name
+    :param path: path of the protocol file
+    :param name: order name
+    :return: a copy of the order element, None if not found
+    """
+    for o in parse(path).findall('./order'):
+        if _text(o, 'name') == name:
+            return o
+    return None
+
+
+def root_tag(path):
+    """
+    Tag of the root element of an xml file, read without parsing the rest of the file
+    :param path: path of the xml file
+    :return: root tag
+    """
+    for event, element in xml.etree.ElementTree.iterparse(path, events=('start',)):
+        return element.tag
+
+
+def stream(path, kinds=('roi',)):
+    """
+    Streams selected values from an xml file with iterparse, clearing each element once it has been read so that
+    memory use does not grow with the size of the file
+    :param path: path of the xml file
+    :param kinds: values to return
+        roi: name of every <roi> element
+        alias: Tg263Record of every <roi> of a TG-263 roiset file
+        order: name of every <order> of a protocol
+        protocol: name of the protocol
+    :return: generator of (kind, value) pairs in the order the elements end
+    """
+    tag = root_tag(path)
+    parser = xml.etree.ElementTree.iterparse(path, events=('end',))
+    for event, element in parser:
+        if element.tag == 'roi':
+            name = _text(element, 'name')
+            if 'roi' in kinds and name is not None:
+                yield 'roi', name
+            if 'alias' in kinds and tag == 'roiset':
+                alias = _text(element, 'Alias')
+                yield 'alias', Tg263Record(name=name, aliases=tuple(alias.split(',')) if alias else ())
+            element.clear()
+        elif element.tag == 'order' and tag == 'protocol':
+            if 'order' in kinds:
+                yield 'order', _text(element, 'name')
+            element.clear()
+        elif element.tag not in ('name', 'Alias', tag):
+            # Names are read when their parent ends, everything else is no longer needed
+            element.clear()
+    if 'protocol' in kinds and tag == 'protocol' and _text(parser.root, 'name') is not None:
+        yield 'protocol', _text(parser.root, 'name')
+
+
+def stream_records(path):
+    """
+    Records of a TG-263 roiset file read with stream, equivalent to file_records of the parsed file
+    :param path: path of the file
+    :return: records dictionary, see file_records
+    """
+    records = {'root': 'roiset', 'rois': [], 'protocols': [], 'orders': [], 'sets': [], 'beamsets': [],
+               'tg263': []}
+    for kind, value in stream(path, kinds=('roi', 'alias')):
+        if kind == 'roi':
+            records['rois'].append(value)
+        else:
+            records['tg263'].append(value)
+    return records
+
+
+def _md5(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+class ProtocolIndex(object):
+    """
+    Index of the records of every xml file below a folder. Files are keyed by absolute path, and the records of a
+    file are reused while its modification time and size, or failing that its md5 hash, are unchanged.
+
+    folder: root folder of the indexed files
+    cache: path of the pickled records, None to keep the index in memory only
+    files: {path: {'mtime', 'size', 'md5', 'records'}}
+    """
+
+    def __init__(self, folder=None, cache=None):
+        self.folder = os.path.abspath(protocol_folder if folder is None else folder)
+        self.cache = cache
+        self.files = {}
+        # Inverted index, built on first use
+        self._by_roi = None
+        self._by_order = None
+        self._primary = None
+        self._protocol_references = None
+        if cache is not None and os.path.isfile(cache):
+            try:
+                with open(cache, 'rb') as f:
+                    state = pickle.load(f)
+                if state.get('version') == cache_version and state.get('folder') == self.folder:
+                    self.files = state['files']
+            except Exception as e:
+                logging.debug('Protocol index cache {} not used: {}'.format(cache, e))
+        self.refresh()
+
+    def refresh(self):
+        """
+        Parse new and changed files and drop deleted ones, writing the cache if anything changed
+        :return: number of files parsed
+        """
+        paths = []
+        for directory, _, names in os.walk(self.folder):
+            paths += [os.path.join(directory, n) for n in names if n.endswith('.xml')]
+        parsed = 0
+        changed = set(self.files) != set(paths)
+        files = {}
+        for p in sorted(paths):
+            stat = os.stat(p)
+            entry = self.files.get(p)
+            if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                files[p] = entry
+                continue
+            md5 = _md5(p)
+            changed = True
+            if entry is not None and entry['md5'] == md5:
+                # Touched but not modified
+                entry.update({'mtime': stat.st_mtime, 'size': stat.st_size})
+                files[p] = entry
+                continue
+            try:
+                if root_tag(p) == 'roiset':
+                    # Large TG-263 files only need names and aliases, which are streamed without building a tree
+                    records = stream_records(p)
+                else:
+                    records = file_records(p, parse(p).getroot())
+            except xml.etree.ElementTree.ParseError as e:
+                logging.warning('Protocol file {} could not be parsed: {}'.format(p, e))
+                records = file_records(p, xml.etree.ElementTree.Element('unreadable'))
+            files[p] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'md5': md5, 'records': records}
+            parsed += 1
+        self.files = files
+        if changed:
+            self._by_roi = None
+            logging.debug('Protocol index: {} of {} files parsed'.format(parsed, len(files)))
+            self.save()
+        return parsed
+
+    def save(self):
+        if self.cache is None:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.cache)):
+                os.makedirs(os.path.dirname(self.cache))
+            with open(self.cache, 'wb') as f:
+                pickle.dump({'version': cache_version, 'folder': self.folder, 'files': self.files}, f, 2)
+        except (IOError, OSError) as e:
+            logging.warning('Protocol index cache {} could not be written: {}'.format(self.cache, e))
+
+    def file_records(self, path):
+        """
+        Records of one file, see file_records
+        :param path: path of the file
+        :return: records dictionary, None if the file is not in the index
+        """
+        entry = self.files.get(os.path.abspath(path))
+        return None if entry is None else entry['records']
+
+    def paths(self, folder=None, root=None):
+        """
+        Indexed files, sorted by path
+        :param folder: only files directly in this folder
+        :param root: only files with this root tag, e.g. protocol, goalsets, objectiveset, templates, roiset
+        :return: list of paths
+        """
+        folder = None if folder is None else os.path.abspath(folder)
+        return [p for p in sorted(self.files)
+                if (folder is None or os.path.dirname(p) == folder) and
+                (root is None or self.files[p]['records']['root'] == root)]
+
+    def records(self, kind, folder=None):
+        # All records of one kind (protocols, orders, sets, beamsets, tg263) in file order
+        result = []
+        for p in self.paths(folder=folder):
+            result += self.files[p]['records'][kind]
+        return result
+
+    def protocols(self, folder=None):
+        """
+        :param folder: only protocols of files directly in this folder
+        :return: {protocol name: list of ProtocolRecord}, a protocol may be split over several files
+        """
+        result = collections.OrderedDict()
+        for r in self.records('protocols', folder=folder):
+            result.setdefault(r.name, []).append(r)
+        return result
+
+    def orders(self, protocol=None, folder=None):
+        """
+        :param protocol: only the orders of this protocol
+        :param folder: only orders of files directly in this folder
+        :return: list of OrderRecord
+        """
+        return [o for o in self.records('orders', folder=folder) if protocol is None or o.protocol == protocol]
+
+    def sets(self, kind=None, folder=None):
+        # Goal sets and objective sets, kind 'goalset' or 'objectiveset'
+        return [s for s in self.records('sets', folder=folder) if kind is None or s.kind == kind]
+
+    def beamsets(self, folder=None):
+        return self.records('beamsets', folder=folder)
+
+    def roi_names(self, folder=None):
+        # Names of every <roi> element, in file and document order
+        names = []
+        for p in self.paths(folder=folder):
+            names += self.files[p]['records']['rois']
+        return names
+
+    def tg263(self, folder=None):
+        return self.records('tg263', folder=folder)
+
+    def retired(self, path):
+        """
+        :param path: path of a file or folder
+        :return: True if the path is below one of the retired_folders
+        """
+        parts = os.path.relpath(os.path.abspath(path), self.folder).split(os.sep)
+        return any(p in retired_folders for p in parts)
+
+    def _build(self):
+        # Build the inverted index of ROI name and order name to records. Protocols and orders are keyed by
+        # (folder, name): files of one protocol in the same folder are merged, other folders are kept apart
+        self._primary = {}
+        for r in self.tg263():
+            self._primary[r.name] = r.name
+            for a in r.aliases:
+                self._primary.setdefault(a.strip(), r.name)
+        goalsets = {}
+        objectivesets = {}
+        for s in self.sets():
+            folder = os.path.dirname(s.path)
+            if s.kind == 'goalset':
+                goalsets.setdefault((folder, s.name), s)
+                if not self.retired(s.path):
+                    goalsets.setdefault((None, s.name), s)
+            else:
+                objectivesets.setdefault((folder, s.protocol, s.name), s)
+        self._by_roi = {}
+        self._by_order = {}
+
+        def add(references, kind, protocol, order, records, folder, set_name=None, priority=None):
+            retired = self.retired(folder)
+            for record in records:
+                reference = RoiReference(kind=kind, protocol=protocol, order=order, set=set_name,
+                                         priority=record.priority if record.priority is not None else priority,
+                                         record=record, folder=folder)
+                references.append(reference)
+                if not retired:
+                    self._by_roi.setdefault(self.primary_name(record.name), []).append(reference)
+
+        def add_goalsets(references, protocol, order, names, folder):
+            for name, priority in names:
+                # Goal sets of the protocol folder first, then of any folder in use
+                s = goalsets.get((folder, name), goalsets.get((None, name)))
+                if s is not None:
+                    add(references, 'goal', protocol, order, s.rois, folder, set_name=name, priority=priority)
+                else:
+                    logging.debug('Goal set {} of protocol {} not found'.format(name, protocol))
+
+        protocol_references = {}
+        for name, protocols in self.protocols().items():
+            for p in protocols:
+                folder = os.path.dirname(p.path)
+                references = protocol_references.setdefault((folder, name), [])
+                add(references, 'prescription', name, None, p.prescriptions, folder)
+                add(references, 'goal', name, None, p.goals, folder)
+                add_goalsets(references, name, None, p.goalsets, folder)
+                for s in p.objectivesets:
+                    if (folder, name, s) in objectivesets:
+                        add(references, 'objective', name, None, objectivesets[(folder, name, s)].rois, folder,
+                            set_name=s)
+        for o in self.orders():
+            folder = os.path.dirname(o.path)
+            references = self._by_order.setdefault((folder, o.name), [])
+            add(references, 'prescription', o.protocol, o.name, o.prescriptions, folder)
+            add(references, 'goal', o.protocol, o.name, o.goals, folder)
+            add_goalsets(references, o.protocol, o.name, o.goalsets, folder)
+            add(references, 'objective', o.protocol, o.name, o.objectives, folder)
+        self._protocol_references = protocol_references
+
+    def folder_of(self, protocol=None, order=None):
+        """
+        Folder of a protocol or order, for callers that do not know which folder was selected. Folders in use come
+        before retired folders, then in path order
+        :param protocol: protocol name
+        :param order: order name, used if protocol is None
+        :return: absolute folder path, None if not found
+        """
+        if self._by_roi is None:
+            self._build()
+        if protocol is not None:
+            folders = [f for f, n in self._protocol_references if n == protocol]
+        else:
+            folders = [f for f, n in self._by_order if n == order]
+        folders = sorted(folders, key=lambda f: (self.retired(f), f))
+        return folders[0] if folders else None
+
+    def primary_name(self, name):
+        """
+        TG-263 primary name of an ROI name or alias
+        :param name: ROI name
+        :return: the primary name, or name if it is not a TG-263 name or alias
+        """
+        if self._by_roi is None:
+            self._build()
+        return self._primary.get(name, name)
+
+    def references(self, roi, kinds=None):
+        """
+        Every prescription, goal and objective record of an ROI in all protocols
+        :param roi: ROI name or TG-263 alias
+        :param kinds: only references of these kinds (prescription, goal, objective)
+        :return: list of RoiReference
+        """
+        if self._by_roi is None:
+            self._build()
+        return [r for r in self._by_roi.get(self.primary_name(roi), []) if kinds is None or r.kind in kinds]
+
+    def order_references(self, order=None, protocol=None, kinds=None, goalsets=True, folder=None):
+        """
+        Records that apply to an order: the protocol level records of its protocol followed by those of the order
+        :param order: order name, None for the protocol level records only
+        :param protocol: protocol name, required if order is None or to choose between orders of the same name
+        :param kinds: only references of these kinds (prescription, goal, objective)
+        :param goalsets: include the goals of referenced goal sets
+        :param folder: folder of the protocol files, see folder_of if None
+        :return: list of RoiReference
+        """
+        if self._by_roi is None:
+            self._build()
+        if folder is None:
+            folder = self.folder_of(protocol=protocol, order=order)
+        folder = os.path.abspath(folder) if folder is not None else None
+        references = []
+        if order is not None:
+            references = [r for r in self._by_order.get((folder, order), [])
+                          if protocol is None or r.protocol == protocol]
+            if protocol is None and references:
+                protocol = references[0].protocol
+        references = self._protocol_references.get((folder, protocol), []) + references
+        return [r for r in references if (kinds is None or r.kind in kinds) and (goalsets or r.set is None)]
+
+    def match_rois(self, references, rois, mapping=None):
+        """
+        Group references by the plan ROI they apply to
+        :param references: list of RoiReference
+        :param rois: ROI names of the plan
+        :param mapping: {protocol ROI name: plan ROI name} of user matched structures, e.g. targets
+        :return: {plan ROI name: list of RoiReference}, references without a plan ROI are grouped under None
+        """
+        mapping = {} if mapping is None else mapping
+        plan_rois = {}
+        for r in rois:
+            plan_rois.setdefault(self.primary_name(r), r)
+        for r in rois:
+            plan_rois[r] = r
+        matched = {}
+        for reference in references:
+            name = reference.record.name
+            roi = mapping.get(name) or plan_rois.get(name) or plan_rois.get(self.primary_name(name))
+            matched.setdefault(roi, []).append(reference)
+        return matched
+
+
+_index = None
+
+
+def get_index(folder=None):
+    """
+    The protocol index of this session, refreshed on every call so edited files are picked up
+    :param folder: root folder of the protocols, protocol_folder if None
+    :return: ProtocolIndex
+    """
+    global _index
+    folder = os.path.abspath(protocol_folder if folder is None else folder)
+    if _index is None or _index.folder != folder:
+        _index = ProtocolIndex(folder=folder, cache=cache_path if folder == protocol_folder else None)
+    else:
+        _index.refresh()
+    return _index
@@ -53,6 +53,8 @@ import System.Drawing
 import numpy as np
 import xml
 import re
+import ProtocolIndex
+import GoalEvaluation
 
 
 def exclude_from_export(case, rois):
@@ -171,6 +173,7 @@ def make_boolean_structure(patient, case, examination, **kwargs):
 
     case.PatientModel.RegionsOfInterest[StructureName].UpdateDerivedGeometry(
         Examination=examination, Algorithm="Auto")
+    GoalEvaluation.rois_changed(case, StructureName)
     patient.SetRoiVisibility(RoiName=StructureName,
                              IsVisible=VisualizeStructure)
     patient.Set2DvisualizationForRoi(RoiName=StructureName,
@@ -413,6 +416,7 @@ def check_structure_exists(case, structure_name, roi_list=None, option='Check'):
     if any(roi.OfRoi.Name == structure_name for roi in roi_list):
         if option == 'Delete':
             case.PatientModel.RegionsOfInterest[structure_name].DeleteRoi()
+            GoalEvaluation.rois_changed(case, structure_name)
             logging.warning(structure_name + 'found - deleting and creating')
         elif option == 'Check':
             logging.info(structure_name + 'found')
@@ -491,30 +495,26 @@ def find_normal_structures_match(rois, site=None, num_matches=None, protocol_fil
     # path_to_secondary_sets = os.path.join(os.path.dirname(__file__),
     #                                      secondary_protocol_folder)
     logging.debug('Searching folder {} for rois'.format(paths[1]))
+    # ROI names and TG-263 aliases come from the pre-parsed protocol index
+    index = ProtocolIndex.get_index()
     standard_names = []
-    for f in os.listdir(paths[1]):
-        if f.endswith('.xml'):
-            tree = xml.etree.ElementTree.parse(os.path.join(paths[1], f))
-            prot_rois = tree.findall('.//roi')
-            for r in prot_rois:
-                if not any(i in r.find('name').text for i in standard_names):
-                    standard_names.append(r.find('name').text)
+    for n in index.roi_names(folder=paths[1]):
+        if not any(i in n for i in standard_names):
+            standard_names.append(n)
     match_threshold = 0.6
     if num_matches is None:
         num_matches = 1
 
-    tree = xml.etree.ElementTree.parse(os.path.join(paths[0],files[0][2]))
-    roi263 = tree.findall('./' + 'roi')
+    roi263 = index.tg263(folder=paths[0])
     # Check aliases first (look in TG-263 to see if an alias is there).
     aliases = {}
     matched_rois = {}
     for r in roi263:
-        if r.find('Alias').text is not None:
-            alias = r.find('Alias').text
-            aliases[r.find('name').text] = alias.split(',')
+        if r.aliases:
+            aliases[r.name] = list(r.aliases)
 
     for r in roi263:
-        standard_names.append(r.find('name').text)
+        standard_names.append(r.name)
 
     # beg_left = re.compile('L_*'.re.IGNORECASE)
     # end_left = re.compile('*_L')
@@ -637,6 +637,7 @@ def translate_roi(case, exam, roi, shifts):
                         'M41':0, 'M42':0, 'M43':0, 'M44':1}
     case.PatientModel.RegionsOfInterest['TomoCouch'].TransformROI3D(
         Examination=exam,TransformationMatrix=transform_matrix)
+    GoalEvaluation.rois_changed(case, 'TomoCouch')
     # case.PatientModel.StructureSets[exam].RoiGeometries[roi].TransformROI3D(
     #    Examination=exam,TransformationMatrix=transform_matrix)
 
@@ -34,6 +34,7 @@ import os
 import logging
 import xml.etree.ElementTree
 import Goals
+import ProtocolIndex
 
 icd = '../../protocols/icd10cm_codes_2018.txt'
 
@@ -1498,9 +1499,16 @@ class PlanDialog:
 
         # Search protocol list, parsing each XML file for protocols and goalsets
         logging.debug('Searching folder {} for protocols, goal sets'.format(folder))
+        index = ProtocolIndex.get_index()
         for f in os.listdir(folder):
             if f.endswith('.xml'):
-                tree = xml.etree.ElementTree.parse(os.path.join(folder, f))
+                # Files that are neither protocols nor goal sets are skipped without parsing them, using the
+                # protocol index or, for files outside of it, the streamed root tag
+                records = index.file_records(os.path.join(folder, f))
+                root = records['root'] if records is not None else ProtocolIndex.root_tag(os.path.join(folder, f))
+                if root not in ['protocol', 'goalsets']:
+                    continue
+                tree = ProtocolIndex.parse(os.path.join(folder, f))
                 if tree.getroot().tag == 'protocol':
                     logging.debug("parsing xml: {}".format(f))
                     n = tree.find('name').text
@@ -34,6 +34,8 @@ import os
 import logging
 import xml.etree.ElementTree
 import Goals
+import ProtocolIndex
+import ConstraintTable
 
 icd = '../../protocols/icd10cm_codes_2018.txt'
 
@@ -51,6 +53,7 @@ class TpoDialog:
         # Initialize internal variables
         self.protocols = {}
         self.goalsets = {}
+        self.constraints = ConstraintTable.ConstraintTable({})
         self.status = False
         self.institution_list = []
         self.protocol_list = []
@@ -712,9 +715,9 @@ class TpoDialog:
 
                 for g in protocol.findall('goals/goalset'):
                     if g.find('name').text in self.goalsets and int(g.find('priority').text) < self.priority:
-                        for r in self.goalsets[g.find('name').text].findall('roi'):
-                            if r.find('name').text not in self.targets and \
-                                    (r.find('fractions').text is None or int(r.find('fractions').text) == fx):
+                        # Goal set constraints without a fractionation or for the fractions of this order
+                        for r in self.constraints.elements(self.constraints.set_rows(g.find('name').text, fx)):
+                            if r.find('name').text not in self.targets:
                                 if r.find('name').text in self.oars:
                                     self.oars[r.find('name').text]['element'].append(r)
 
@@ -723,9 +726,9 @@ class TpoDialog:
 
                 for g in order.findall('goals/goalset'):
                     if g.find('name').text in self.goalsets and int(g.find('priority').text) < self.priority:
-                        for r in self.goalsets[g.find('name').text].findall('roi'):
-                            if r.find('name').text not in self.targets and \
-                                    (r.find('fractions').text is None or int(r.find('fractions').text) == fx):
+                        # Goal set constraints without a fractionation or for the fractions of this order
+                        for r in self.constraints.elements(self.constraints.set_rows(g.find('name').text, fx)):
+                            if r.find('name').text not in self.targets:
                                 if r.find('name').text in self.oars:
                                     self.oars[r.find('name').text]['element'].append(r)
 
@@ -1336,9 +1339,16 @@ class TpoDialog:
 
         # Search protocol list, parsing each XML file for protocols and goalsets
         logging.debug('Searching folder {} for protocols, goal sets'.format(folder))
+        index = ProtocolIndex.get_index()
         for f in os.listdir(folder):
             if f.endswith('.xml'):
-                tree = xml.etree.ElementTree.parse(os.path.join(folder, f))
+                # Files that are neither protocols nor goal sets are skipped without parsing them, using the
+                # protocol index or, for files outside of it, the streamed root tag
+                records = index.file_records(os.path.join(folder, f))
+                root = records['root'] if records is not None else ProtocolIndex.root_tag(os.path.join(folder, f))
+                if root not in ['protocol', 'goalsets']:
+                    continue
+                tree = ProtocolIndex.parse(os.path.join(folder, f))
                 if tree.getroot().tag == 'protocol':
                     logging.debug("parsing xml: {}".format(f))
                     n = tree.find('name').text
@@ -1357,6 +1367,9 @@ class TpoDialog:
                         else:
                             self.goalsets[n] = s
 
+        # Index the goal set constraints by set and fractions
+        self.constraints = ConstraintTable.ConstraintTable(self.goalsets)
+
         # Populate institution list
         logging.debug('{} protocols identified'.format(len(self.protocols)))
         self.institution_list = []
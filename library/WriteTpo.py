@@ -12,6 +12,9 @@
                  exam=connect.get_current('Exam'),
                  plan=connect.get_current('Plan'))
 
+    If a GoalEvaluation cache is passed as evaluations, the value, result and time of the last evaluation of
+    each clinical goal are listed with the goal. Only goals whose ROI or dose changed are evaluated again.
+
     This program is free software: you can redistribute it and/or modify it under
     the terms of the GNU General Public License as published by the Free Software
     Foundation, either version 3 of the License, or (at your option) any later version.
@@ -48,7 +51,7 @@ from reportlab.lib.styles import ParagraphStyle
 report_folder = r'\\aria\echart'
 
 
-def pdf(patient, exam, plan, folder=report_folder, fields=None, overwrite=True, priority=4):
+def pdf(patient, exam, plan, folder=report_folder, fields=None, overwrite=True, priority=4, evaluations=None):
     tic = time.time()
     filename = os.path.join(folder, '{}_{}.pdf'.format(patient.Name.replace('^', '_'), plan.Name))
     if overwrite and os.path.isfile(filename):
@@ -232,12 +235,21 @@ def pdf(patient, exam, plan, folder=report_folder, fields=None, overwrite=True,
 
     goals_header.append(P('<b>Priority</b>', s))
     goals_dict = {}
+    if evaluations is not None:
+        evaluations.evaluate()
+
     c = 0
     for f in plan.TreatmentCourse.EvaluationSetup.EvaluationFunctions:
         try:
             c += 1
             if f.PlanningGoal.Priority < priority:
                 goal = Goals.print_goal(f, 'eval')
+                result = evaluations.result(f) if evaluations is not None and goal != '' else None
+                if result is not None and result.value is not None:
+                    goal += ' ({:.4g}, {}, {})'.format(result.value, 'Pass' if result.passed else 'Fail',
+                                                      time.strftime('%m/%d/%Y %H:%M',
+                                                                    time.localtime(result.evaluated)))
+
                 if goal != '':
                     if '{}{}'.format(f.PlanningGoal.Priority, f.ForRegionOfInterest.Name) in goals_dict:
                         goals_dict['{}{}'.format(f.PlanningGoal.Priority,
@@ -252,6 +252,7 @@ def main():
                 rs_beam_set.DicomPlanLabel))
 
     status.next_step('Finalizing beam configuration')
+    settings_index = BeamOperations.OptimizationSettingsIndex(plan)
     for b in opt_setup.BeamSettings:
         start = b.ForBeam.GantryAngle
         stop = b.ForBeam.ArcStopGantryAngle
@@ -277,7 +278,8 @@ def main():
 
             success = BeamOperations.check_beam_limits(b.ForBeam.Name, plan=plan, beamset=rs_beam_set,
                                                        limit=[x1limit, x2limit, y1_limit, y2limit],
-                                                       change=True, verbose_logging=False)
+                                                       change=True, verbose_logging=False,
+                                                       settings_index=settings_index)
             if not success:
                 sys.exit('An error occurred setting beam limits')
 
@@ -61,9 +61,8 @@ def main():
     import sys
     import os
     import connect
-    import csv
     import UserInterface
-    from collections import namedtuple
+    import BeamOperations
 
     # Set the current scope of RayStation to the open patient.
     try:
@@ -95,101 +94,96 @@ def main():
         filename = os.path.join(os.path.dirname(__file__), protocol)
         filecsv = filename
 
-    # The container for each line of the csv is the Row class listed below
-    Row = namedtuple('Row',('PlanName','BeamSetName','TemplateName','TreatmentTechnique','PatientPosition','BeamName','BeamDescription','GantryStart','GantryStop','ArcDirection','CollimatorAngle','CouchAngle'))
-    # Open the csv delimited file containing the list beam templates to be loaded
+    # Load the csv delimited file containing the list beam templates through the beam template library
     # Ensure that the first row is a header for the columns
-    with open(filecsv,'r') as f:
-        r = csv.reader(f, delimiter=',')
-        r.next() # Skip header
-        beams = [Row(*l) for l in r]
+    template_beamsets = BeamOperations.beam_template_library(files=[filecsv]).file_beamsets(filecsv)
 
     IsoPosition = { 'x': 7.0, 'y': -25.0, 'z': -70.0 }
     currentplan = ""
     currentbeamset = ""
-    for beam in beams:
-        if beam.PlanName != currentplan:
+    for template, beam in [(t, b) for t in template_beamsets for b in t.beams]:
+        if template.plan_name != currentplan:
             try:
-                plan = case.AddNewPlan(PlanName=beam.PlanName,
+                plan = case.AddNewPlan(PlanName=template.plan_name,
                                        PlannedBy="",
                                        Comment="",
                                        ExaminationName=examination.Name,
                                        AllowDuplicateNames=False)
-                currentplan = beam.PlanName
+                currentplan = template.plan_name
             except SystemError:
-                RaiseError = "Unable to load Plan: %s" % beam.PlanName
+                RaiseError = "Unable to load Plan: %s" % template.plan_name
                 raise IOError(RaiseError)
-        if beam.BeamSetName != currentbeamset:
+        if template.name != currentbeamset:
             try: 
-                if (beam.TreatmentTechnique == "VMAT" or
-                        beam.TreatmentTechnique == "ConformalArc"):
-                    beamset = plan.AddNewBeamSet(Name=beam.BeamSetName,
+                if (template.technique == "VMAT" or
+                        template.technique == "ConformalArc"):
+                    beamset = plan.AddNewBeamSet(Name=template.name,
                                                  ExaminationName=examination.Name,
                                                  MachineName="TrueBeam",
                                                  Modality="Photons",
-                                                 TreatmentTechnique=beam.TreatmentTechnique,
-                                                 PatientPosition=beam.PatientPosition,
+                                                 TreatmentTechnique=template.technique,
+                                                 PatientPosition=template.patient_position,
                                                  NumberOfFractions=999,
                                                  CreateSetupBeams=False,
                                                  UseLocalizationPointAsSetupIsocenter=False,
-                                                 Comment=beam.TemplateName,
+                                                 Comment=template.template_name,
                                                  RbeModelReference=None,
                                                  EnableDynamicTrackingForVero=False,
                                                  NewDoseSpecificationPointNames=[],
                                                  NewDoseSpecificationPoints=[],
                                                  RespiratoryMotionCompensationTechnique="Disabled",
                                                  RespiratorySignalSource="Disabled")
-                    currentbeamset = beam.BeamSetName
-                elif (beam.TreatmentTechnique == "Conformal" or
-                          beam.TreatmentTechnique == "SMLC"):
-                    beamset = plan.AddNewBeamSet(Name=beam.BeamSetName,
+                    currentbeamset = template.name
+                elif (template.technique == "Conformal" or
+                          template.technique == "SMLC"):
+                    beamset = plan.AddNewBeamSet(Name=template.name,
                                                  ExaminationName=examination.Name,
                                                  MachineName="TrueBeam",
                                                  Modality="Photons",
-                                                 TreatmentTechnique=beam.TreatmentTechnique,
-                                                 PatientPosition=beam.PatientPosition,
+                                                 TreatmentTechnique=template.technique,
+                                                 PatientPosition=template.patient_position,
                                                  NumberOfFractions=999,
                                                  CreateSetupBeams=False,
                                                  UseLocalizationPointAsSetupIsocenter=False,
-                                                 Comment=beam.TemplateName,
+                                                 Comment=template.template_name,
                                                  RbeModelReference=None,
                                                  EnableDynamicTrackingForVero=False,
                                                  NewDoseSpecificationPointNames=[],
                                                  NewDoseSpecificationPoints=[],
                                                  RespiratoryMotionCompensationTechnique="Disabled",
                                                  RespiratorySignalSource="Disabled")
-                    currentbeamset = beam.BeamSetName
+                    currentbeamset = template.name
                 else:
                     raise IOError("Treatment Technique not supported")
                 # Set an rather arbritrary isocenter position
                 IsoParams = beamset.CreateDefaultIsocenterData(Position = IsoPosition)
-                IsoParams['Name'] = "iso_"+beam.BeamSetName
-                IsoParams['NameOfIsocenterToRef'] = "iso_"+beam.BeamSetName
+                IsoParams['Name'] = "iso_"+template.name
+                IsoParams['NameOfIsocenterToRef'] = "iso_"+template.name
             except SystemError:
                 raise IOError("No plan or beamset managed to load.")
         try:
-            if (beam.TreatmentTechnique == "VMAT" or
-                    beam.TreatmentTechnique == "ConformalArc"):
-                beamset.CreateArcBeam(ArcStopGantryAngle=beam.GantryStop,
-                                      ArcRotationDirection=beam.ArcDirection,
+            if (template.technique == "VMAT" or
+                    template.technique == "ConformalArc"):
+                beamset.CreateArcBeam(ArcStopGantryAngle=beam.gantry_stop_angle,
+                                      ArcRotationDirection=beam.rotation_dir,
                                       Energy=6,
                                       IsocenterData=IsoParams,
-                                      Name=beam.BeamName,
-                                      Description=beam.BeamDescription,
-                                      GantryAngle=beam.GantryStart,
-                                      CouchAngle=beam.CouchAngle,
-                                      CollimatorAngle=beam.CollimatorAngle)
-            elif (beam.TreatmentTechnique == "Conformal" or
-                      beam.TreatmentTechnique == "SMLC"):
+                                      Name=beam.name,
+                                      Description=beam.description,
+                                      GantryAngle=beam.gantry_start_angle,
+                                      CouchAngle=beam.couch_angle,
+                                      CollimatorAngle=beam.collimator_angle)
+            elif (template.technique == "Conformal" or
+                      template.technique == "SMLC"):
                 beamset.CreatePhotonBeam(Energy = 6,
                                          IsocenterData=IsoParams,
-                                         Name=beam.BeamName,
-                                         Description=beam.BeamDescription,
-                                         GantryAngle=beam.GantryStart,
-                                         CouchAngle=beam.CouchAngle,
-                                         CollimatorAngle=beam.CollimatorAngle)
+                                         Name=beam.name,
+                                         Description=beam.description,
+                                         GantryAngle=beam.gantry_start_angle,
+                                         CouchAngle=beam.couch_angle,
+                                         CollimatorAngle=beam.collimator_angle)
         except SystemError:
-            RaiseError = "Unable to load Beam: %s" % beam.BeamName
+            RaiseError = "Unable to load Beam: %s" % beam.name
             raise IOError(RaiseError)
     patient.Save()
 
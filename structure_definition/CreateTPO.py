@@ -38,6 +38,7 @@ import logging
 import time
 import WriteTpo
 import Goals
+import GoalEvaluation
 
 # Define the protocol XML directory
 protocol_folder = r'../protocols'
@@ -47,6 +48,24 @@ institution_folder = r'UW'
 priority = 4
 
 
+def match_rois(case, goals, structures):
+    """
+    Match each goal to a plan ROI, by name or else by the user selected structure
+    :param case: RS case
+    :param goals: list of Goals.Goal records
+    :param structures: {protocol structure name: plan structure name}
+    :return: {goal ROI name: plan ROI name} of the goals whose structure is found
+    """
+    roi_names = set(r.Name for r in case.PatientModel.RegionsOfInterest)
+    rois = {}
+    for g in goals:
+        if g.roi in roi_names:
+            rois[g.roi] = g.roi
+        elif structures.get(g.roi) in roi_names:
+            rois[g.roi] = structures[g.roi]
+    return rois
+
+
 def main():
     # Get current patient, case, and exam
     try:
@@ -334,70 +353,41 @@ def main():
                           'to customize these goals for this plan prior to TPO generation.')
     patient.Save()
     goals = []
-    for o in response['xml'].findall('order'):
-        if o.find('name').text == response['order']:
-            for g in o.findall('goals/roi'):
-                if (g.find('name').text in response['oars'] and response['oars'][g.find('name').text]['use']) or \
-                        (g.find('name').text in response['targets'] and
-                         response['targets'][g.find('name').text]['use']):
-                    goals.append(g)
-
-            for s in o.findall('goals/goalset'):
-                if s.find('name').text in response['goalsets']:
-                    logging.debug('Adding goalset {} to goal list'.format(s.find('name').text))
-                    for g in response['goalsets'][s.find('name').text].findall('roi'):
-                        if (g.find('name').text in response['oars'] and response['oars'][g.find('name').text]['use']) \
-                                or (g.find('name').text in response['targets'] and
-                                    response['targets'][g.find('name').text]['use']):
-                            g.append(s.find('priority'))
-                            goals.append(g)
-
-    for g in response['xml'].findall('goals/roi'):
-        if (g.find('name').text in response['oars'] and response['oars'][g.find('name').text]['use']) or \
-                (g.find('name').text in response['targets'] and
-                 response['targets'][g.find('name').text]['use']):
-            goals.append(g)
-
-    for s in response['xml'].findall('goals/goalset'):
-        if s.find('name').text in response['goalsets']:
-            logging.debug('Adding goalset {} to goal list'.format(s.find('name').text))
-            for g in response['goalsets'][s.find('name').text].findall('roi'):
-                if (g.find('name').text in response['oars'] and response['oars'][g.find('name').text]['use']) \
-                        or (g.find('name').text in response['targets'] and
-                            response['targets'][g.find('name').text]['use']):
-                    g.append(s.find('priority'))
-                    goals.append(g)
-
-    c = 0
-    for g in goals:
-        if (g.find('priority') is None or int(g.find('priority').text) < priority) and \
-                (g.find('fractions') is None or int(g.find('fractions').text) == sum(response['fractions'])):
-            roi_name = ''
-            for roi in case.PatientModel.RegionsOfInterest:
-                if roi.Name == g.find('name').text:
-                    roi_name = roi.Name
-                    break
-
-            if roi_name == '':
-                for roi in case.PatientModel.RegionsOfInterest:
-                    if (g.find('name').text in response['oars'] and
-                        roi.Name == response['oars'][g.find('name').text]['structure']) or \
-                            (g.find('name').text in response['targets'] and
-                             roi.Name == response['targets'][g.find('name').text]['structure']):
-                        roi_name = roi.Name
-                        break
-
-            # If this structure was found and the number of fractions match
-            if roi_name != '':
-                c += 1
-                Goals.add_goal(goal=g,
-                               roi=roi_name,
-                               targets=response['targets'],
-                               plan=plan,
-                               exam=exam,
-                               case=case)
-
-    if c > 0:
+    # Map each protocol structure the user chose to use to its plan structure, so that goals are matched to
+    # plan ROIs by dictionary lookups rather than by scanning the ROI list for every goal
+    structures = {}
+    for k in ('oars', 'targets'):
+        for n, v in response[k].items():
+            if v['use']:
+                structures.setdefault(n, v['structure'])
+    orders = dict((o.find('name').text, o) for o in response['xml'].findall('order'))
+    locations = [response['xml']]
+    if response['order'] in orders:
+        locations.insert(0, orders[response['order']])
+
+    for o in locations:
+        for g in o.findall('goals/roi'):
+            if g.find('name').text in structures:
+                goals.append(g)
+
+        for s in o.findall('goals/goalset'):
+            if s.find('name').text in response['goalsets']:
+                logging.debug('Adding goalset {} to goal list'.format(s.find('name').text))
+                for g in response['goalsets'][s.find('name').text].findall('roi'):
+                    if g.find('name').text in structures:
+                        g.append(s.find('priority'))
+                        goals.append(g)
+
+    # Compile the goals once and match each to a plan ROI, by name or else by the user selected structure
+    goals = Goals.compile_goals(goals)
+    rois = match_rois(case, goals, structures)
+
+    # Goals whose number of fractions match, the TPO goals are those whose structure was found
+    goals = [g for g in goals if g.fractions is None or g.fractions == sum(response['fractions'])]
+    tpo_goals = [g for g in goals if g.roi in rois and (g.priority is None or g.priority < priority)]
+    Goals.add_goals(tpo_goals, plan=plan, rois=rois, targets=response['targets'], exam=exam, case=case)
+
+    if len(tpo_goals) > 0:
         patient.Save()
         ui = connect.get_current('ui')
         ui.TitleBar.MenuItem['Plan Optimization'].Click()
@@ -408,32 +398,10 @@ def main():
 
     status.next_step(text='All remaining non-TPO planning goals are now being added...')
     patient.Save()
-    for g in goals:
-        if int(g.find('priority').text) >= priority and \
-                (g.find('fractions') is None or int(g.find('fractions').text) == sum(response['fractions'])):
-            roi_name = ''
-            for roi in case.PatientModel.RegionsOfInterest:
-                if roi.Name == g.find('name').text:
-                    roi_name = roi.Name
-                    break
-
-            if roi_name == '':
-                for roi in case.PatientModel.RegionsOfInterest:
-                    if (g.find('name').text in response['oars'] and
-                        roi.Name == response['oars'][g.find('name').text]['structure']) or \
-                            (g.find('name').text in response['targets'] and
-                             roi.Name == response['targets'][g.find('name').text]['structure']):
-                        roi_name = roi.Name
-                        break
-
-            # If this structure was found and the number of fractions match
-            if roi_name != '':
-                Goals.add_goal(goal=g,
-                               roi=roi_name,
-                               targets=response['targets'],
-                               plan=plan,
-                               exam=exam,
-                               case=case)
+    # ROIs may have been added, renamed or deleted while the script waited for the user
+    rois = match_rois(case, goals, structures)
+    Goals.add_goals([g for g in goals if g.roi in rois and g.priority is not None and g.priority >= priority],
+                    plan=plan, rois=rois, targets=response['targets'], exam=exam, case=case)
 
     # Create TPO PDF
     status.next_step(text='A treatment planning order PDF is now being generated...')
@@ -443,7 +411,8 @@ def main():
                        plan=plan,
                        fields=response,
                        overwrite=True,
-                       priority=priority)
+                       priority=priority,
+                       evaluations=GoalEvaluation.get_cache(patient=patient, case=case, exam=exam, plan=plan))
 
     # Finish up
     patient.Save()
@@ -35,6 +35,7 @@ import logging
 import time
 import WriteTpo
 import Goals
+import GoalEvaluation
 import GeneralOperations
 
 # Define the protocol XML directory
@@ -437,7 +438,8 @@ def main():
                        plan=plan,
                        fields=response,
                        overwrite=True,
-                       priority=priority)
+                       priority=priority,
+                       evaluations=GoalEvaluation.get_cache(patient=patient, case=case, exam=exam, plan=plan))
 
     # Finish up
     patient.Save()
@@ -0,0 +1,122 @@
+"""Benchmark protocol parsing
+Compares the peak memory and latency of collecting the ROI names, TG-263 aliases and order names of the
+shipped protocols with a full DOM parse against the streaming loader of ProtocolIndex. Runs outside of
+RayStation with CPython 3 (tracemalloc):
+
+    python testing/benchmark_protocol_parsing.py [-n repeats]
+
+Version Notes: 1.0.0 Original
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.0'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+import os
+import sys
+import gc
+import time
+import argparse
+import tracemalloc
+import xml.etree.ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'library'))
+import ProtocolIndex
+
+
+def dom_names(path):
+    """
+    ROI names, aliases and order names of a file from its full tree
+    :param path: path of the xml file
+    :return: list of (kind, value)
+    """
+    root = xml.etree.ElementTree.parse(path).getroot()
+    values = []
+    for r in root.iter('roi'):
+        if r.find('name') is not None and r.find('name').text is not None:
+            values.append(('roi', r.find('name').text.strip()))
+    if root.tag == 'roiset':
+        for r in root.findall('roi'):
+            alias = r.find('Alias')
+            values.append(('alias', alias.text if alias is not None else None))
+    for o in root.findall('order'):
+        values.append(('order', o.find('name').text))
+    return values
+
+
+def stream_names(path):
+    """
+    ROI names, aliases and order names of a file from ProtocolIndex.stream
+    :param path: path of the xml file
+    :return: list of (kind, value)
+    """
+    return list(ProtocolIndex.stream(path, kinds=('roi', 'alias', 'order')))
+
+
+def measure(function, paths, repeats):
+    """
+    Peak traced memory of one pass and the best time of several passes over all files. Garbage is collected
+    after each file, as iterparse leaves reference cycles that would otherwise count towards the peak
+    :param function: function of a path
+    :param paths: xml files
+    :param repeats: number of timed passes
+    :return: (peak memory in bytes, seconds)
+    """
+    tracemalloc.start()
+    for p in paths:
+        function(p)
+        gc.collect()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        for p in paths:
+            function(p)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return peak, best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare DOM and streaming parsing of the protocol files')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='timed passes per method')
+    parser.add_argument('-f', '--folder', default=ProtocolIndex.protocol_folder, help='protocol folder')
+    args = parser.parse_args(argv)
+
+    groups = {'TG-263': [], 'protocols': []}
+    for directory, _, names in os.walk(args.folder):
+        for n in sorted(names):
+            if not n.endswith('.xml'):
+                continue
+            p = os.path.join(directory, n)
+            try:
+                tag = ProtocolIndex.root_tag(p)
+            except xml.etree.ElementTree.ParseError:
+                continue
+            groups['TG-263' if tag == 'roiset' else 'protocols'].append(p)
+
+    print('{:<10} {:>6} {:>10} {:>14} {:>12}'.format('files', 'count', 'method', 'peak memory kB', 'time ms'))
+    for group, paths in sorted(groups.items()):
+        for method, function in (('dom', dom_names), ('stream', stream_names)):
+            peak, seconds = measure(function, paths, args.repeats)
+            print('{:<10} {:>6} {:>10} {:>14.0f} {:>12.1f}'.format(group, len(paths), method, peak / 1024.,
+                                                                    seconds * 1000.))
+
+
+if __name__ == '__main__':
+    main()
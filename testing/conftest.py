@@ -0,0 +1,95 @@
+"""Stand-ins for the RayStation modules
+The library imports connect, clr, System and UserInterface, which only exist inside RayStation (UserInterface
+is built on System.Windows.Forms). When they can not be imported, minimal stand-ins are installed so the tests in
+this folder can import the library and drive it with stand-in RayStation objects. Tests set the objects returned
+by connect.get_current in connect.current.
+
+Version Notes: 1.0.0 Original
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.0'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+import os
+import sys
+import types
+
+# Scripts in this folder that run inside RayStation
+collect_ignore = ['test_pydicom.py', 'test_userinterface.py', 'test_xml_handling.py']
+
+folder = os.path.dirname(os.path.abspath(__file__))
+for p in [os.path.join(folder, '..', 'library'), os.path.join(folder, '..', 'general')]:
+    if p not in sys.path:
+        sys.path.insert(0, p)
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def _get_current(name):
+    if name not in sys.modules['connect'].current:
+        raise SystemError('No {} is currently loaded'.format(name))
+    return sys.modules['connect'].current[name]
+
+
+class _ScriptStatus(object):
+    def __init__(self, steps=None, docstring=None, help=None):
+        self.steps = list(steps) if steps else ['']
+        self.current_step = -1
+
+    def next_step(self, text='', num=None):
+        self.current_step = min(self.current_step + 1 if num is None else num, len(self.steps) - 1)
+
+    def add_step(self, text=''):
+        self.steps.append(text)
+
+    def finish(self, text=''):
+        pass
+
+    def aborted(self, text=''):
+        pass
+
+
+def _dialog(*args, **kwargs):
+    pass
+
+
+try:
+    import connect
+except ImportError:
+    _module('connect', current={}, get_current=_get_current, await_user_input=_dialog)
+
+try:
+    import clr
+except ImportError:
+    _module('clr', AddReference=_dialog)
+
+try:
+    import System
+except ImportError:
+    _module('System', Drawing=_module('System.Drawing', Color=None))
+
+try:
+    import UserInterface
+except ImportError:
+    _module('UserInterface', ScriptStatus=_ScriptStatus, WarningBox=_dialog, MessageBox=_dialog,
+            QuestionBox=_dialog, InputDialog=_dialog, CommonDialog=_dialog)
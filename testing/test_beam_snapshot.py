@@ -0,0 +1,71 @@
+"""Beam snapshot tests
+Checks that BeamOperations.beam_snapshot only reads the segment shapes again when the beam changed or its
+snapshot was invalidated. Runs outside of RayStation with CPython 3 (see conftest.py):
+
+    python -m pytest testing/test_beam_snapshot.py
+
+Version Notes: 1.0.0 Original
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.0'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+from types import SimpleNamespace
+
+import BeamOperations
+
+
+class _Segment(object):
+    # Stand-in RS segment counting the reads of the leaf positions
+    reads = 0
+
+    def __init__(self, weight):
+        self.JawPositions = [-5., 5., -5., 5.]
+        self.RelativeWeight = weight
+        self._leaves = [[-1.] * 4, [1.] * 4]
+
+    @property
+    def LeafPositions(self):
+        _Segment.reads += 1
+        return self._leaves
+
+
+def _beam():
+    return SimpleNamespace(Name='1_Brai_g180', Number=1, BeamMU=100., GantryAngle=180., CouchAngle=0.,
+                           InitialCollimatorAngle=0., MachineReference=SimpleNamespace(MachineName='TrueBeam'),
+                           Segments=[_Segment(0.5), _Segment(0.5)])
+
+
+def test_cache_hit_does_not_read_leaves(monkeypatch):
+    monkeypatch.setattr(BeamOperations, '_beam_snapshots', {})
+    beam = _beam()
+    _Segment.reads = 0
+    snapshot = BeamOperations.beam_snapshot(beam)
+    assert snapshot.number_segments == 2
+    assert _Segment.reads == 2
+
+    assert BeamOperations.beam_snapshot(beam) is snapshot
+    assert _Segment.reads == 2
+
+    beam.Segments[0].RelativeWeight = 0.25
+    assert BeamOperations.beam_snapshot(beam) is not snapshot
+    assert _Segment.reads == 4
+
+    BeamOperations.invalidate_beam_snapshot(beam)
+    BeamOperations.beam_snapshot(beam)
+    assert _Segment.reads == 6
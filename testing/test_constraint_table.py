@@ -0,0 +1,73 @@
+"""Constraint table tests
+Checks that the goal set constraint tables of ConstraintTable.get_table follow edits of the goal set files.
+Runs outside of RayStation with CPython 3:
+
+    python -m pytest testing/test_constraint_table.py
+
+Version Notes: 1.0.0 Original
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.0'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'library'))
+import ProtocolIndex
+import ConstraintTable
+
+_goalset = """<goalsets>
+    <set>
+        <name>{name}</name>
+        <roi><name>SpinalCord</name><type>Max</type><dose units="Gy">{dose}</dose><fractions>5</fractions></roi>
+    </set>
+</goalsets>
+"""
+
+
+def _write(path, name, dose, mtime):
+    with open(path, 'w') as f:
+        f.write(_goalset.format(name=name, dose=dose))
+    os.utime(path, (mtime, mtime))
+
+
+def _doses(table):
+    return sorted(table.query(fractions=5)['dose'].tolist())
+
+
+def test_table_follows_goalset_edits(tmp_path, monkeypatch):
+    folder = str(tmp_path)
+    monkeypatch.setattr(ProtocolIndex, 'protocol_folder', folder)
+    monkeypatch.setattr(ProtocolIndex, 'cache_path', os.path.join(folder, 'index.pkl'))
+    monkeypatch.setattr(ProtocolIndex, '_index', None)
+    monkeypatch.setattr(ConstraintTable, '_tables', {})
+
+    _write(os.path.join(folder, 'TG101.xml'), 'TG-101', 30, 1000000000)
+    assert _doses(ConstraintTable.get_table()) == [30.]
+    # An unchanged folder reuses the table
+    assert ConstraintTable.get_table() is ConstraintTable.get_table()
+
+    _write(os.path.join(folder, 'TG101.xml'), 'TG-101', 22.5, 1000000100)
+    assert _doses(ConstraintTable.get_table()) == [22.5]
+
+    _write(os.path.join(folder, 'QUANTEC.xml'), 'QUANTEC', 45, 1000000200)
+    assert _doses(ConstraintTable.get_table()) == [22.5, 45.]
+
+    os.remove(os.path.join(folder, 'TG101.xml'))
+    assert _doses(ConstraintTable.get_table()) == [45.]
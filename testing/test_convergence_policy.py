@@ -0,0 +1,64 @@
+"""Convergence policy tests
+Checks the early termination rule of the optimize_plan warm starts (OptimizationOperations.ConvergencePolicy), in
+particular that objective values from before a dose grid change are not compared with values after it. Runs
+outside of RayStation with CPython 3:
+
+    python -m pytest testing/test_convergence_policy.py
+
+Version Notes: 1.0.0 Original
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.0'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+from OptimizationOperations import ConvergencePolicy
+
+
+def test_stops_on_plateau():
+    convergence = ConvergencePolicy(tolerance=0.01, window=2)
+    for total in [100., 50., 49.9, 49.8]:
+        convergence.record(total)
+    assert convergence.relative_improvement() < 0.01
+    assert convergence.stop_reason() is not None
+
+
+def test_grid_change_inside_window():
+    convergence = ConvergencePolicy(tolerance=0.01, window=2)
+    convergence.record(100.)
+    convergence.record(50.)
+    # The finer grid raises the objective, which would read as a large negative improvement over the window
+    convergence.grid_changed()
+    convergence.record(60.)
+    assert convergence.relative_improvement() is None
+    assert convergence.relative_improvement(window=1) is None
+    assert convergence.stop_reason() is None
+    convergence.record(59.99)
+    assert convergence.relative_improvement() is None
+    assert convergence.stop_reason() is None
+    # The window is full of warm starts on the new grid
+    convergence.record(59.98)
+    assert abs(convergence.relative_improvement() - (60. - 59.98) / 60.) < 1e-12
+    assert convergence.stop_reason() is not None
+
+
+def test_grid_change_does_not_hide_time_budget():
+    convergence = ConvergencePolicy(tolerance=0.01, window=2, time_budget=0.)
+    convergence.record(100.)
+    convergence.grid_changed()
+    convergence.record(90.)
+    assert convergence.stop_reason().startswith('time budget')
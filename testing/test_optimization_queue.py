@@ -0,0 +1,118 @@
+"""Optimization queue tests
+Runs the batch optimization queue of automated_plan_optimization against a stand-in connect module and
+stand-in patients, with optimize_plan replaced by a recorder. Runs outside of RayStation with CPython 3:
+
+    python -m pytest testing/test_optimization_queue.py
+
+Version Notes: 1.0.0 Original
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.0'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+import re
+import json
+import types
+import OptimizationOperations
+import automated_plan_optimization
+
+
+class _Current(object):
+    # A case, plan or beamset that can be made current
+    def __init__(self, name, **children):
+        self.Name = name
+        self.__dict__.update(children)
+
+    def SetCurrent(self):
+        pass
+
+
+class _Patient(object):
+    def __init__(self, patient_id):
+        self.PatientID = patient_id
+        self.saves = 0
+        beamset = _Current('VMAT_Test')
+        plan = _Current('VMAT_Test', BeamSets={'VMAT_Test': beamset})
+        self.Cases = {'Case 1': _Current('Case 1', TreatmentPlans={'VMAT_Test': plan})}
+
+    def Save(self):
+        self.saves += 1
+
+
+class _PatientDB(object):
+    def __init__(self, patients):
+        self.patients = patients
+        self.filters = []
+
+    def QueryPatientInfo(self, Filter):
+        self.filters.append(Filter['PatientID'])
+        return [{'PatientID': p} for p in self.patients if re.match(Filter['PatientID'], p)]
+
+    def LoadPatient(self, PatientInfo):
+        return self.patients[PatientInfo['PatientID']]
+
+
+def _connect(patients):
+    db = _PatientDB(dict((p.PatientID, p) for p in patients))
+    return types.SimpleNamespace(get_current=lambda name: db, db=db)
+
+
+def _job(patient_id, **inputs):
+    return {'PatientID': patient_id, 'Case': 'Case 1', 'Plan': 'VMAT_Test', 'BeamSet': 'VMAT_Test',
+            'OptimizationInputs': inputs}
+
+
+def test_queue_continues_past_failures(tmp_path, monkeypatch):
+    calls = []
+
+    def optimize_plan(patient, case, plan, beamset, **inputs):
+        calls.append((patient.PatientID, inputs))
+        if inputs.get('n_iterations') == 0:
+            raise ValueError('no iterations')
+
+    monkeypatch.setattr(OptimizationOperations, 'optimize_plan', optimize_plan)
+    patients = [_Patient('12.34'), _Patient('1234'), _Patient('5678')]
+    rs = _connect(patients)
+    exported = []
+    results_path = str(tmp_path / 'results.jsonl')
+    jobs = [_job('12.34', n_iterations=6), _job('0000'), _job('5678', n_iterations=0), _job('1234')]
+    results = automated_plan_optimization.run_queue(jobs, connect_module=rs, results_path=results_path,
+                                                    export=lambda job, *args: exported.append(job['PatientID']))
+
+    assert [r['Status'] for r in results] == ['Exported', 'Failed', 'Failed', 'Exported']
+    assert 'IOError' in results[1]['Error'] or 'OSError' in results[1]['Error']
+    assert 'no iterations' in results[2]['Error']
+    assert exported == ['12.34', '1234']
+    # The PatientID is matched literally, 12.34 does not match 1234
+    assert rs.db.filters[0] == r'^12\.34$'
+    # Queued runs are headless, write telemetry and save the patient once
+    assert [c[0] for c in calls] == ['12.34', '5678', '1234']
+    assert all(c[1]['headless'] and c[1]['telemetry'] and not c[1]['save'] for c in calls)
+    assert calls[0][1]['n_iterations'] == 6
+    assert [p.saves for p in patients] == [1, 1, 0]
+    with open(results_path) as f:
+        assert [json.loads(l)['Status'] for l in f] == ['Exported', 'Failed', 'Failed', 'Exported']
+
+
+def test_read_jobs(tmp_path):
+    path = tmp_path / 'jobs.jsonl'
+    path.write_text(json.dumps(_job('1234')) + '\n\n' + json.dumps({'PatientID': '5678', 'Case': 'Case 1',
+                                                                     'Plan': 'VMAT_Test', 'BeamSet': 'VMAT_Test'}))
+    jobs = automated_plan_optimization.read_jobs(str(path))
+    assert [j['PatientID'] for j in jobs] == ['1234', '5678']
+    assert jobs[1]['OptimizationInputs'] == {}
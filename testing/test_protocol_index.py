@@ -0,0 +1,92 @@
+"""Protocol index tests
+Checks that protocols of the same name in different folders, such as protocols/Retired, are kept apart by the
+protocol index. Runs outside of RayStation with CPython 3:
+
+    python -m pytest testing/test_protocol_index.py
+
+Version Notes: 1.0.0 Original
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+    this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Adam Bayliss'
+__contact__ = 'rabayliss@wisc.edu'
+__version__ = '1.0.0'
+__license__ = 'GPLv3'
+__copyright__ = 'Copyright (C) 2018, University of Wisconsin Board of Regents'
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'library'))
+import ProtocolIndex
+
+_protocol = """<protocol>
+    <name>Test Prostate</name>
+    <goals>
+        <roi><name>Bladder</name><type>Max</type><dose units="Gy">80</dose><priority>3</priority></roi>
+        {goals}
+    </goals>
+    <order>
+        <name>Prostate 7000cGy in 28Fx</name>
+        <goals>
+            <roi><name>Rectum</name><type>Max</type><dose units="Gy">72</dose><priority>3</priority></roi>
+        </goals>
+    </order>
+</protocol>
+"""
+
+
+def _write(path, goals=''):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(_protocol.format(goals=goals))
+
+
+def _goal_names(references):
+    return sorted(r.record.name for r in references)
+
+
+def test_retired_protocol_not_merged(tmp_path):
+    folder = str(tmp_path)
+    _write(os.path.join(folder, 'UW', 'Prostate.xml'))
+    _write(os.path.join(folder, 'Retired', 'Prostate.xml'),
+           goals='<roi><name>PenileBulb</name><type>Mean</type><dose units="Gy">50</dose>'
+                 '<priority>3</priority></roi>')
+    index = ProtocolIndex.ProtocolIndex(folder=folder)
+
+    uw = index.order_references('Prostate 7000cGy in 28Fx', protocol='Test Prostate', kinds=['goal'],
+                                folder=os.path.join(folder, 'UW'))
+    assert _goal_names(uw) == ['Bladder', 'Rectum']
+    # Without a folder the folder in use is chosen over the retired one
+    assert _goal_names(index.order_references('Prostate 7000cGy in 28Fx', protocol='Test Prostate',
+                                              kinds=['goal'])) == ['Bladder', 'Rectum']
+    retired = index.order_references('Prostate 7000cGy in 28Fx', protocol='Test Prostate', kinds=['goal'],
+                                     folder=os.path.join(folder, 'Retired'))
+    assert _goal_names(retired) == ['Bladder', 'PenileBulb', 'Rectum']
+    # Retired protocols are left out of the ROI lookup
+    assert index.references('PenileBulb') == []
+
+
+def test_shipped_prostate_excludes_retired_goals():
+    index = ProtocolIndex.ProtocolIndex(folder=ProtocolIndex.protocol_folder)
+    uw = os.path.join(ProtocolIndex.protocol_folder, 'UW')
+    names = set(r.record.name for r in index.order_references(protocol='UW Prostate', kinds=['goal'],
+                                                              goalsets=False, folder=uw))
+    retired = set(r.record.name for r in index.order_references(
+        protocol='UW Prostate', kinds=['goal'], goalsets=False,
+        folder=os.path.join(ProtocolIndex.protocol_folder, 'Retired')))
+    assert names
+    assert retired - names
+    assert all(r.folder == uw for r in index.order_references(protocol='UW Prostate', folder=uw))